@@ -1,4 +1,4 @@
-from flask import Flask, request, send_file, render_template, jsonify, url_for, make_response
+from flask import Flask, request, send_file, render_template, jsonify, url_for, make_response, g, has_request_context, session
 from flask_talisman import Talisman # Security Headers
 from flask_wtf.csrf import CSRFProtect, CSRFError # CSRF Protection
 from flask_limiter import Limiter # Rate Limiting
@@ -8,20 +8,36 @@ import sys
 import time
 import subprocess
 import logging
+import logging.handlers
+import atexit
+import signal
+try: import resource # POSIX only
+except ImportError: resource = None
 import glob
+import re
 from werkzeug.utils import secure_filename
-from werkzeug.exceptions import RequestEntityTooLarge # Better handling for large files
-from pdf2docx import Converter
+from werkzeug.exceptions import RequestEntityTooLarge, NotFound # Better handling for large files
+from werkzeug.security import safe_join
+from werkzeug.datastructures import FileStorage, MultiDict
 import tempfile
-import PyPDF2
 import shutil
-from pdf2image import convert_from_path, pdfinfo_from_path
-from pdf2image.exceptions import PDFInfoNotInstalledError, PDFPageCountError, PDFSyntaxError
-from pptx import Presentation
-from pptx.util import Inches, Pt
+import json
+import hashlib
+import mimetypes
+import collections
+import threading
+import importlib
+import functools
+import secrets
+import queue
+import itertools
+import heapq
+import contextlib
+import pathlib
 from io import BytesIO
-from PIL import Image, UnidentifiedImageError
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 try:
     import magic
 except ImportError:
@@ -29,6 +45,26 @@ except ImportError:
     logging.warning("python-magic library not found. MIME type detection might be less reliable.")
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+
+class _LazyModule:
+    # Proxy import module nặng ở lần truy cập thuộc tính đầu tiên, giúp khởi động worker nhanh
+    def __init__(self, name): self._name = name
+    def __getattr__(self, attr): return getattr(importlib.import_module(self._name), attr)
+    def load(self): return importlib.import_module(self._name)
+
+pdf2docx = _LazyModule('pdf2docx')
+PyPDF2 = _LazyModule('PyPDF2')
+pdf2image = _LazyModule('pdf2image')
+pdf2image_exceptions = _LazyModule('pdf2image.exceptions')
+pptx = _LazyModule('pptx')
+pptx_util = _LazyModule('pptx.util')
+Image = _LazyModule('PIL.Image')
+ImageOps = _LazyModule('PIL.ImageOps')
+fitz = _LazyModule('fitz')
+docx = _LazyModule('docx')
+docx_shared = _LazyModule('docx.shared')
+HEAVY_MODULES = (pdf2docx, PyPDF2, pdf2image, pdf2image_exceptions, pptx, pptx_util, Image, ImageOps, fitz, docx, docx_shared)
+
 #Basic Flask App Setup
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
@@ -41,12 +77,68 @@ app.wsgi_app = ProxyFix(
 )
 
 #Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - [%(funcName)s] - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+#LOG_FORMAT=json -> mỗi dòng 1 object JSON. Request thread chỉ đẩy record vào queue, ghi stdout do 1 thread listener riêng làm.
+#LOG_SAMPLE_RATES="sweep=50,engine=1": logger con ồn ào chỉ giữ 1/N record INFO/DEBUG (WARNING trở lên luôn giữ)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_OUTPUT_TAIL = int(os.environ.get('LOG_OUTPUT_TAIL', 2000)) # Số ký tự cuối của stdout/stderr engine được log
+LOG_SAMPLE_RATES = {name.strip(): max(1, int(rate)) for name, _, rate in (item.partition('=') for item in os.environ.get('LOG_SAMPLE_RATES', 'sweep=50,engine=1').split(',')) if name.strip() and rate.strip().isdigit()}
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname, 'logger': record.name, 'func': record.funcName, 'msg': record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS) # extra={...}
+        if record.exc_info: entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text: entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SampledLogFilter(logging.Filter):
+    def __init__(self, every):
+        super().__init__(); self.every = every; self.counter = itertools.count(); self.suppressed = 0
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or next(self.counter) % self.every == 0: return True
+        self.suppressed += 1; return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    # Queue đầy (stdout bị nghẽn) thì bỏ record và đếm, không bao giờ chặn request thread
+    dropped = 0
+    def enqueue(self, record):
+        try: self.queue.put_nowait(record)
+        except queue.Full: NonBlockingQueueHandler.dropped += 1
+    def prepare(self, record):
+        # Chỉ ghép msg % args (args có thể bị sửa sau đó); traceback và format dòng log để thread listener làm
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.message = record.getMessage(); record.args = None
+        return record
+
+def output_tail(text, limit=None):
+    # Chỉ giữ phần cuối output của subprocess (lỗi thường nằm ở cuối), tránh dump cả MB log vào stdout
+    limit = limit or LOG_OUTPUT_TAIL
+    text = (text or '').strip()
+    return text if len(text) <= limit else f"...[{len(text) - limit} chars truncated]\n{text[-limit:]}"
+
+def _setup_logging():
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else logging.Formatter('%(asctime)s - %(levelname)s - [%(funcName)s] - %(message)s'))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO), handlers=[NonBlockingQueueHandler(log_queue)], force=True)
+    listener.start(); atexit.register(listener.stop)
+    return listener
+
+_log_listener = _setup_logging()
 logger = logging.getLogger(__name__)
+sweep_logger = logging.getLogger(f"{__name__}.sweep") # Teardown/cleanup: 1 dòng mỗi file bị xóa
+engine_logger = logging.getLogger(f"{__name__}.engine") # Command line + stdout/stderr của LibreOffice/Ghostscript
+_log_samplers = {}
+for _name, _logger in (('sweep', sweep_logger), ('engine', engine_logger)):
+    if LOG_SAMPLE_RATES.get(_name, 1) > 1: _log_samplers[_name] = SampledLogFilter(LOG_SAMPLE_RATES[_name]); _logger.addFilter(_log_samplers[_name])
+
+def get_log_stats():
+    return {'format': LOG_FORMAT, 'queue_depth': _log_listener.queue.qsize(), 'dropped': NonBlockingQueueHandler.dropped,
+            'sampled_out': {name: sampler.suppressed for name, sampler in _log_samplers.items()}}
 
 #Security
 csrf = CSRFProtect(app)
@@ -57,14 +149,62 @@ limiter = Limiter(
     storage_uri="memory://",
     strategy="fixed-window"
 )
+
+#Asset frontend đã build (python build_assets.py -> static/dist + manifest.json): CSS Tailwind đã purge, font Roboto tự host,
+#JS của trang; tên file có hash nội dung nên cache vĩnh viễn (immutable) và có sẵn bản .br/.gz gửi theo Accept-Encoding.
+#Chưa build (môi trường dev) thì trang dùng Tailwind CDN + Google Fonts + file nguồn trong static/ như trước.
+ASSET_DIST_FOLDER = os.path.join(app.static_folder, 'dist')
+ASSET_CACHE_MAX_AGE = 365 * 24 * 3600
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz')) # Theo thứ tự ưu tiên
+mimetypes.add_type('font/woff2', '.woff2')
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(ASSET_DIST_FOLDER, 'manifest.json'), encoding='utf-8') as f: manifest = json.load(f)
+    except FileNotFoundError: return {}
+    except (OSError, ValueError) as e: logger.warning(f"Asset manifest unreadable, serving unbuilt assets: {e}"); return {}
+    missing = [name for name in manifest.values() if not os.path.isfile(os.path.join(ASSET_DIST_FOLDER, name))]
+    if missing: logger.warning(f"Asset manifest lists missing files {missing}, serving unbuilt assets"); return {}
+    return manifest
+
+ASSET_MANIFEST = load_asset_manifest()
+ASSETS_BUILT = bool(ASSET_MANIFEST)
+
+@app.template_global()
+def asset_url(name):
+    # Tên logic (app.js, app.css...) -> URL file đã hash trong static/dist, hoặc file nguồn trong static/ khi chưa build
+    if name in ASSET_MANIFEST: return url_for('static', filename=f"dist/{ASSET_MANIFEST[name]}")
+    return url_for('static', filename=name)
+
+def serve_static_file(filename):
+    # Thay view 'static' mặc định của Flask (giữ tên endpoint nên url_for và miễn rate limit vẫn như cũ)
+    if not filename.startswith('dist/'): return app.send_static_file(filename)
+    path = safe_join(ASSET_DIST_FOLDER, filename[len('dist/'):])
+    if not path or not os.path.isfile(path) or path.endswith(tuple(suffix for _, suffix in ASSET_ENCODINGS)): raise NotFound()
+    send_path, encoding = path, None
+    for candidate, suffix in ASSET_ENCODINGS:
+        if request.accept_encodings[candidate] and os.path.isfile(path + suffix): send_path, encoding = path + suffix, candidate; break
+    response = send_file(send_path, mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream', conditional=True, max_age=ASSET_CACHE_MAX_AGE)
+    if encoding: response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = f"public, max-age={ASSET_CACHE_MAX_AGE}, immutable"
+    return response
+
+app.view_functions['static'] = serve_static_file
+
 csp = {
-    'default-src': ['\'self\'', 'https://cdn.tailwindcss.com', 'https://fonts.googleapis.com', 'https://fonts.gstatic.com'],
-    'style-src': ['\'self\'', '\'unsafe-inline\'', 'https://cdn.tailwindcss.com', 'https://fonts.googleapis.com'], # Allow inline styles for now
-    'script-src': ['\'self\'', '\'unsafe-inline\'', 'https://cdn.tailwindcss.com'], # Allow inline scripts for now
-    'font-src': ['\'self\'', 'https://fonts.gstatic.com'],
+    'default-src': ['\'self\''],
+    'style-src': ['\'self\'', '\'unsafe-inline\''], # Allow inline styles for now (style="" attributes, JS style changes)
+    'script-src': ['\'self\''], # Không còn script/onclick inline (appConfig là JSON, không thực thi)
+    'font-src': ['\'self\''],
     'img-src': ['\'self\'', 'data:'],
     'form-action': '\'self\''
 }
+if not ASSETS_BUILT: # Chế độ dev: Tailwind CDN + Google Fonts
+    csp['default-src'] += ['https://cdn.tailwindcss.com', 'https://fonts.googleapis.com', 'https://fonts.gstatic.com']
+    csp['style-src'] += ['https://cdn.tailwindcss.com', 'https://fonts.googleapis.com']
+    csp['script-src'] += ['\'unsafe-inline\'', 'https://cdn.tailwindcss.com']
+    csp['font-src'] += ['https://fonts.gstatic.com']
 
 talisman = Talisman(
     app,
@@ -91,6 +231,12 @@ ALLOWED_MIME_TYPES = {
 }
 LIBREOFFICE_TIMEOUT = 180
 GS_TIMEOUT = 180
+#Giới hạn cho tiến trình engine (LibreOffice/Ghostscript) chạy qua run_engine; 0 = không giới hạn
+ENGINE_MEMORY_LIMIT_MB = int(os.environ.get('ENGINE_MEMORY_LIMIT_MB', 4096)) # RLIMIT_AS (virtual, soffice reserve khá nhiều)
+ENGINE_CPU_LIMIT_SECONDS = int(os.environ.get('ENGINE_CPU_LIMIT_SECONDS', 0)) # RLIMIT_CPU; 0 = 2 x timeout
+ENGINE_NICE = int(os.environ.get('ENGINE_NICE', 5))
+ENGINE_OUTPUT_BUFFER = int(os.environ.get('ENGINE_OUTPUT_BUFFER', 64 * 1024)) # Byte cuối của stdout/stderr được giữ lại
+ENGINE_KILL_GRACE = 5 # Giây chờ sau SIGTERM trước khi SIGKILL cả process group
 MIME_BUFFER_SIZE = 4096
 
 
@@ -101,131 +247,670 @@ def make_error_response(error_key, status_code=400):
     response.headers["Content-Type"] = "text/plain; charset=utf-8"
     return response
 
-#Tìm và xác minh LibreOffice
-SOFFICE_PATH = None
-potential_paths_win = []
+#Tìm và xác minh LibreOffice / Ghostscript
+# Discovery chạy lazy (lần dùng đầu tiên hoặc trong thread warm-up), kết quả probe version được cache trên đĩa
+# theo path + mtime của binary nên restart worker/container không phải chạy lại `--version`.
+ENGINE_CACHE_PATH = os.environ.get('ENGINE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'convert_all_files_engines.json'))
+ENGINE_WARMUP = os.environ.get('ENGINE_WARMUP', 'True').lower() in ['true', '1', 't']
+LO_VERSION_TIMEOUT = 15
+GS_VERSION_TIMEOUT = 10
 
+_engine_paths = {} # 'soffice' / 'gs' -> path đã xác minh (hoặc None), chỉ có key khi discovery đã chạy xong
+_engine_locks = {'soffice': threading.Lock(), 'gs': threading.Lock()}
+_engine_cache_lock = threading.Lock()
+_warmup_lock = threading.Lock()
+_warmup_state = {'started': False, 'done': threading.Event(), 'error': None, 'started_at': None, 'finished_at': None}
 
-if sys.platform == 'win32':
-    common_paths = [
-        r'C:\Program Files\LibreOffice\program\soffice.exe',
-        r'C:\Program Files (x86)\LibreOffice\program\soffice.exe'
-    ]
-    potential_paths_win.extend(common_paths)
 
+def _engine_cache_key(binary_path):
+    stat_result = os.stat(binary_path)
+    return f"{os.path.realpath(binary_path)}|{stat_result.st_mtime_ns}|{stat_result.st_size}"
 
-    for path_to_check in potential_paths_win:
-        if os.path.isfile(path_to_check):
-            logger.info(f"Found potential LO path by checking known Windows location: {path_to_check}")
-            SOFFICE_PATH = path_to_check
-            logger.info(f"Assuming valid LO on Windows (path exists) and setting path: {SOFFICE_PATH}")
-            break
+def _load_engine_cache():
+    try:
+        with open(ENGINE_CACHE_PATH, 'r', encoding='utf-8') as f: cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError): return {}
+
+def _store_engine_cache_entry(cache_key, entry):
+    with _engine_cache_lock:
+        cache = _load_engine_cache()
+        cache[cache_key] = entry
+        tmp_path = f"{ENGINE_CACHE_PATH}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(cache, f)
+            os.replace(tmp_path, ENGINE_CACHE_PATH)
+        except OSError as e:
+            logger.warning(f"Could not write engine cache {ENGINE_CACHE_PATH}: {e}")
+            safe_remove(tmp_path)
+
+def _probe_engine(binary_path, version_cmd, is_valid_output, timeout):
+    # Trả về (ok, output). Chỉ cache kết quả khi probe chạy xong (timeout/exception không được cache)
+    try: cache_key = _engine_cache_key(binary_path)
+    except OSError as e: logger.warning(f"Cannot stat engine binary {binary_path}: {e}"); return False, ''
+    with _engine_cache_lock: cached = _load_engine_cache().get(cache_key)
+    if cached is not None:
+        logger.info(f"Engine probe cache hit for {binary_path} (ok={cached.get('ok')})")
+        return bool(cached.get('ok')), cached.get('output', '')
+    result = subprocess.run(version_cmd, capture_output=True, text=True, check=False, timeout=timeout)
+    output = result.stdout.strip()
+    ok = result.returncode == 0 and is_valid_output(output)
+    if not ok: logger.warning(f"Version check failed for {binary_path}! Code: {result.returncode}, Output: {output}")
+    _store_engine_cache_entry(cache_key, {'ok': ok, 'output': output, 'checked_at': time.time()})
+    return ok, output
+
+def _discover_soffice():
+    soffice_path = None
+    if sys.platform == 'win32':
+        common_paths = [
+            r'C:\Program Files\LibreOffice\program\soffice.exe',
+            r'C:\Program Files (x86)\LibreOffice\program\soffice.exe'
+        ]
+        for path_to_check in common_paths:
+            if os.path.isfile(path_to_check):
+                logger.info(f"Found LO path by checking known Windows location (assuming valid): {path_to_check}")
+                soffice_path = path_to_check
+                break
 
+        if not soffice_path:
+            logger.info("Could not find LO in known Windows locations, trying shutil.which('soffice.exe')...")
+            soffice_found_which = shutil.which('soffice.exe')
+            if soffice_found_which:
+                 soffice_path = soffice_found_which
+                 logger.info(f"Found LO via shutil.which on Windows. Assuming valid and setting path: {soffice_path}")
+            else:
+                 logger.warning("shutil.which('soffice.exe') did not find an executable on Windows.")
 
-    if not SOFFICE_PATH:
-        logger.info("Could not find LO in known Windows locations, trying shutil.which('soffice.exe')...")
-        soffice_found_which = shutil.which('soffice.exe')
+    else: # Logic cho các hệ điều hành khác
+        logger.info("Not Windows, trying shutil.which('libreoffice')...")
+        soffice_found_which = shutil.which('libreoffice')
         if soffice_found_which:
-             SOFFICE_PATH = soffice_found_which
-             logger.info(f"Found LO via shutil.which on Windows. Assuming valid and setting path: {SOFFICE_PATH}")
+            try:
+                version_cmd = [soffice_found_which, '--headless', '--version'] # Dùng --headless ở đây
+                ok, _ = _probe_engine(soffice_found_which, version_cmd, lambda out: 'LibreOffice' in out, LO_VERSION_TIMEOUT)
+                if ok:
+                    logger.info(f"Using LO path found via shutil.which (non-Windows): {soffice_found_which}")
+                    soffice_path = soffice_found_which
+            except Exception as e:
+                logger.warning(f"Error verifying LO path via which (non-Windows) {soffice_found_which}: {e}")
         else:
-             logger.warning("shutil.which('soffice.exe') did not find an executable on Windows.")
-
-# Logic cho các hệ điều hành khác
-elif not SOFFICE_PATH: #chỉ chạy phần này nếu không phải Windows
-    logger.info("Not Windows or LO not found yet, trying shutil.which('libreoffice')...")
-    soffice_found_which = shutil.which('libreoffice')
-    if soffice_found_which:
-        try:
-            version_cmd = [soffice_found_which, '--headless', '--version'] # Dùng --headless ở đây
-            result = subprocess.run(version_cmd, capture_output=True, text=True, check=False, timeout=15)
-            if result.returncode == 0 and 'LibreOffice' in result.stdout:
-                logger.info(f"Using LO path found via shutil.which (non-Windows): {soffice_found_which}")
-                SOFFICE_PATH = soffice_found_which
+            logger.warning("shutil.which('libreoffice') did not find an executable (non-Windows).")
+
+    if soffice_path: logger.info(f"Successfully set LO path for use: {soffice_path}")
+    else: logger.critical("LibreOffice could NOT be set/verified using any method. Conversions requiring it WILL FAIL.")
+    return soffice_path
+
+def _discover_gs():
+    potential_gs_paths = []
+    gs_executable_names = []
+    if sys.platform == 'win32':
+        gs_base_dir_pf = r'C:\Program Files\gs'
+        gs_base_dir_pf86 = r'C:\Program Files (x86)\gs'
+        possible_gs_dirs = [d for d in glob.glob(os.path.join(gs_base_dir_pf, 'gs*')) if os.path.isdir(d)]
+        possible_gs_dirs.extend([d for d in glob.glob(os.path.join(gs_base_dir_pf86, 'gs*')) if os.path.isdir(d)])
+
+        if not possible_gs_dirs:
+            logger.warning(f"Could not find Ghostscript version directory in {gs_base_dir_pf} or {gs_base_dir_pf86}")
+        else:
+            possible_gs_dirs.sort(reverse=True)
+            latest_gs_dir = possible_gs_dirs[0]
+            bin_path = os.path.join(latest_gs_dir, 'bin')
+            if os.path.isdir(bin_path):
+                potential_gs_paths.append(os.path.join(bin_path, 'gswin64c.exe'))
+                potential_gs_paths.append(os.path.join(bin_path, 'gswin32c.exe'))
+                potential_gs_paths.append(os.path.join(bin_path, 'gs.exe'))
+                gs_executable_names.extend(['gswin64c.exe', 'gswin32c.exe', 'gs.exe', 'gs'])
+                logger.info(f"Checking for Ghostscript in potential directory: {bin_path}")
             else:
-                logger.warning(f"Found LO path {soffice_found_which} via which (non-Windows), but version check failed! Code: {result.returncode}, Output: {result.stdout.strip()}")
-        except Exception as e:
-            logger.warning(f"Error verifying LO path via which (non-Windows) {soffice_found_which}: {e}")
-    else:
-        logger.warning("shutil.which('libreoffice') did not find an executable (non-Windows).")
-
-
-# Log kết quả cuối cùng
-if SOFFICE_PATH:
-    logger.info(f"Successfully set LO path for use: {SOFFICE_PATH}")
-else:
-    logger.critical("LibreOffice could NOT be set/verified using any method. Conversions requiring it WILL FAIL.")
-
-
-GS_PATH = None
-potential_gs_paths = []
-gs_executable_names = []
+                logger.warning(f"Ghostscript bin directory not found in {latest_gs_dir}")
+    if not gs_executable_names:
+        gs_executable_names.append('gs')
 
+    def _verify(candidate):
+        ok, version = _probe_engine(candidate, [candidate, '--version'], lambda out: '.' in out, GS_VERSION_TIMEOUT)
+        return version if ok else None
 
-if sys.platform == 'win32':
-    gs_base_dir_pf = r'C:\Program Files\gs'
-    gs_base_dir_pf86 = r'C:\Program Files (x86)\gs'
-    gs_version_dir_pattern_pf = os.path.join(gs_base_dir_pf, 'gs*')
-    gs_version_dir_pattern_pf86 = os.path.join(gs_base_dir_pf86, 'gs*')
+    for path_to_check in potential_gs_paths:
+        if os.path.isfile(path_to_check):
+            try:
+                version = _verify(path_to_check)
+                if version:
+                    logger.info(f"Verified GS path by checking known location: {path_to_check} (Version: {version})")
+                    logger.info(f"Successfully set GS path for use: {path_to_check}")
+                    return path_to_check
+            except Exception as e:
+                logger.warning(f"Error verifying known GS path {path_to_check}: {e}")
+
+    logger.info(f"Could not verify GS in known locations, trying shutil.which with {gs_executable_names}...")
+    for gs_name in gs_executable_names:
+        gs_found_which = shutil.which(gs_name)
+        if gs_found_which:
+            try:
+                version = _verify(gs_found_which)
+                if version:
+                    logger.info(f"Using GS path found via shutil.which('{gs_name}'): {gs_found_which} (Version: {version})")
+                    logger.info(f"Successfully set GS path for use: {gs_found_which}")
+                    return gs_found_which
+            except Exception as e:
+                logger.warning(f"Error verifying GS path via which('{gs_name}') {gs_found_which}: {e}")
+    logger.warning(f"shutil.which failed for all potential names: {gs_executable_names}")
+    logger.critical("Ghostscript could NOT be found or verified. PDF Compression WILL FAIL.")
+    return None
 
-    possible_gs_dirs = [d for d in glob.glob(gs_version_dir_pattern_pf) if os.path.isdir(d)]
-    possible_gs_dirs.extend([d for d in glob.glob(gs_version_dir_pattern_pf86) if os.path.isdir(d)])
+def _get_engine_path(engine_name, discover):
+    if engine_name in _engine_paths: return _engine_paths[engine_name]
+    with _engine_locks[engine_name]:
+        if engine_name not in _engine_paths:
+            _engine_paths[engine_name] = discover()
+    return _engine_paths[engine_name]
 
-    if not possible_gs_dirs:
-        logger.warning(f"Could not find Ghostscript version directory in {gs_base_dir_pf} or {gs_base_dir_pf86}")
-    else:
-        possible_gs_dirs.sort(reverse=True)
-        latest_gs_dir = possible_gs_dirs[0]
-        bin_path = os.path.join(latest_gs_dir, 'bin')
-        if os.path.isdir(bin_path):
-            potential_gs_paths.append(os.path.join(bin_path, 'gswin64c.exe'))
-            potential_gs_paths.append(os.path.join(bin_path, 'gswin32c.exe'))
-            potential_gs_paths.append(os.path.join(bin_path, 'gs.exe'))
-            gs_executable_names.extend(['gswin64c.exe', 'gswin32c.exe', 'gs.exe', 'gs'])
-            logger.info(f"Checking for Ghostscript in potential directory: {bin_path}")
-        else:
-            logger.warning(f"Ghostscript bin directory not found in {latest_gs_dir}")
-if not gs_executable_names:
-    gs_executable_names.append('gs')
+def get_soffice_path(): return _get_engine_path('soffice', _discover_soffice)
+def get_gs_path(): return _get_engine_path('gs', _discover_gs)
 
-for path_to_check in potential_gs_paths:
-    if os.path.isfile(path_to_check):
-        logger.info(f"Found potential GS path by checking known location: {path_to_check}")
+def _warm_up_engines():
+    try:
+        get_soffice_path(); get_gs_path()
+        for module in HEAVY_MODULES: module.load()
+        if CPU_ENGINE_PROCESSES > 0: _get_cpu_pool() # Pre-fork engine worker trước request đầu tiên
+        logger.info(f"Engine warm-up finished in {time.time() - _warmup_state['started_at']:.2f}s")
+    except Exception as e:
+        _warmup_state['error'] = str(e)
+        logger.error(f"Engine warm-up failed: {e}", exc_info=True)
+    finally:
+        _warmup_state['finished_at'] = time.time()
+        _warmup_state['done'].set()
+
+def start_engine_warmup():
+    with _warmup_lock:
+        if _warmup_state['started']: return
+        _warmup_state['started'] = True; _warmup_state['started_at'] = time.time()
+    threading.Thread(target=_warm_up_engines, name='engine-warmup', daemon=True).start()
+
+
+#Theo dõi job đang chạy theo engine (dùng cho /readyz)
+MAX_CONCURRENT_JOBS = int(os.environ.get('MAX_CONCURRENT_JOBS', 4)) # Số job chạy engine cùng lúc (slot của scheduler)
+WAITRESS_THREADS = int(os.environ.get('WAITRESS_THREADS', 8)) # > MAX_CONCURRENT_JOBS: request chờ slot không chiếm hết thread của file nhỏ
+MIN_FREE_DISK_BYTES = int(os.environ.get('MIN_FREE_DISK_BYTES', 500 * 1024 * 1024))
+PROCESS_STARTED_AT = time.time()
+_job_stats_lock = threading.Lock()
+_jobs_in_flight = {} # engine -> số job đang chạy
+_last_engine_success = {} # engine -> {'latency': giây, 'at': timestamp}
+
+class EngineJob:
+    # Context manager đếm job in-flight theo engine; gọi succeeded() để ghi latency của lần thành công gần nhất
+    def __init__(self, engine_name): self.engine_name = engine_name; self.started_at = None
+    def __enter__(self):
+        with _job_stats_lock: _jobs_in_flight[self.engine_name] = _jobs_in_flight.get(self.engine_name, 0) + 1
+        self.started_at = time.time()
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        with _job_stats_lock: _jobs_in_flight[self.engine_name] = max(0, _jobs_in_flight.get(self.engine_name, 1) - 1)
+        return False
+    def succeeded(self):
+        with _job_stats_lock: _last_engine_success[self.engine_name] = {'latency': round(time.time() - self.started_at, 3), 'at': time.time()}
+
+def tracked_engine(engine_name):
+    # Decorator cho các hàm convert trả về True khi thành công
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with EngineJob(engine_name) as job:
+                result = func(*args, **kwargs)
+                if result: job.succeeded()
+                return result
+        return wrapper
+    return decorator
+
+#Single-flight: nhiều request cùng lúc convert đúng cùng nội dung + tham số (file chia sẻ cả lớp, tài liệu viral)
+#thì chỉ request đầu chạy engine, các request sau chờ và nhận bản copy kết quả (hoặc cùng lỗi).
+SINGLE_FLIGHT_FOLDER = os.path.join(UPLOAD_FOLDER, 'flights')
+SINGLE_FLIGHT_MAX_WAITERS = int(os.environ.get('SINGLE_FLIGHT_MAX_WAITERS', 32)) # Quá số này thì request tự chạy engine
+_flights = {} # key -> _Flight đang chạy
+_flights_lock = threading.Lock()
+_flight_stats = {'leaders': 0, 'shared': 0, 'overflow': 0}
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event(); self.waiters = 0; self.pending = 0; self.result = None; self.error = None; self.shared_path = None
+
+def _finish_flight_waiter(flight):
+    with _flights_lock:
+        flight.pending -= 1; last = flight.pending == 0 and flight.done.is_set()
+    if last and flight.shared_path: safe_remove(flight.shared_path)
+
+def known_input_hash(path):
+    # sha256 route đã tính cho input của chính request (remember_result_inputs) -> single_flight khỏi băm lại
+    hashes = g.get('input_hashes') if has_request_context() else None
+    return hashes.get(path) if hashes else None
+
+def single_flight(func):
+    # Cho các hàm engine dạng func(input_path, output_path, ...): key = tên hàm + sha256 input + các tham số còn lại.
+    # flight_hash=...: caller tự đưa định danh nội dung của input (vd. file mẫu cắt từ input đã biết hash), không truyền xuống func
+    @functools.wraps(func)
+    def wrapper(input_path, output_path, *args, flight_hash=None, **kwargs):
+        content_hash = kwargs.get('content_hash') or flight_hash or known_input_hash(input_path) or file_sha256(input_path)
+        if 'content_hash' in kwargs: kwargs['content_hash'] = content_hash # Hàm nhận hash thì khỏi hash lại
+        key = (func.__name__, content_hash, repr(args), repr(sorted((name, value) for name, value in kwargs.items() if name != 'content_hash')))
+        with _flights_lock:
+            flight = _flights.get(key)
+            if flight is None: flight = _flights[key] = _Flight(); is_leader = True; _flight_stats['leaders'] += 1
+            elif flight.waiters >= SINGLE_FLIGHT_MAX_WAITERS: flight = None; is_leader = False; _flight_stats['overflow'] += 1
+            else: flight.waiters += 1; flight.pending += 1; is_leader = False; _flight_stats['shared'] += 1
+        if flight is None: return func(input_path, output_path, *args, **kwargs)
+        if is_leader:
+            try:
+                flight.result = func(input_path, output_path, *args, **kwargs); return flight.result
+            except Exception as flight_err: flight.error = flight_err; raise
+            finally:
+                with _flights_lock:
+                    _flights.pop(key, None); has_waiters = flight.pending > 0
+                if has_waiters and flight.error is None and os.path.exists(output_path):
+                    try:
+                        os.makedirs(SINGLE_FLIGHT_FOLDER, exist_ok=True)
+                        flight.shared_path = os.path.join(SINGLE_FLIGHT_FOLDER, f"{secrets.token_hex(8)}_{os.path.basename(output_path)}")
+                        shutil.copyfile(output_path, flight.shared_path)
+                    except OSError as share_err: logger.error(f"Cannot share {func.__name__} result: {share_err}"); flight.error = RuntimeError("err-conversion")
+                flight.done.set()
+                with _flights_lock: orphaned = flight.pending == 0 # Mọi waiter đã bỏ cuộc (timeout) trước khi có kết quả
+                if orphaned and flight.shared_path: safe_remove(flight.shared_path)
+        # Waiter: trả slot của scheduler trong lúc chờ, không tính thời gian chờ vào cost model
+        job = g.get('cost_job') if has_request_context() else None
+        if job: job.shared = True; job.release()
+        logger.info(f"{func.__name__}: identical job already running, waiting for its result")
         try:
-            result = subprocess.run([path_to_check, '--version'], capture_output=True, text=True, check=False, timeout=10)
-            if result.returncode == 0 and '.' in result.stdout.strip():
-                logger.info(f"Verified GS path by checking known location: {path_to_check} (Version: {result.stdout.strip()})")
-                GS_PATH = path_to_check
-                break
-            else:
-                logger.warning(f"Known GS path {path_to_check} exists, but version check failed! Code: {result.returncode}, Output: {result.stdout.strip()}")
-        except Exception as e:
-            logger.warning(f"Error verifying known GS path {path_to_check}: {e}")
-    if GS_PATH: break
-
-if not GS_PATH:
-     logger.info(f"Could not verify GS in known locations, trying shutil.which with {gs_executable_names}...")
-     for gs_name in gs_executable_names:
-         gs_found_which = shutil.which(gs_name)
-         if gs_found_which:
-             try:
-                 result = subprocess.run([gs_found_which, '--version'], capture_output=True, text=True, check=False, timeout=10)
-                 if result.returncode == 0 and '.' in result.stdout.strip():
-                     logger.info(f"Using GS path found via shutil.which('{gs_name}'): {gs_found_which} (Version: {result.stdout.strip()})")
-                     GS_PATH = gs_found_which
-                     break
-                 else:
-                      logger.warning(f"Found GS path {gs_found_which} via which('{gs_name}'), but version check failed! Code: {result.returncode}, Output: {result.stdout.strip()}")
-             except Exception as e:
-                  logger.warning(f"Error verifying GS path via which('{gs_name}') {gs_found_which}: {e}")
-     if not GS_PATH: logger.warning(f"shutil.which failed for all potential names: {gs_executable_names}")
-
-
-# Log kết quả cuối cùng
-if not GS_PATH:
-    logger.critical("Ghostscript could NOT be found or verified. PDF Compression WILL FAIL.")
-else:
-    logger.info(f"Successfully set GS path for use: {GS_PATH}")
+            if not flight.done.wait(job_timeout(LIBREOFFICE_TIMEOUT)): raise RuntimeError("err-conversion-timeout")
+            if flight.error is not None: # Cùng error key cho mọi waiter; lỗi thư viện (constructor lạ) -> err-conversion
+                error_key = str(flight.error) if str(flight.error).startswith("err-") else "err-conversion"
+                raise (ValueError if isinstance(flight.error, ValueError) else RuntimeError)(error_key) from flight.error
+            shutil.copyfile(flight.shared_path, output_path)
+            return flight.result
+        finally: _finish_flight_waiter(flight)
+    return wrapper
+
+#Engine Python nặng CPU (pdf2docx, python-pptx, Pillow) giữ GIL gần như suốt quá trình -> các request khác trong cùng process bị chậm,
+#và bitmap lớn/layout object của pdf2docx làm phân mảnh heap nên RSS của web process chỉ tăng chứ không giảm.
+#CPU_ENGINE_PROCESSES > 0 thì các hàm @offload_cpu chạy trong pool process con dựng sẵn, fork từ fork server đã import sẵn app + thư viện nặng
+#(không fork từ server nhiều thread). Mỗi process con chạy 1 task một lúc, bị thay mới sau CPU_ENGINE_MAX_TASKS task hoặc khi RSS vượt trần.
+#Kết quả là file output trong workspace của job; qua pipe chỉ có tên hàm + tham số (đường dẫn) và giá trị trả về nhỏ.
+CPU_ENGINE_PROCESSES = int(os.environ.get('CPU_ENGINE_PROCESSES', min(MAX_CONCURRENT_JOBS, os.cpu_count() or 1) if os.name == 'posix' else 0))
+CPU_ENGINE_START_METHOD = os.environ.get('CPU_ENGINE_START_METHOD', 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+CPU_ENGINE_MAX_TASKS = int(os.environ.get('CPU_ENGINE_MAX_TASKS', 50)) # 0 = không giới hạn
+CPU_ENGINE_MAX_RSS_MB = int(os.environ.get('CPU_ENGINE_MAX_RSS_MB', 1024)) # 0 = không giới hạn
+CPU_ENGINE_TASK_TIMEOUT = 900 # Ngoài request (CLI); trong request dùng thời gian còn lại của job
+_offloadable = {} # tên hàm -> hàm gốc (chưa bọc), tra lại trong process con
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+_in_engine_process = False
+_engine_task_deadline = None # Trong process con: deadline của task đang chạy (thay cho g.cost_job)
+
+def _process_rss():
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0 # Đỉnh RSS, KB trên Linux
+
+def _engine_process_init():
+    global _in_engine_process, _log_listener
+    _in_engine_process = True
+    if not (_log_listener._thread and _log_listener._thread.is_alive()): _log_listener = _setup_logging() # Fork từ fork server: thread ghi log không đi theo
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C chỉ dừng server, server dừng process con
+
+def _engine_worker_main(conn):
+    global _engine_task_deadline
+    _engine_process_init()
+    while True:
+        try: task = conn.recv()
+        except (EOFError, OSError): return # Server đã đóng pipe
+        if task is None: return
+        name, args, kwargs, timeout = task
+        _engine_task_deadline = time.time() + timeout
+        try: reply = (True, _offloadable[name](*args, **kwargs))
+        except Exception as e: reply = (False, e)
+        try: conn.send(reply + (_process_rss(),))
+        except Exception as send_err: # Kết quả/exception không pickle được
+            logger.error(f"{name}: cannot send result to server: {send_err}")
+            conn.send((False, RuntimeError("err-conversion"), _process_rss()))
+
+class EngineWorkerPool:
+    def __init__(self, size, start_method):
+        self.context = multiprocessing.get_context(start_method); self.start_method = start_method
+        if start_method == 'forkserver':
+            preload = ([__name__] if __name__ != '__main__' else []) + [module._name for module in HEAVY_MODULES]
+            self.context.set_forkserver_preload(preload) # Import 1 lần trong fork server, process con fork ra đã có sẵn
+        self.idle = queue.Queue(); self.size = size; self.closed = False
+        self.stats = {'tasks': 0, 'started': 0, 'recycled_tasks': 0, 'recycled_rss': 0, 'crashed': 0, 'timed_out': 0}
+        for _ in range(size): self.idle.put(self._start_worker())
+
+    def _start_worker(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_engine_worker_main, args=(child_conn,), name='engine-worker', daemon=True)
+        process.start(); child_conn.close()
+        self.stats['started'] += 1
+        return {'process': process, 'conn': parent_conn, 'tasks': 0, 'rss': 0}
+
+    def _replace(self, worker, graceful):
+        # Dừng process cũ và dựng process mới ở thread nền, request hiện tại trả kết quả ngay
+        def replace():
+            try:
+                if graceful: worker['conn'].send(None); worker['process'].join(5)
+                if worker['process'].is_alive(): worker['process'].kill(); worker['process'].join(5)
+            except OSError: pass
+            finally: worker['conn'].close()
+            if not self.closed: self.idle.put(self._start_worker())
+        threading.Thread(target=replace, name='engine-worker-recycle', daemon=True).start()
+
+    def run(self, name, args, kwargs, timeout):
+        deadline = time.time() + timeout
+        try:
+            worker = self.idle.get(timeout=timeout)
+            while not worker['process'].is_alive(): # Chết lúc đang rảnh: thay process, lấy worker khác thay vì làm hỏng request
+                self.stats['crashed'] += 1; logger.warning(f"Idle engine worker {worker['process'].pid} died (exit code {worker['process'].exitcode})")
+                self._replace(worker, graceful=False); worker = self.idle.get(timeout=max(0.1, deadline - time.time()))
+        except queue.Empty: raise RuntimeError("err-conversion-timeout")
+        try:
+            worker['conn'].send((name, args, kwargs, max(5, deadline - time.time())))
+            if not worker['conn'].poll(max(5, deadline - time.time())):
+                self.stats['timed_out'] += 1; logger.error(f"{name}: engine worker {worker['process'].pid} timed out, killing it")
+                self._replace(worker, graceful=False); worker = None
+                raise RuntimeError("err-conversion-timeout")
+            ok, result, worker['rss'] = worker['conn'].recv()
+        except (EOFError, OSError) as worker_err: # Process con chết giữa chừng (OOM killer, segfault trong thư viện C)
+            self.stats['crashed'] += 1
+            logger.error(f"{name}: engine worker {worker['process'].pid} died (exit code {worker['process'].exitcode}): {worker_err}")
+            self._replace(worker, graceful=False); worker = None
+            raise RuntimeError("err-conversion") from worker_err
+        finally:
+            if worker is not None: self._release(worker)
+        if not ok: raise result # err-* ValueError/RuntimeError được pickle về nguyên vẹn
+        return result
+
+    def _release(self, worker):
+        worker['tasks'] += 1; self.stats['tasks'] += 1
+        if CPU_ENGINE_MAX_RSS_MB > 0 and worker['rss'] > CPU_ENGINE_MAX_RSS_MB * 1024 * 1024:
+            self.stats['recycled_rss'] += 1; logger.info(f"Recycling engine worker {worker['process'].pid}: RSS {worker['rss'] / 1048576:.0f}MB > {CPU_ENGINE_MAX_RSS_MB}MB")
+            self._replace(worker, graceful=True)
+        elif CPU_ENGINE_MAX_TASKS > 0 and worker['tasks'] >= CPU_ENGINE_MAX_TASKS:
+            self.stats['recycled_tasks'] += 1; self._replace(worker, graceful=True)
+        else: self.idle.put(worker)
+
+    def close(self):
+        self.closed = True
+        while True:
+            try: worker = self.idle.get_nowait()
+            except queue.Empty: return
+            try: worker['conn'].send(None)
+            except OSError: pass
+
+def _get_cpu_pool():
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            os.environ['ENGINE_WARMUP'] = 'False' # Fork server/process con import lại app.py, không cần warm-up
+            started = time.time()
+            _cpu_pool = EngineWorkerPool(CPU_ENGINE_PROCESSES, CPU_ENGINE_START_METHOD)
+            atexit.register(_cpu_pool.close)
+            logger.info(f"Engine worker pool: {CPU_ENGINE_PROCESSES} processes ({CPU_ENGINE_START_METHOD}) started in {time.time() - started:.2f}s")
+        return _cpu_pool
+
+def offload_cpu(func):
+    _offloadable[func.__name__] = func
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if CPU_ENGINE_PROCESSES <= 0 or _in_engine_process: return func(*args, **kwargs)
+        return _get_cpu_pool().run(func.__name__, args, kwargs, job_timeout(CPU_ENGINE_TASK_TIMEOUT))
+    return wrapper
+
+def get_engine_pool_stats():
+    if _cpu_pool is None: return {'processes': CPU_ENGINE_PROCESSES, 'started': False}
+    return dict(_cpu_pool.stats, processes=CPU_ENGINE_PROCESSES, start_method=_cpu_pool.start_method, idle=_cpu_pool.idle.qsize(),
+                max_tasks=CPU_ENGINE_MAX_TASKS, max_rss_mb=CPU_ENGINE_MAX_RSS_MB)
+
+def get_single_flight_stats():
+    with _flights_lock: return dict(_flight_stats, in_flight=len(_flights))
+
+def get_job_stats():
+    with _job_stats_lock:
+        return dict(_jobs_in_flight), {k: dict(v) for k, v in _last_engine_success.items()}
+
+_last_engine_usage = {} # engine -> rusage của lần chạy subprocess gần nhất
+
+class _RingBuffer:
+    # Giữ tối đa `limit` byte cuối của 1 pipe, đọc bởi thread riêng để engine không bị block khi pipe đầy
+    def __init__(self, pipe, limit):
+        self.data = bytearray(); self.limit = limit; self.total = 0
+        self.thread = threading.Thread(target=self._pump, args=(pipe,), daemon=True); self.thread.start()
+    def _pump(self, pipe):
+        with pipe:
+            for chunk in iter(lambda: pipe.read1(65536), b''):
+                self.data += chunk; self.total += len(chunk)
+                if len(self.data) > self.limit: del self.data[:-self.limit]
+    def text(self):
+        self.thread.join(1)
+        return bytes(self.data).decode('utf-8', errors='ignore')
+
+def _limit_engine_process(pid, timeout):
+    # Đặt rlimit/nice ngay sau khi spawn bằng prlimit (preexec_fn không an toàn khi server chạy nhiều thread).
+    # Các tiến trình con (soffice.bin) fork sau đó kế thừa giới hạn.
+    try:
+        if ENGINE_NICE: os.setpriority(os.PRIO_PROCESS, pid, ENGINE_NICE)
+        if resource is None or not hasattr(resource, 'prlimit'): return
+        if ENGINE_MEMORY_LIMIT_MB > 0:
+            memory_limit = ENGINE_MEMORY_LIMIT_MB * 1024 * 1024; resource.prlimit(pid, resource.RLIMIT_AS, (memory_limit, memory_limit))
+        cpu_limit = ENGINE_CPU_LIMIT_SECONDS or int(timeout * 2)
+        if cpu_limit > 0: resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+    except (OSError, ValueError) as limit_err: logger.warning(f"Could not apply engine limits to pid {pid}: {limit_err}")
+
+def _kill_process_group(proc):
+    # Kill cả group để soffice.bin/gs con không sống sót sau timeout
+    if sys.platform == 'win32': proc.kill(); return
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try: os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError): return
+        if sig == signal.SIGTERM:
+            deadline = time.time() + ENGINE_KILL_GRACE
+            while time.time() < deadline and proc.poll() is None: time.sleep(0.1)
+
+def run_engine(cmd, timeout, engine_name, check=True, limits=True):
+    # Chạy engine ngoài trong process group riêng, có rlimit/nice, kill-tree khi timeout, stdout/stderr giữ trong ring buffer.
+    # Trả về CompletedProcess (stdout/stderr là text); lỗi raise TimeoutExpired/CalledProcessError như subprocess.run
+    started = time.time()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=(sys.platform != 'win32'))
+    if limits and sys.platform != 'win32': _limit_engine_process(proc.pid, timeout)
+    stdout_buf = _RingBuffer(proc.stdout, ENGINE_OUTPUT_BUFFER); stderr_buf = _RingBuffer(proc.stderr, ENGINE_OUTPUT_BUFFER)
+    usage = None
+    try:
+        if hasattr(os, 'wait4'):
+            # wait4 thay cho Popen.wait để lấy rusage của tiến trình con
+            deadline = started + timeout
+            while True:
+                pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                if pid: proc.returncode = os.waitstatus_to_exitcode(status); break
+                if time.time() >= deadline: raise subprocess.TimeoutExpired(cmd, timeout)
+                time.sleep(0.05)
+        else: proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_group(proc); proc.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout, output=stdout_buf.text(), stderr=stderr_buf.text())
+    finally:
+        if proc.returncode is not None and sys.platform != 'win32':
+            try: os.killpg(proc.pid, signal.SIGKILL) # Dọn tiến trình con còn sót trong group
+            except (ProcessLookupError, PermissionError): pass
+    stdout, stderr = stdout_buf.text(), stderr_buf.text()
+    run_usage = {'wall': round(time.time() - started, 3), 'returncode': proc.returncode}
+    if usage: run_usage.update({'cpu_user': round(usage.ru_utime, 3), 'cpu_system': round(usage.ru_stime, 3), 'max_rss_mb': round(usage.ru_maxrss / 1024, 1)})
+    with _job_stats_lock: _last_engine_usage[engine_name] = run_usage
+    if run_usage.get('max_rss_mb'): logger.info(f"{engine_name} finished in {run_usage['wall']}s (rc={proc.returncode}, cpu {run_usage['cpu_user'] + run_usage['cpu_system']:.2f}s, max RSS {run_usage['max_rss_mb']} MB)")
+    if check and proc.returncode != 0: raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+#Cost model: dự đoán thời gian xử lý (giây) từ đặc trưng rẻ của input (số trang, dung lượng, số ảnh) theo loại job.
+#Hệ số prior là ước lượng thô; mỗi loại job có hệ số hiệu chỉnh EWMA(observed/predicted) học dần từ thời gian thực tế.
+#Dự đoán quyết định: timeout của engine, thứ tự chờ slot (job nhỏ đi trước) và việc từ chối khi hàng đợi quá dài.
+COST_PRIORS = { # kind -> (giây cố định, giây/trang, giây/MB, giây/ảnh)
+    'pdf_to_docx': (2.0, 0.6, 0.5, 0.05), 'office_to_pdf': (3.0, 0.15, 0.3, 0.02), 'pdf_to_ppt': (2.0, 0.5, 0.2, 0.0), 'pdf_to_ppt_libreoffice': (5.0, 0.4, 0.3, 0.05),
+    'pdf_to_docx_text': (0.5, 0.03, 0.1, 0.01), 'compress_pdf_images': (0.5, 0.02, 0.15, 0.03),
+    'pdf_to_image': (1.0, 0.4, 0.1, 0.0), 'image_to_pdf': (0.5, 0.0, 0.2, 0.1), 'compress_pdf': (1.0, 0.1, 0.4, 0.05), 'compress_docx': (5.0, 0.8, 0.8, 0.07),
+}
+COST_EWMA_ALPHA = 0.2
+JOB_TIMEOUT_FACTOR = float(os.environ.get('JOB_TIMEOUT_FACTOR', 4)) # timeout = dự đoán x factor + slack
+JOB_TIMEOUT_SLACK = 30
+JOB_TIMEOUT_RANGE = (int(os.environ.get('JOB_TIMEOUT_MIN', 30)), int(os.environ.get('JOB_TIMEOUT_MAX', 1800)))
+ADMISSION_MAX_WAIT = int(os.environ.get('ADMISSION_MAX_WAIT', 120)) # Giây chờ dự kiến tối đa trước khi trả err-server-busy
+SJF_AGING = 1.0 # Thứ tự chờ = thời điểm đến + SJF_AGING x dự đoán: job nhỏ chen lên nhưng job lớn không bị đói mãi
+#Lane theo kích thước input: small nếu <= cả 2 ngưỡng small, large nếu vượt 1 trong 2 ngưỡng large
+JOB_LANES = ('small', 'medium', 'large')
+SMALL_JOB_LIMITS = (int(os.environ.get('SMALL_JOB_MAX_BYTES', 2 * 1024 * 1024)), int(os.environ.get('SMALL_JOB_MAX_PAGES', 10)))
+LARGE_JOB_LIMITS = (int(os.environ.get('LARGE_JOB_MIN_BYTES', 20 * 1024 * 1024)), int(os.environ.get('LARGE_JOB_MIN_PAGES', 100)))
+RESERVED_SMALL_SLOTS = int(os.environ.get('RESERVED_SMALL_SLOTS', 1))
+#Job medium/large đang chờ slot giữ 1 thread server suốt lúc chờ: giới hạn số job chờ để luôn còn thread cho file nhỏ
+#(thread của job medium/large chạy + chờ <= WAITRESS_THREADS - RESERVED_SMALL_SLOTS). asgi.py đặt lại theo pool job của nó
+ADMISSION_MAX_WAITERS = int(os.environ.get('ADMISSION_MAX_WAITERS', max(0, WAITRESS_THREADS - MAX_CONCURRENT_JOBS)))
+LANE_WAIT_SAMPLES = 500 # Số lần chờ gần nhất mỗi lane dùng để tính p50/p95
+DOCX_BYTES_PER_PAGE = 25000 # word/document.xml (đã giải nén) trung bình mỗi trang
+_cost_corrections = {} # kind -> {'factor': EWMA observed/predicted, 'samples': n}
+_PDF_IMAGE_PATTERN = re.compile(rb'/Subtype\s*/Image')
+
+def inspect_input_features(paths):
+    # Chỉ đọc metadata rẻ: PDF -> số trang (PyPDF2) + đếm XObject ảnh; DOCX/PPTX -> danh sách zip; ảnh -> số file
+    features = {'pages': 0, 'bytes': 0, 'images': 0}
+    for path in ([paths] if isinstance(paths, str) else paths):
+        size = os.path.getsize(path); features['bytes'] += size
+        ext = path.rsplit('.', 1)[-1].lower()
+        if ext in ('jpg', 'jpeg', 'png', 'webp', 'tif', 'tiff'): features['images'] += 1; features['pages'] += 1; continue
+        try:
+            if ext == 'pdf':
+                features['pages'] += get_pdf_page_count(path)
+                with open(path, 'rb') as f:
+                    tail = b'' # 32 byte cuối chunk trước, để không bỏ sót match nằm vắt qua 2 chunk
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        data = tail + chunk
+                        features['images'] += sum(1 for match in _PDF_IMAGE_PATTERN.finditer(data) if match.end() > len(tail)); tail = data[-32:]
+            elif ext in ('docx', 'pptx'):
+                with zipfile.ZipFile(path) as archive:
+                    infos = archive.infolist()
+                    features['images'] += sum(1 for info in infos if '/media/' in info.filename)
+                    if ext == 'pptx': features['pages'] += sum(1 for info in infos if re.match(r'ppt/slides/slide\d+\.xml$', info.filename))
+                    else: features['pages'] += max(1, sum(info.file_size for info in infos if info.filename == 'word/document.xml') // DOCX_BYTES_PER_PAGE)
+            else: features['pages'] += max(1, size // (100 * 1024)) # .ppt nhị phân: ước lượng theo dung lượng
+        except Exception as inspect_err: # Lỗi đọc file để engine báo lỗi đúng; ở đây chỉ ước lượng theo dung lượng
+            logger.debug("Feature inspection failed for %s: %s", path, inspect_err); features['pages'] += max(1, size // (100 * 1024))
+    return features
+
+def predict_job_cost(kind, features, selected_pages=None, correction_key=None):
+    # correction_key: hệ số hiệu chỉnh học riêng (vd. theo converter) thay vì theo loại job
+    base, per_page, per_mb, per_image = COST_PRIORS.get(kind, COST_PRIORS['office_to_pdf'])
+    pages = features['pages']; fraction = min(1.0, selected_pages / pages) if selected_pages and pages else 1.0
+    estimate = base + fraction * (per_page * pages + per_mb * features['bytes'] / (1024 * 1024) + per_image * features['images'])
+    with _job_stats_lock: factor = _cost_corrections.get(correction_key or kind, {}).get('factor', 1.0)
+    return estimate * factor
+
+def observe_job_cost(kind, predicted, elapsed):
+    if predicted <= 0: return
+    ratio = min(20.0, max(0.05, elapsed / predicted))
+    with _job_stats_lock:
+        entry = _cost_corrections.setdefault(kind, {'factor': 1.0, 'samples': 0})
+        # predicted đã nhân factor cũ -> ratio là sai số còn lại, nhân dồn vào factor
+        entry['factor'] = min(50.0, max(0.02, entry['factor'] * (ratio ** COST_EWMA_ALPHA))); entry['samples'] += 1
+
+class CostScheduler:
+    # MAX_CONCURRENT_JOBS slot chia theo lane kích thước (small/medium/large). RESERVED_SMALL_SLOTS slot chỉ dành cho
+    # lane small để file nhỏ không phải chờ sau loạt PDF scan lớn. Khi hết slot job chờ theo thứ tự (đến + dự đoán)
+    # thay vì FIFO: job nhỏ chen lên trước, job lớn vẫn "già" dần nên không bị đói.
+    def __init__(self, slots, reserved_small=0, max_waiting=None):
+        self.slots = slots; self.reserved_small = min(reserved_small, max(0, slots - 1)); self.max_waiting = max_waiting # Job không phải small
+        self.running = {}; self.waiting = {lane: [] for lane in JOB_LANES}; self.lock = threading.Lock(); self.sequence = itertools.count()
+        self.wait_samples = {lane: collections.deque(maxlen=LANE_WAIT_SAMPLES) for lane in JOB_LANES}
+    def _can_start(self, lane):
+        if len(self.running) >= self.slots: return False
+        if lane == 'small': return True
+        return sum(1 for job in self.running.values() if job.lane != 'small') < self.slots - self.reserved_small
+    def _start(self, job):
+        self.running[id(job)] = job; self.wait_samples[job.lane].append(time.time() - job.queued_at); job.started_at = time.time()
+    def expected_wait(self, job):
+        # Ước lượng thời gian chờ để quyết định nhận job: lane small có slot riêng nên chỉ tính hàng đợi của chính nó
+        if job.lane == 'small':
+            with self.lock: return sum(entry[3].predicted for entry in self.waiting['small']) / self.slots
+        return self.queue_wait()
+    def queue_wait(self):
+        # Thời gian chờ dự kiến của 1 job medium/large mới (job đang chạy còn lại + toàn bộ hàng đợi)
+        return self.backlog() / max(1, self.slots - self.reserved_small)
+    def acquire(self, job, max_wait):
+        job.queued_at = time.time()
+        with self.lock:
+            if job.lane != 'small' and self.max_waiting is not None and not self._can_start(job.lane) \
+                    and sum(len(self.waiting[lane]) for lane in JOB_LANES if lane != 'small') >= self.max_waiting:
+                logger.warning(f"Rejecting {job.kind} job: {self.max_waiting} medium/large jobs already waiting for a slot"); return False
+            entry = [job.queued_at + SJF_AGING * job.predicted, next(self.sequence), threading.Event(), job]
+            heapq.heappush(self.waiting[job.lane], entry); self._dispatch()
+        if entry[2].wait(max_wait): return True
+        with self.lock:
+            if entry[2].is_set(): return True # Được cấp slot đúng lúc hết giờ chờ
+            self.waiting[job.lane].remove(entry); heapq.heapify(self.waiting[job.lane]); return False
+    def release(self, job):
+        with self.lock:
+            if self.running.pop(id(job), None) is not None: self._dispatch()
+    def _dispatch(self):
+        while True:
+            # Trong các lane còn được phép chạy, lấy job có key nhỏ nhất ở đầu hàng
+            heads = [queue_[0] for lane, queue_ in self.waiting.items() if queue_ and self._can_start(lane)]
+            if not heads: return
+            entry = heapq.heappop(self.waiting[min(heads)[3].lane]); self._start(entry[3]); entry[2].set()
+    def backlog(self):
+        now = time.time()
+        with self.lock:
+            running = sum(max(0.0, job.predicted - (now - job.started_at)) for job in self.running.values())
+            return running + sum(entry[3].predicted for lane in JOB_LANES for entry in self.waiting[lane])
+    def stats(self):
+        with self.lock:
+            lanes = {}
+            for lane in JOB_LANES:
+                waits = sorted(self.wait_samples[lane])
+                lanes[lane] = {'running': sum(1 for job in self.running.values() if job.lane == lane), 'waiting': len(self.waiting[lane]), 'samples': len(waits),
+                               'wait_p50': round(waits[len(waits) // 2], 3) if waits else None, 'wait_p95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else None}
+            return {'slots': self.slots, 'reserved_small': self.reserved_small, 'max_waiting': self.max_waiting, 'running': len(self.running), 'waiting': sum(len(queue_) for queue_ in self.waiting.values()), 'lanes': lanes}
+
+_job_scheduler = CostScheduler(MAX_CONCURRENT_JOBS, RESERVED_SMALL_SLOTS, ADMISSION_MAX_WAITERS)
+
+def classify_job_lane(features):
+    if features['bytes'] <= SMALL_JOB_LIMITS[0] and features['pages'] <= SMALL_JOB_LIMITS[1]: return 'small'
+    if features['bytes'] > LARGE_JOB_LIMITS[0] or features['pages'] > LARGE_JOB_LIMITS[1]: return 'large'
+    return 'medium'
+
+class CostedJob:
+    def __init__(self, kind, predicted, lane='medium'):
+        self.kind = kind; self.predicted = predicted; self.lane = lane; self.started_at = self.queued_at = time.time(); self.done = False; self.shared = False
+        self.timeout = min(JOB_TIMEOUT_RANGE[1], max(JOB_TIMEOUT_RANGE[0], predicted * JOB_TIMEOUT_FACTOR + JOB_TIMEOUT_SLACK))
+        self.deadline = None
+    def succeeded(self):
+        if not self.done and not self.shared: self.done = True; observe_job_cost(self.kind, self.predicted, time.time() - self.started_at)
+    def release(self): _job_scheduler.release(self)
+
+def admit_job(kind, input_paths, selected_pages=None):
+    # Gọi trong route sau khi lưu input: dự đoán chi phí, quyết định nhận job, chờ slot. Slot được trả ở teardown_request
+    features = inspect_input_features(input_paths)
+    job = CostedJob(kind, predict_job_cost(kind, features, len(selected_pages) if selected_pages else None), classify_job_lane(features))
+    expected_wait = _job_scheduler.expected_wait(job)
+    logger.info(f"Job {kind} ({job.lane}): features={features}, predicted {job.predicted:.1f}s, timeout {job.timeout:.0f}s, expected wait {expected_wait:.1f}s")
+    if expected_wait > ADMISSION_MAX_WAIT: logger.warning(f"Rejecting {kind} job: expected wait {expected_wait:.0f}s > {ADMISSION_MAX_WAIT}s"); raise RuntimeError("err-server-busy")
+    if not _job_scheduler.acquire(job, ADMISSION_MAX_WAIT): raise RuntimeError("err-server-busy")
+    job.deadline = job.started_at + job.timeout
+    if has_request_context(): g.cost_job = job
+    return job
+
+def job_timeout(default):
+    # Timeout còn lại của job hiện tại cho engine (LibreOffice/Ghostscript); ngoài job dùng hằng số mặc định
+    job = g.get('cost_job') if has_request_context() else None
+    if job and job.deadline: return max(5, job.deadline - time.time())
+    return max(5, _engine_task_deadline - time.time()) if _engine_task_deadline else default # Trong engine worker: deadline server gửi kèm task
+
+@app.teardown_request
+def release_job_slot(exception=None):
+    job = g.pop('cost_job', None)
+    if job: job.release()
+
+def get_cost_stats():
+    with _job_stats_lock: corrections = {kind: {'factor': round(entry['factor'], 3), 'samples': entry['samples']} for kind, entry in _cost_corrections.items()}
+    return dict(_job_scheduler.stats(), backlog_seconds=round(_job_scheduler.backlog(), 1), corrections=corrections)
 
 
 def _allowed_file_extension(filename, allowed_set):
@@ -238,7 +923,7 @@ def safe_remove(item_path, retries=3, delay=0.5):
         try:
             if is_dir: shutil.rmtree(item_path)
             else: os.remove(item_path)
-            logger.debug(f"Removed {item_type}: {item_path}"); return True
+            sweep_logger.debug("Removed %s: %s", item_type, item_path); return True
         except Exception as e: logger.warning(f"Error removing {item_path} (Attempt {i+1}): {e}"); time.sleep(delay*(i+1))
     logger.error(f"Failed to remove {item_type} after {retries} attempts: {item_path}"); return False
 
@@ -306,12 +991,65 @@ def get_pdf_page_size(pdf_path):
     except Exception as e: logger.error(f"Error reading PDF size {pdf_path}: {e}"); raise ValueError("err-unknown") # Lỗi không xác định khác
     return width, height
 
+def get_pdf_page_count(pdf_path):
+    try:
+        with open(pdf_path, 'rb') as f:
+            reader = PyPDF2.PdfReader(f, strict=False)
+            if reader.is_encrypted:
+                get_pdf_page_size(pdf_path) # Raise err-pdf-protected nếu mật khẩu rỗng không mở được
+                reader.decrypt('')
+            return len(reader.pages)
+    except PyPDF2.errors.PdfReadError as pdf_err: raise ValueError("err-pdf-corrupt") from pdf_err
+    except ValueError: raise
+    except Exception as e: logger.error(f"Error reading PDF page count {pdf_path}: {e}"); raise ValueError("err-pdf-corrupt") from e
+
+#Chọn trang: "1-5,8,10-" -> [1, 2, 3, 4, 5, 8, 10, ..., page_count]. Chuỗi rỗng hoặc chọn đủ mọi trang -> None (xử lý cả file)
+PAGE_RANGE_PATTERN = re.compile(r'^\s*(\d*)\s*(?:(-)\s*(\d*))?\s*$')
+MAX_PAGES_SPEC_LENGTH = 256
+
+def parse_page_ranges(spec, page_count):
+    if spec is None or not spec.strip(): return None
+    if len(spec) > MAX_PAGES_SPEC_LENGTH or not page_count: raise ValueError("err-invalid-pages")
+    pages = set()
+    for part in spec.split(','):
+        match = PAGE_RANGE_PATTERN.match(part)
+        if not match or not (match.group(1) or match.group(3)): raise ValueError("err-invalid-pages")
+        first = int(match.group(1)) if match.group(1) else 1
+        last = (int(match.group(3)) if match.group(3) else page_count) if match.group(2) else first
+        if first < 1 or first > last or last > page_count: raise ValueError("err-invalid-pages")
+        pages.update(range(first, last + 1))
+    return None if len(pages) == page_count else sorted(pages)
+
+def page_runs(pages):
+    # [1, 2, 3, 8, 10, 11] -> [(1, 3), (8, 8), (10, 11)]: mỗi đoạn liên tiếp là một lần gọi engine
+    runs = []
+    for page in pages:
+        if runs and page == runs[-1][1] + 1: runs[-1] = (runs[-1][0], page)
+        else: runs.append((page, page))
+    return runs
+
+def format_page_runs(pages): return ','.join(f"{first}-{last}" if first != last else str(first) for first, last in page_runs(pages))
+
+def extract_pdf_pages(input_path, output_path, pages):
+    # Cho engine không tự chọn trang được (LibreOffice): tách các trang cần thành PDF riêng
+    try:
+        with open(input_path, 'rb') as f:
+            reader = PyPDF2.PdfReader(f, strict=False)
+            if reader.is_encrypted: reader.decrypt('')
+            writer = PyPDF2.PdfWriter()
+            for page in pages: writer.add_page(reader.pages[page - 1])
+            with open(output_path, 'wb') as out: writer.write(out)
+    except PyPDF2.errors.PdfReadError as pdf_err: raise ValueError("err-pdf-corrupt") from pdf_err
+    except Exception as e: logger.error(f"Page extraction failed for {input_path}: {e}"); raise RuntimeError("err-conversion") from e
+    logger.info(f"Extracted {len(pages)} page(s) from {input_path} to {output_path}")
+    return output_path
+
 def setup_slide_size(prs, pdf_path):
     try:
         pdf_width_pt, pdf_height_pt = get_pdf_page_size(pdf_path)
         if pdf_width_pt is None or pdf_height_pt is None: # Kiểm tra cả hai
             logger.warning("Could not get PDF page size for slide setup. Falling back.")
-            prs.slide_width, prs.slide_height = Inches(10), Inches(7.5)
+            prs.slide_width, prs.slide_height = pptx_util.Inches(10), pptx_util.Inches(7.5)
         else:
             pdf_width_in, pdf_height_in = pdf_width_pt / 72.0, pdf_height_pt / 72.0; max_dim = 56.0
             if pdf_width_in > max_dim or pdf_height_in > max_dim:
@@ -327,31 +1065,33 @@ def setup_slide_size(prs, pdf_path):
                 final_width, final_height = pdf_width_in, pdf_height_in
             if final_width <= 0 or final_height <= 0:
                  logger.warning(f"Calculated non-positive slide dimensions ({final_width}x{final_height}). Falling back.")
-                 prs.slide_width, prs.slide_height = Inches(10), Inches(7.5)
+                 prs.slide_width, prs.slide_height = pptx_util.Inches(10), pptx_util.Inches(7.5)
             else:
-                 prs.slide_width, prs.slide_height = Inches(final_width), Inches(final_height)
+                 prs.slide_width, prs.slide_height = pptx_util.Inches(final_width), pptx_util.Inches(final_height)
                  logger.info(f"Set slide size from PDF: {final_width:.2f}in x {final_height:.2f}in")
 
     except ValueError as ve:
          logger.warning(f"Error getting PDF page size ({ve}). Falling back on slide setup.")
-         prs.slide_width, prs.slide_height = Inches(10), Inches(7.5)
+         prs.slide_width, prs.slide_height = pptx_util.Inches(10), pptx_util.Inches(7.5)
     except Exception as e:
         logger.warning(f"Error setting slide size from PDF dims: {e}. Falling back.")
-        prs.slide_width, prs.slide_height = Inches(10), Inches(7.5)
+        prs.slide_width, prs.slide_height = pptx_util.Inches(10), pptx_util.Inches(7.5)
     return prs
 
 def sort_key_for_pptx_images(filename):
     try: return int(os.path.splitext(filename)[0].split('-')[-1].split('_')[-1])
     except (ValueError, IndexError): return 0
 
-def _convert_pdf_to_pptx_images(input_path, output_path):
+@tracked_engine('poppler')
+@offload_cpu
+def _convert_pdf_to_pptx_images(input_path, output_path, pages=None):
     temp_dir = None
     success = False
     try:
-        temp_dir = tempfile.mkdtemp(prefix="pdfimg_")
+        temp_dir = tempfile.mkdtemp(prefix="pdfimg_", dir=os.path.dirname(os.path.abspath(output_path))) # Trong workspace của job
         page_count = 0 # Khởi tạo
         try:
-            page_count_info = pdfinfo_from_path(input_path, poppler_path=None)
+            page_count_info = pdf2image.pdfinfo_from_path(input_path, poppler_path=None)
             page_count = page_count_info.get('Pages')
             if page_count is None:
                 logger.warning("pdfinfo failed to get page count, trying PyPDF2...")
@@ -370,13 +1110,13 @@ def _convert_pdf_to_pptx_images(input_path, output_path):
                     logger.info(f"PyPDF2 got page count: {page_count}")
                 except ValueError as ve_pypdf:
                      if "err-pdf-protected" in str(ve_pypdf): raise ve_pypdf # Re-raise lỗi protected
-                     else: raise PDFPageCountError(f"PyPDF2 failed to get page count: {ve_pypdf}") from ve_pypdf
+                     else: raise pdf2image_exceptions.PDFPageCountError(f"PyPDF2 failed to get page count: {ve_pypdf}") from ve_pypdf
                 except Exception as e_pypdf:
-                     raise PDFPageCountError(f"PyPDF2 failed to get page count: {e_pypdf}") from e_pypdf
+                     raise pdf2image_exceptions.PDFPageCountError(f"PyPDF2 failed to get page count: {e_pypdf}") from e_pypdf
 
             # Nếu cả hai cách đều ko lấy được page count -> lỗi
             if page_count is None:
-                 raise PDFPageCountError("Could not determine page count using pdfinfo or PyPDF2.")
+                 raise pdf2image_exceptions.PDFPageCountError("Could not determine page count using pdfinfo or PyPDF2.")
 
             # Kiểm tra mã hóa bằng pdfinfo nếu có thể, hoặc dựa vào get_pdf_page_size
             is_encrypted = page_count_info.get('Encrypted', 'no').lower() == 'yes'
@@ -394,8 +1134,8 @@ def _convert_pdf_to_pptx_images(input_path, output_path):
                       logger.warning(f"Unexpected error checking encrypted PDF: {e_enc}")
                       raise # Raise lỗi đó lên
 
-        except PDFInfoNotInstalledError as e: raise ValueError("err-poppler-missing") from e
-        except (PDFPageCountError, PDFSyntaxError) as e: raise ValueError("err-pdf-corrupt") from e
+        except pdf2image_exceptions.PDFInfoNotInstalledError as e: raise ValueError("err-poppler-missing") from e
+        except (pdf2image_exceptions.PDFPageCountError, pdf2image_exceptions.PDFSyntaxError) as e: raise ValueError("err-pdf-corrupt") from e
         except ValueError as ve:
              if "err-pdf-protected" in str(ve): raise ve
              else: raise
@@ -406,22 +1146,25 @@ def _convert_pdf_to_pptx_images(input_path, output_path):
 
         if page_count == 0:
              logger.info("PDF has 0 pages. Creating empty PPTX.")
-             Presentation().save(output_path)
+             pptx.Presentation().save(output_path)
              success = True
         else:
-            logger.info(f"Converting {page_count} PDF pages to images for PPTX...")
-            images = convert_from_path(input_path, dpi=300, fmt='jpeg', output_folder=temp_dir, thread_count=1, poppler_path=None, strict=False)
+            logger.info(f"Converting {len(pages) if pages else page_count} of {page_count} PDF pages to images for PPTX...")
+            images = []
+            # Tên file ảnh chứa số trang thật nên sort_key_for_pptx_images vẫn giữ đúng thứ tự qua nhiều đoạn
+            for first_page, last_page in (page_runs(pages) if pages else [(None, None)]):
+                images += pdf2image.convert_from_path(input_path, dpi=300, fmt='jpeg', output_folder=temp_dir, first_page=first_page, last_page=last_page, thread_count=1, poppler_path=None, strict=False)
             if not images:
                  if page_count > 0:
                      logger.error("convert_from_path returned no images despite page count > 0.")
                      raise RuntimeError("err-conversion-img")
                  else:
                       logger.warning("No images generated for 0-page PDF.")
-                      Presentation().save(output_path)
+                      pptx.Presentation().save(output_path)
                       success = True
 
             if images:
-                prs = Presentation()
+                prs = pptx.Presentation()
                 prs = setup_slide_size(prs, input_path)
                 blank_layout = prs.slide_layouts[6]
                 gen_imgs = sorted([f for f in os.listdir(temp_dir) if f.lower().endswith(('.jpg', '.jpeg'))], key=sort_key_for_pptx_images)
@@ -468,7 +1211,7 @@ def _convert_pdf_to_pptx_images(input_path, output_path):
 
                         slide.shapes.add_picture(img_path, pic_l, pic_t, width=pic_w, height=pic_h)
 
-                    except UnidentifiedImageError:
+                    except Image.UnidentifiedImageError:
                         logger.warning(f"Skipping invalid image file {img_fn}")
                         continue
                     except Exception as page_err:
@@ -486,77 +1229,94 @@ def _convert_pdf_to_pptx_images(input_path, output_path):
     finally: safe_remove(temp_dir)
     return success
 
-def convert_pdf_to_pptx_python(input_path, output_path):
+@single_flight
+def convert_pdf_to_pptx_python(input_path, output_path, pages=None):
     logger.info("Attempting PDF -> PPTX via Python (image-based)...")
-    return _convert_pdf_to_pptx_images(input_path, output_path)
+    return _convert_pdf_to_pptx_images(input_path, output_path, pages)
+
+#Ảnh -> PDF: mỗi ảnh được chuẩn hóa song song (xoay theo EXIF, bỏ kênh alpha, thu nhỏ theo khổ trang + DPI tối đa)
+#rồi ghi PDF theo đúng thứ tự. 'fit' = trang theo tỉ lệ ảnh, vừa khổ A4; 'a4'/'letter' = đúng khổ, ảnh căn giữa
+PDF_PAGE_SIZES = {'fit': (8.27, 11.69), 'a4': (8.27, 11.69), 'letter': (8.5, 11.0)} # inch, chiều dọc
+IMAGE_PDF_DEFAULT_DPI = 200
+IMAGE_PDF_JPEG_QUALITY = 85
+IMAGE_NORMALIZE_WORKERS = max(1, os.cpu_count() or 1)
+EXIF_ORIENTATION_TAG = 0x0112
+
+def parse_image_pdf_options(form):
+    page_size = (form.get('page_size') or 'fit').lower()
+    try: max_dpi = int(form.get('dpi') or IMAGE_PDF_DEFAULT_DPI)
+    except ValueError: raise ValueError("err-invalid-image-options")
+    if page_size not in PDF_PAGE_SIZES or not IMAGE_DPI_RANGE[0] <= max_dpi <= IMAGE_DPI_RANGE[1]: raise ValueError("err-invalid-image-options")
+    return {'page_size': page_size, 'max_dpi': max_dpi}
+
+def _flatten_image_for_pdf(img, filename):
+    # PDF writer của Pillow không nhận alpha: ghép lên nền trắng; RGB, L, CMYK giữ nguyên
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        logger.debug(f"Flattening {img.mode} image {filename} onto white background.")
+        rgba = img.convert('RGBA')
+        bg = Image.new('RGB', rgba.size, (255, 255, 255))
+        try: bg.paste(rgba, mask=rgba.getchannel('A')); return bg
+        except Exception as paste_err: logger.warning(f"Error pasting {img.mode} {filename}, falling back to basic convert: {paste_err}"); return img.convert('RGB')
+    if img.mode not in ('RGB', 'L', 'CMYK'): logger.debug(f"Converting {filename} from mode {img.mode} to RGB"); return img.convert('RGB')
+    return img
+
+def _image_page_geometry(img, page_size):
+    # (rộng, cao) sau khi xoay theo EXIF, khổ trang cùng chiều với ảnh, và DPI để ảnh vừa khít khổ đó
+    width, height = img.size
+    if img.getexif().get(EXIF_ORIENTATION_TAG) in (5, 6, 7, 8): width, height = height, width # Xoay 90° theo EXIF
+    box_w, box_h = PDF_PAGE_SIZES[page_size]
+    if width > height: box_w, box_h = box_h, box_w # Ảnh ngang -> trang ngang
+    return width, height, box_w, box_h, max(width / box_w, height / box_h)
+
+def _image_fit_dpi(file_path, page_size):
+    try:
+        with Image.open(file_path) as img: return _image_page_geometry(img, page_size)[4] # Chỉ đọc header
+    except Image.UnidentifiedImageError: raise ValueError("err-invalid-image-file")
 
-def convert_images_to_pdf(image_paths, output_path):
+def _normalize_image_for_pdf(file_path, page_size, resolution):
+    # Chạy trong thread pool: decode/resize của Pillow nhả GIL. Ảnh được thu nhỏ về `resolution` DPI (không phóng to)
+    filename = os.path.basename(file_path)
+    try:
+        with Image.open(file_path) as img:
+            width, height, box_w, box_h, fit_dpi = _image_page_geometry(img, page_size)
+            scale = min(1.0, resolution / fit_dpi)
+            if img.format == 'JPEG' and scale < 0.5:
+                # JPEG decode thẳng ở 1/2, 1/4, 1/8 kích thước: nhanh và ít RAM hơn nhiều với ảnh điện thoại
+                draft_size = (int(img.size[0] * scale), int(img.size[1] * scale))
+                img.draft(img.mode if img.mode in ('RGB', 'L', 'CMYK') else 'RGB', draft_size)
+            page = ImageOps.exif_transpose(img)
+            page = _flatten_image_for_pdf(page, filename)
+            target = (max(1, round(width * scale)), max(1, round(height * scale)))
+            if page.size != target: page = page.resize(target, Image.LANCZOS, reducing_gap=3.0)
+            if page_size != 'fit':
+                # Đúng khổ giấy: đặt ảnh vào giữa trang trắng cùng DPI
+                canvas = Image.new(page.mode, (round(box_w * resolution), round(box_h * resolution)), 'white' if page.mode != 'CMYK' else (0, 0, 0, 0))
+                canvas.paste(page, ((canvas.width - page.width) // 2, (canvas.height - page.height) // 2)); page = canvas
+            if page is img: page = img.copy() # Tách khỏi file đang mở
+            return page
+    except Image.UnidentifiedImageError:
+        logger.error(f"File {filename} is not a valid image or format not supported by Pillow.")
+        raise ValueError("err-invalid-image-file")
+    except Exception as img_err:
+        logger.error(f"Error processing image {filename}: {img_err}", exc_info=True)
+        raise RuntimeError("err-conversion") from img_err
+
+@tracked_engine('pillow')
+@offload_cpu
+def convert_images_to_pdf(image_paths, output_path, page_size='fit', max_dpi=IMAGE_PDF_DEFAULT_DPI):
     image_objects = []
     success = False
     try:
-        sorted_paths = image_paths
-        for file_path in sorted_paths:
-            filename = os.path.basename(file_path)
-            try:
-                with Image.open(file_path) as img:
-                    img.load()
-                    converted_img = None
-                    if img.mode == 'RGBA':
-                        logger.debug(f"Converting RGBA image {filename} to RGB with white background.")
-                        bg = Image.new('RGB', img.size, (255, 255, 255))
-                        try:
-                            bg.paste(img, mask=img.getchannel('A'))
-                            converted_img = bg
-                        except Exception as paste_err:
-                            logger.warning(f"Error pasting RGBA {filename}, falling back to basic convert: {paste_err}")
-                            converted_img = img.convert('RGB')
-                    elif img.mode == 'LA': # Luminance + Alpha
-                         logger.debug(f"Converting LA image {filename} to RGB with white background.")
-                         bg = Image.new('RGB', img.size, (255, 255, 255));
-                         l_channel = img.getchannel('L'); a_channel = img.getchannel('A');
-                         rgb_img = Image.merge('RGB', (l_channel, l_channel, l_channel))
-                         try:
-                             bg.paste(rgb_img, mask=a_channel); converted_img = bg
-                         except Exception as paste_err:
-                             logger.warning(f"Error pasting LA {filename}, falling back to basic convert: {paste_err}");
-                             converted_img = img.convert('RGB')
-                    elif img.mode == 'P' and 'transparency' in img.info:
-                         logger.debug(f"Converting Palette image {filename} with transparency to RGB.")
-                         img_rgba = img.convert('RGBA') # Convert palette with transparency to RGBA first
-                         bg = Image.new('RGB', img_rgba.size, (255, 255, 255))
-                         try:
-                             bg.paste(img_rgba, mask=img_rgba.getchannel('A')); converted_img = bg
-                         except Exception as paste_err:
-                             logger.warning(f"Error pasting P->RGBA {filename}, falling back to basic convert: {paste_err}")
-                             converted_img = img.convert('RGB')
-                    elif img.mode not in ['RGB', 'L', 'CMYK']:
-                        logger.debug(f"Converting {filename} from mode {img.mode} to RGB")
-                        converted_img = img.convert('RGB')
-                    else:
-                        # Keep RGB, L (grayscale), CMYK as they are supported by Pillow's PDF writer
-                        if img.mode == 'CMYK': logger.debug(f"Image {filename} is CMYK.")
-                        if img.mode == 'L': logger.debug(f"Image {filename} is Grayscale.")
-                        converted_img = img.copy() # Make a copy to avoid issues with context manager
-
-                    if converted_img: image_objects.append(converted_img)
-                    else: logger.error(f"Failed to prepare image {filename} for PDF conversion."); raise RuntimeError("err-conversion")
-
-            except UnidentifiedImageError:
-                logger.error(f"File {filename} is not a valid image or format not supported by Pillow.")
-                raise ValueError("err-invalid-image-file")
-            except Exception as img_err:
-                logger.error(f"Error processing image {filename}: {img_err}", exc_info=True)
-                raise RuntimeError("err-conversion") from img_err
-
-        if not image_objects:
+        if not image_paths:
              logger.warning("No valid images found to convert to PDF.")
              raise ValueError("err-select-file") # Hoặc lỗi khác phù hợp
-
-        # Lưu ảnh đầu tiên và nối các ảnh còn lại
-        first_image = image_objects[0]
-        other_images = image_objects[1:]
-        first_image.save(output_path, "PDF", resolution=100.0, save_all=True, append_images=other_images)
-        logger.info(f"Saved {len(image_objects)} images to PDF: {output_path}")
+        # Pillow ghi cả file với 1 resolution: dùng DPI thấp nhất để mọi ảnh vừa khổ (>= 72 để ảnh rất nhỏ không kéo cả file xuống)
+        resolution = min(max_dpi, max(72.0, min(_image_fit_dpi(file_path, page_size) for file_path in image_paths)))
+        with ThreadPoolExecutor(max_workers=min(IMAGE_NORMALIZE_WORKERS, len(image_paths))) as pool:
+            futures = [pool.submit(_normalize_image_for_pdf, file_path, page_size, resolution) for file_path in image_paths]
+            for future in futures: image_objects.append(future.result()) # Giữ thứ tự trang, lỗi đầu tiên được raise lại
+        image_objects[0].save(output_path, "PDF", resolution=resolution, save_all=True, append_images=image_objects[1:], quality=IMAGE_PDF_JPEG_QUALITY)
+        logger.info(f"Saved {len(image_objects)} images to PDF ({page_size}, {resolution:.0f} DPI): {output_path} ({os.path.getsize(output_path)} bytes)")
         success = True
 
     except ValueError as ve: raise ve
@@ -571,14 +1331,70 @@ def convert_images_to_pdf(image_paths, output_path):
              except Exception as close_err: logger.debug(f"Error closing PIL object: {close_err}")
     return success
 
-def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg'):
-    temp_dir = None; fmt = img_format.lower(); ext = 'jpg' if fmt in ['jpeg', 'jpg'] else fmt
+#PDF -> ảnh: định dạng, chế độ màu, DPI và giới hạn số pixel mỗi trang
+IMAGE_OUTPUT_FORMATS = {'jpeg': 'jpg', 'png': 'png', 'webp': 'webp', 'tiff': 'tif'}
+IMAGE_COLOR_MODES = {'jpeg': ('color', 'gray'), 'png': ('color', 'gray', 'mono'), 'webp': ('color', 'gray'), 'tiff': ('color', 'gray', 'mono')}
+IMAGE_DPI_RANGE = (36, 600)
+IMAGE_DEFAULT_DPI = 200
+MAX_RENDER_PIXELS = int(os.environ.get('MAX_RENDER_PIXELS', 50_000_000)) # ~A4 ở 600 DPI là 35 MP
+IMAGE_ENCODE_WORKERS = max(1, min(4, os.cpu_count() or 1))
+JPEG_RENDER_OPTIONS = {'quality': 85, 'progressive': True, 'optimize': True}
+PNG_PALETTE_MAX_COLORS = 256 # Trang chữ/ảnh quét đen trắng thường ít màu -> PNG palette nhỏ hơn nhiều
+WEBP_QUALITY = 80; WEBP_METHOD = 4 # method 6 chậm hơn ~2x mà chỉ nhỏ hơn vài %
+
+def parse_image_options(form):
+    img_format = (form.get('image_format') or 'jpeg').lower()
+    if img_format == 'jpg': img_format = 'jpeg'
+    color = (form.get('color_mode') or 'color').lower()
+    if img_format not in IMAGE_OUTPUT_FORMATS or color not in IMAGE_COLOR_MODES[img_format]: raise ValueError("err-invalid-image-options")
+    try:
+        dpi = int(form.get('dpi') or IMAGE_DEFAULT_DPI)
+        max_pixels = min(int(form.get('max_pixels') or MAX_RENDER_PIXELS), MAX_RENDER_PIXELS)
+    except ValueError: raise ValueError("err-invalid-image-options")
+    if not IMAGE_DPI_RANGE[0] <= dpi <= IMAGE_DPI_RANGE[1] or max_pixels < 10_000: raise ValueError("err-invalid-image-options")
+    return {'img_format': img_format, 'color': color, 'dpi': dpi, 'max_pixels': max_pixels}
+
+def _capped_render_dpi(pdf_path, dpi, max_pixels):
+    # Giảm DPI để trang (theo kích thước trang đầu) không vượt max_pixels
+    try: width_pt, height_pt = get_pdf_page_size(pdf_path)
+    except ValueError: return dpi
+    if not width_pt or not height_pt: return dpi
+    cap = int((max_pixels / ((width_pt / 72.0) * (height_pt / 72.0))) ** 0.5)
+    if cap < dpi: logger.info(f"Render DPI capped {dpi} -> {cap} to stay under {max_pixels} pixels per page"); return max(cap, 1)
+    return dpi
+
+def _encode_page_image(src_path, dst_path, img_format, color, dpi):
+    with Image.open(src_path) as img:
+        img.load()
+        if color == 'mono': img = img.convert('L').point(lambda v: 255 if v >= 128 else 0, mode='1') # Ngưỡng cứng, không dither: hợp cho OCR
+        elif color == 'gray' and img.mode != 'L': img = img.convert('L')
+        if img_format == 'png':
+            # Ít màu (trang chữ, sơ đồ) -> palette: MEDIANCUT giữ đúng màu khi số màu <= palette. Ảnh xám chỉ đáng đổi khi <= 16 mức (4 bit)
+            if img.mode == 'RGB': color_count = len(img.getcolors(PNG_PALETTE_MAX_COLORS) or ()) # None khi vượt ngưỡng
+            elif img.mode == 'L': color_count = sum(1 for count in img.histogram() if count); color_count = color_count if color_count <= 16 else 0
+            else: color_count = 0
+            if color_count: img = img.quantize(colors=color_count, method=Image.Quantize.MEDIANCUT)
+            img.save(dst_path, 'PNG', compress_level=3 if img.mode == 'RGB' else 6, dpi=(dpi, dpi))
+        elif img_format == 'webp': img.save(dst_path, 'WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD)
+        elif img_format == 'tiff': img.save(dst_path, 'TIFF', compression='group4' if img.mode == '1' else 'tiff_adobe_deflate', dpi=(dpi, dpi))
+        else: img.save(dst_path, 'JPEG', quality=JPEG_RENDER_OPTIONS['quality'], optimize=True, progressive=True, dpi=(dpi, dpi))
+    safe_remove(src_path)
+    return dst_path
+
+@single_flight
+@tracked_engine('poppler')
+@offload_cpu
+def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg', pages=None, dpi=IMAGE_DEFAULT_DPI, color='color', max_pixels=MAX_RENDER_PIXELS):
+    temp_dir = None; img_format = 'jpeg' if img_format.lower() == 'jpg' else img_format.lower(); ext = IMAGE_OUTPUT_FORMATS[img_format]
+    # JPEG màu/xám: pdftoppm ghi thẳng JPEG. Định dạng khác: render PPM thô rồi encode bằng Pillow theo định dạng
+    native_render = img_format == 'jpeg'
+    fmt = 'jpeg' if native_render else 'ppm'; render_exts = ('.jpg',) if native_render else ('.ppm', '.pgm')
     success = False
     try:
-        temp_dir = tempfile.mkdtemp(prefix="pdf2imgzip_")
+        temp_dir = tempfile.mkdtemp(prefix="pdf2imgzip_", dir=os.path.dirname(os.path.abspath(output_zip_path))) # Trong workspace của job
         page_count = 0 # Khởi tạo
         try:
-             page_count_info = pdfinfo_from_path(input_path, poppler_path=None)
+             page_count_info = pdf2image.pdfinfo_from_path(input_path, poppler_path=None)
              page_count = page_count_info.get('Pages')
              if page_count is None:
                   logger.warning("pdfinfo failed to get page count for zip conversion, trying PyPDF2...")
@@ -593,11 +1409,11 @@ def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg'):
                       logger.info(f"PyPDF2 got page count for zip: {page_count}")
                   except ValueError as ve_pypdf:
                        if "err-pdf-protected" in str(ve_pypdf): raise ve_pypdf
-                       else: raise PDFPageCountError(f"PyPDF2 failed to get page count for zip: {ve_pypdf}") from ve_pypdf
+                       else: raise pdf2image_exceptions.PDFPageCountError(f"PyPDF2 failed to get page count for zip: {ve_pypdf}") from ve_pypdf
                   except Exception as e_pypdf:
-                       raise PDFPageCountError(f"PyPDF2 failed to get page count for zip: {e_pypdf}") from e_pypdf
+                       raise pdf2image_exceptions.PDFPageCountError(f"PyPDF2 failed to get page count for zip: {e_pypdf}") from e_pypdf
 
-             if page_count is None: raise PDFPageCountError("Could not determine page count for zip conversion.")
+             if page_count is None: raise pdf2image_exceptions.PDFPageCountError("Could not determine page count for zip conversion.")
 
              is_encrypted = page_count_info.get('Encrypted', 'no').lower() == 'yes'
              if is_encrypted:
@@ -609,8 +1425,8 @@ def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg'):
 
              logger.info(f"PDF Info for ZIP conversion: {page_count} pages.")
 
-        except (PDFInfoNotInstalledError, FileNotFoundError) as e: raise ValueError("err-poppler-missing") from e
-        except (PDFPageCountError, PDFSyntaxError) as e: raise ValueError("err-pdf-corrupt") from e
+        except (pdf2image_exceptions.PDFInfoNotInstalledError, FileNotFoundError) as e: raise ValueError("err-poppler-missing") from e
+        except (pdf2image_exceptions.PDFPageCountError, pdf2image_exceptions.PDFSyntaxError) as e: raise ValueError("err-pdf-corrupt") from e
         except ValueError as ve:
              if "err-pdf-protected" in str(ve): raise ve
              else: raise
@@ -624,7 +1440,11 @@ def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg'):
             input_basename = os.path.splitext(os.path.basename(input_path))[0]
             safe_base = secure_filename(f"page_{input_basename}")[:100] # Giới hạn độ dài
 
-            images = convert_from_path(input_path, dpi=200, fmt=fmt, output_folder=temp_dir, output_file=safe_base, thread_count=1, poppler_path=None, strict=False)
+            render_dpi = _capped_render_dpi(input_path, dpi, max_pixels)
+            render_options = {'jpegopt': JPEG_RENDER_OPTIONS} if native_render else {}
+            images = []
+            for first_page, last_page in (page_runs(pages) if pages else [(None, None)]):
+                images += pdf2image.convert_from_path(input_path, dpi=render_dpi, fmt=fmt, output_folder=temp_dir, output_file=safe_base, first_page=first_page, last_page=last_page, grayscale=color != 'color', thread_count=1, poppler_path=None, strict=False, paths_only=True, **render_options)
             if not images:
                  if page_count > 0: logger.error(f"pdf2image failed for zip conversion {input_path}"); raise RuntimeError("err-conversion-img")
                  else:
@@ -644,10 +1464,10 @@ def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg'):
                         return 0
 
                 # Lọc file chính xác hơn dựa trên prefix đã tạo
-                gen_files = sorted( [f for f in os.listdir(temp_dir) if f.lower().startswith(safe_base.lower()) and f.lower().endswith(f'.{ext}')], key=sort_key_pdf2image )
+                gen_files = sorted( [f for f in os.listdir(temp_dir) if f.lower().startswith(safe_base.lower()) and f.lower().endswith(render_exts)], key=sort_key_pdf2image )
 
                 if not gen_files and page_count > 0:
-                     logger.error(f"No output files found matching pattern '{safe_base}*.{ext}' in {temp_dir}")
+                     logger.error(f"No output files found matching pattern '{safe_base}*{render_exts}' in {temp_dir}")
                      # Thử list lại xem có file nào không
                      all_files = os.listdir(temp_dir)
                      logger.debug(f"Files found in temp dir: {all_files}")
@@ -657,11 +1477,16 @@ def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg'):
                      with zipfile.ZipFile(output_zip_path, 'w') as zf: pass
                      success = True
                 else:
-                    with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-                         for i, filename in enumerate(gen_files):
-                             zip_filename = f"page_{i+1}.{ext}" # Đặt tên file trong zip đơn giản
-                             zf.write(os.path.join(temp_dir, filename), zip_filename)
-                    logger.info(f"Created image ZIP: {output_zip_path} with {len(gen_files)} images.")
+                    page_files = [(f"page_{sort_key_pdf2image(filename) or i+1}.{ext}", os.path.join(temp_dir, filename)) for i, filename in enumerate(gen_files)] # Tên file pdf2image mang số trang gốc
+                    if not native_render:
+                        with ThreadPoolExecutor(max_workers=IMAGE_ENCODE_WORKERS) as pool: # Encoder của Pillow nhả GIL
+                            encoded = pool.map(lambda item: _encode_page_image(item[1], os.path.join(temp_dir, item[0]), img_format, color, render_dpi), page_files)
+                            page_files = [(zip_name, path) for (zip_name, _), path in zip(page_files, encoded)]
+                    # Ảnh đã nén sẵn (JPEG/PNG/WebP/TIFF) -> lưu STORED, deflate lần nữa chỉ tốn CPU
+                    with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_STORED) as zf:
+                         for zip_filename, page_path in page_files:
+                             zf.write(page_path, zip_filename)
+                    logger.info(f"Created image ZIP: {output_zip_path} with {len(gen_files)} {img_format}/{color} images at {render_dpi} DPI.")
                     success = True
     except ValueError as ve: raise ve
     except RuntimeError as rte: raise rte
@@ -669,18 +1494,24 @@ def convert_pdf_to_image_zip(input_path, output_zip_path, img_format='jpeg'):
     finally: safe_remove(temp_dir)
     return success
 
-def compress_pdf_ghostscript(input_path, output_path, quality_level='medium'):
-    if not GS_PATH: logger.error("GS_PATH not set."); raise RuntimeError("err-gs-missing")
+@single_flight
+@tracked_engine('ghostscript')
+def compress_pdf_ghostscript(input_path, output_path, quality_level='medium', pages=None):
+    gs_path = get_gs_path()
+    if not gs_path: logger.error("Ghostscript path not available."); raise RuntimeError("err-gs-missing")
     success = False
     # Thêm check file input tồn tại
     if not os.path.isfile(input_path):
          logger.error(f"Input file for GS compression not found: {input_path}")
          raise RuntimeError("err-gs-failed") # Hoặc lỗi khác
 
-    # Sử dụng GS_PATH đã được xác minh
-    gs_base_cmd = [ GS_PATH, '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4', '-dNOPAUSE', '-dBATCH', '-dQUIET' ]
+    # Sử dụng GS path đã được xác minh
+    gs_base_cmd = [ gs_path, '-sDEVICE=pdfwrite', '-dCompatibilityLevel=1.4', '-dNOPAUSE', '-dBATCH', '-dQUIET' ]
     gs_output_cmd = [f'-sOutputFile={output_path}']
     gs_input_cmd = [input_path]
+    if pages: # Một đoạn liên tiếp -> FirstPage/LastPage, nhiều đoạn -> PageList
+        runs = page_runs(pages)
+        gs_base_cmd += [f'-dFirstPage={runs[0][0]}', f'-dLastPage={runs[0][1]}'] if len(runs) == 1 else [f'-sPageList={format_page_runs(pages)}']
     cmd = []; log_quality_info = ""
 
     # Chọn chất lượng
@@ -706,11 +1537,13 @@ def compress_pdf_ghostscript(input_path, output_path, quality_level='medium'):
         cmd = gs_base_cmd + standard_settings + gs_output_cmd + gs_input_cmd
         log_quality_info = f"Quality: medium (Setting: /ebook)"
 
-    logger.info(f"Running Ghostscript ({log_quality_info}): {' '.join(cmd)}")
+    logger.info("Running Ghostscript (%s) on %s", log_quality_info, input_path)
+    if engine_logger.isEnabledFor(logging.DEBUG): engine_logger.debug("Ghostscript command: %s", ' '.join(cmd))
     try:
-        result = subprocess.run(cmd, check=True, timeout=GS_TIMEOUT, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-        if result.stdout: logger.info(f"Ghostscript stdout:\n{result.stdout}")
-        if result.stderr: logger.info(f"Ghostscript stderr:\n{result.stderr}")
+        gs_timeout = job_timeout(GS_TIMEOUT)
+        result = run_engine(cmd, gs_timeout, 'ghostscript')
+        if result.stdout and engine_logger.isEnabledFor(logging.DEBUG): engine_logger.debug("Ghostscript stdout (tail):\n%s", output_tail(result.stdout))
+        if result.stderr: engine_logger.info("Ghostscript stderr (tail):\n%s", output_tail(result.stderr))
 
         if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
             original_size = os.path.getsize(input_path)
@@ -724,14 +1557,14 @@ def compress_pdf_ghostscript(input_path, output_path, quality_level='medium'):
             raise RuntimeError("err-gs-failed")
 
     except subprocess.TimeoutExpired:
-        logger.error(f"Ghostscript command timed out ({GS_TIMEOUT}s) for {input_path}.")
+        logger.error(f"Ghostscript command timed out ({gs_timeout:.0f}s) for {input_path}.")
         safe_remove(output_path) # Xóa file output nếu có
         raise RuntimeError("err-gs-timeout")
     except subprocess.CalledProcessError as gs_err:
         logger.error(f"Ghostscript command failed for {input_path}. Return Code: {gs_err.returncode}")
         # Ghi lại stdout/stderr để debug
-        if gs_err.stdout: logger.error(f"GS stdout on error:\n{gs_err.stdout}")
-        if gs_err.stderr: logger.error(f"GS stderr on error:\n{gs_err.stderr}")
+        if gs_err.stdout: engine_logger.error("GS stdout on error (tail):\n%s", output_tail(gs_err.stdout))
+        if gs_err.stderr: engine_logger.error("GS stderr on error (tail):\n%s", output_tail(gs_err.stderr))
         safe_remove(output_path) # Xóa file output lỗi nếu có
 
         # Phân tích stderr để xác định lỗi cụ thể hơn
@@ -751,7 +1584,7 @@ def compress_pdf_ghostscript(input_path, output_path, quality_level='medium'):
 
     except ValueError as ve: raise ve # Re-raise lỗi đã xác định (protected, corrupt)
     except FileNotFoundError:
-        logger.error(f"Ghostscript executable not found at the specified path: {GS_PATH}")
+        logger.error(f"Ghostscript executable not found at the specified path: {gs_path}")
         raise RuntimeError("err-gs-missing")
     except Exception as gs_run_err:
         logger.error(f"Unexpected error running Ghostscript: {gs_run_err}", exc_info=True)
@@ -760,6 +1593,593 @@ def compress_pdf_ghostscript(input_path, output_path, quality_level='medium'):
 
     return success
 
+#Nén PDF kiểu "phẫu thuật": chỉ ảnh (XObject) có DPI hiệu dụng theo kích thước hiển thị vượt ngưỡng mới được thu nhỏ + mã hóa
+#lại JPEG (song song trong thread pool, Pillow nhả GIL); font, vector, text và cấu trúc giữ nguyên. Nhanh hơn nhiều so với
+#Ghostscript pdfwrite ghi lại toàn bộ file khi phần lớn dung lượng là ảnh scan quá khổ.
+PDF_IMAGE_COMPRESSION = {'low': (110, 55), 'medium': (150, 70), 'high': (300, 85)} # quality -> (DPI mục tiêu, chất lượng JPEG)
+PDF_IMAGE_DPI_SLACK = 1.25 # Chỉ xử lý ảnh có DPI hiệu dụng > mục tiêu x hệ số này
+PDF_IMAGE_MIN_PIXELS = 64 * 64
+PDF_IMAGE_MIN_GAIN = 0.9 # Ảnh mới phải nhỏ hơn 90% stream cũ, không thì giữ nguyên
+PDF_IMAGE_WORKERS = max(1, min(8, os.cpu_count() or 1))
+#quality -> engine: 'images' (chỉ nén lại ảnh), 'ghostscript' (pdfwrite) hoặc 'auto' (planner chọn engine rẻ nhất, lỗi thì thử engine kia)
+COMPRESS_PDF_ENGINES = dict({'low': 'ghostscript', 'medium': 'auto', 'high': 'auto'}, **{
+    level.strip(): engine.strip() for level, _, engine in (item.partition('=') for item in os.environ.get('COMPRESS_PDF_ENGINES', '').split(','))
+    if level.strip() in ('low', 'medium', 'high') and engine.strip() in ('images', 'ghostscript', 'auto')})
+
+def _pdf_image_components(pdf_document, xref):
+    # Số kênh màu của ảnh nếu ảnh nén lại JPEG được (Gray/RGB 8 bit, không mask/Decode), ngược lại None
+    get_key = lambda key: pdf_document.xref_get_key(xref, key)
+    if get_key('ImageMask')[1] == 'true' or get_key('Decode')[0] != 'null' or get_key('BitsPerComponent')[1] != '8': return None
+    if get_key('Mask')[0] == 'array': return None # Color-key mask: JPEG lệch màu -> vùng trong suốt thành đục
+    smask_kind, smask = get_key('SMask')
+    if smask_kind == 'xref' and pdf_document.xref_get_key(int(smask.split()[0]), 'Matte')[0] != 'null': return None # /Matte cần ảnh và SMask cùng kích thước
+    kind, colorspace = get_key('ColorSpace')
+    if colorspace in ('/DeviceGray', '/CalGray'): return 1
+    if colorspace in ('/DeviceRGB', '/CalRGB'): return 3
+    match = re.match(r'\[/ICCBased (\d+) 0 R\]$', colorspace) if kind == 'array' else None
+    if match:
+        components = pdf_document.xref_get_key(int(match.group(1)), 'N')[1]
+        return int(components) if components in ('1', '3') else None
+    return None
+
+def _recompress_pdf_image(data, is_jpeg, size, components, target_size, quality):
+    mode = 'L' if components == 1 else 'RGB'
+    try:
+        if is_jpeg:
+            img = Image.open(BytesIO(data))
+            if img.mode not in ('L', 'RGB'): return None # CMYK/YCCK: màu dễ sai, bỏ qua
+            img.draft(mode, target_size) # Decoder JPEG thu nhỏ 1/2, 1/4, 1/8 ngay khi giải mã
+        else: img = Image.frombytes(mode, size, data)
+        img = img.convert(mode)
+        if img.size != target_size: img = img.resize(target_size, Image.LANCZOS)
+        buffer = BytesIO(); img.save(buffer, 'JPEG', quality=quality, optimize=True)
+        return buffer.getvalue()
+    except Exception as image_err: logger.debug("Keeping PDF image as is: %s", image_err); return None # Ảnh lỗi/lạ: giữ nguyên
+
+def _save_pdf_compact(pdf_document, output_path):
+    try: pdf_document.save(output_path, garbage=3, deflate=True, use_objstms=1) # Object stream cần PyMuPDF >= 1.24
+    except TypeError: pdf_document.save(output_path, garbage=3, deflate=True)
+
+def _pdf_image_effective_dpi(pdf_document):
+    # DPI hiệu dụng nhỏ nhất của mỗi ảnh trên mọi chỗ nó được vẽ (ảnh dùng lại ở nhiều trang tính theo chỗ hiển thị lớn nhất)
+    effective_dpi = {}
+    for page in pdf_document:
+        for info in page.get_image_info(xrefs=True):
+            xref = info.get('xref'); bbox = fitz.Rect(info['bbox'])
+            if not xref or bbox.is_empty or not info['width'] or not info['height']: continue
+            # bbox theo hướng trang; ảnh xoay 90 độ thì đổi chiều
+            shown_w, shown_h = (bbox.height, bbox.width) if abs(info['transform'][1]) > abs(info['transform'][0]) else (bbox.width, bbox.height)
+            dpi = min(info['width'] / max(shown_w / 72, 1e-3), info['height'] / max(shown_h / 72, 1e-3))
+            effective_dpi[xref] = min(dpi, effective_dpi.get(xref, dpi))
+    return effective_dpi
+
+@single_flight
+@tracked_engine('pymupdf')
+@offload_cpu
+def compress_pdf_images(input_path, output_path, quality_level='medium', pages=None, target_dpi=None, jpeg_quality=None):
+    # target_dpi/jpeg_quality: đặt thẳng mức nén thay cho mức theo quality_level (dùng bởi chế độ target_bytes)
+    level_dpi, level_quality = PDF_IMAGE_COMPRESSION.get(quality_level, PDF_IMAGE_COMPRESSION['medium'])
+    target_dpi = target_dpi or level_dpi; jpeg_quality = jpeg_quality or level_quality
+    deadline = time.time() + job_timeout(GS_TIMEOUT)
+    try: pdf_document = fitz.open(input_path)
+    except Exception as open_err: logger.error(f"PyMuPDF could not open {input_path}: {open_err}"); raise ValueError("err-pdf-corrupt") from open_err
+    try:
+        if pdf_document.needs_pass: raise ValueError("err-pdf-protected")
+        if pdf_document.page_count == 0: raise ValueError("err-pdf-no-pages")
+        if pages: pdf_document.select([page - 1 for page in pages])
+        effective_dpi = _pdf_image_effective_dpi(pdf_document)
+        candidates = []
+        for xref, dpi in effective_dpi.items():
+            if dpi <= target_dpi * PDF_IMAGE_DPI_SLACK: continue
+            width = int(pdf_document.xref_get_key(xref, 'Width')[1] or 0); height = int(pdf_document.xref_get_key(xref, 'Height')[1] or 0)
+            components = _pdf_image_components(pdf_document, xref)
+            if not components or width * height < PDF_IMAGE_MIN_PIXELS: continue
+            filters = pdf_document.xref_get_key(xref, 'Filter')[1].strip('[]').strip()
+            if filters not in ('/DCTDecode', '/FlateDecode', '/LZWDecode', 'null'): continue # JPX/JBIG2/CCITT: giữ nguyên
+            scale = target_dpi / dpi
+            candidates.append((xref, filters == '/DCTDecode', (width, height), components, (max(1, round(width * scale)), max(1, round(height * scale)))))
+        logger.info(f"Image recompression ({target_dpi} DPI, JPEG q{jpeg_quality}): {len(candidates)}/{len(effective_dpi)} image(s) above target in {input_path}")
+
+        replaced = saved_bytes = 0
+        with ThreadPoolExecutor(max_workers=PDF_IMAGE_WORKERS) as pool:
+            pending = collections.deque()
+            def collect(entry):
+                nonlocal replaced, saved_bytes
+                xref, original_length, target_size, components, future = entry
+                data = future.result()
+                if not data or len(data) >= original_length * PDF_IMAGE_MIN_GAIN: return
+                pdf_document.update_stream(xref, data, compress=0)
+                pdf_document.xref_set_key(xref, 'Filter', '/DCTDecode'); pdf_document.xref_set_key(xref, 'DecodeParms', 'null')
+                pdf_document.xref_set_key(xref, 'Width', str(target_size[0])); pdf_document.xref_set_key(xref, 'Height', str(target_size[1]))
+                replaced += 1; saved_bytes += original_length - len(data)
+            for xref, is_jpeg, size, components, target_size in candidates:
+                if time.time() > deadline: raise RuntimeError("err-gs-timeout")
+                # Đọc stream trên thread này (PyMuPDF không thread-safe), chỉ giải mã/mã hóa ảnh chạy trong pool; giới hạn số ảnh giữ trong RAM
+                raw = pdf_document.xref_stream_raw(xref)
+                data = raw if is_jpeg else pdf_document.xref_stream(xref)
+                pending.append((xref, len(raw), target_size, components, pool.submit(_recompress_pdf_image, data, is_jpeg, size, components, target_size, jpeg_quality)))
+                if len(pending) >= PDF_IMAGE_WORKERS * 2: collect(pending.popleft())
+            while pending: collect(pending.popleft())
+        _save_pdf_compact(pdf_document, output_path)
+    except (ValueError, RuntimeError): raise
+    except Exception as compress_err: logger.error(f"Image recompression failed for {input_path}: {compress_err}", exc_info=True); raise RuntimeError("err-gs-failed") from compress_err
+    finally: pdf_document.close()
+    if not os.path.isfile(output_path) or os.path.getsize(output_path) == 0: raise RuntimeError("err-gs-failed")
+    logger.info(f"Image recompression successful: {output_path} ({replaced} image(s) re-encoded, {saved_bytes} bytes saved, size {os.path.getsize(output_path)} bytes)")
+    return True
+
+#Nén tới dung lượng mục tiêu (target_bytes): thang mức (DPI ảnh, chất lượng JPEG) từ cao xuống thấp. Phân tích nhanh phần byte
+#do ảnh chiếm để đoán mức khởi đầu, thử nén vài trang mẫu để thu hẹp (tìm nhị phân, giới hạn số lần thử) rồi mới nén cả file.
+#Trả về kết quả chất lượng cao nhất dưới mục tiêu, hoặc kết quả nhỏ nhất đạt được kèm target_met=False.
+TARGET_SIZE_LEVELS = ((300, 85), (240, 80), (200, 76), (150, 72), (130, 65), (110, 58), (96, 50), (85, 45), (72, 40), (60, 34), (50, 28))
+TARGET_SIZE_SAMPLE_PAGES = 6
+TARGET_SIZE_MAX_TRIALS = 4 # Số lần nén thử trên trang mẫu
+TARGET_SIZE_MAX_FULL_RUNS = 2 # Số lần nén cả file
+TARGET_SIZE_MARGIN = 0.95 # Dự đoán từ mẫu phải <= 95% mục tiêu (mẫu không chính xác tuyệt đối)
+TARGET_BYTES_MIN = 10 * 1024
+
+def parse_target_bytes(form):
+    value = (form.get('target_bytes') or '').strip()
+    if not value: return None
+    try: target_bytes = int(value)
+    except ValueError: raise ValueError("err-invalid-target-size")
+    if target_bytes < TARGET_BYTES_MIN: raise ValueError("err-invalid-target-size")
+    return target_bytes
+
+def analyze_pdf_image_bytes(pdf_path):
+    # Chỉ đọc metadata + độ dài stream: (tổng byte ảnh, DPI hiệu dụng trung vị theo byte) để đoán mức nén ban đầu
+    with fitz.open(pdf_path) as pdf_document:
+        if pdf_document.needs_pass: raise ValueError("err-pdf-protected")
+        effective_dpi = _pdf_image_effective_dpi(pdf_document)
+        sized = sorted((dpi, len(pdf_document.xref_stream_raw(xref) or b'')) for xref, dpi in effective_dpi.items())
+    image_bytes = sum(size for _, size in sized); running = 0
+    for dpi, size in sized:
+        running += size
+        if running * 2 >= image_bytes: return image_bytes, dpi
+    return image_bytes, None
+
+def _target_model_bytes(index, file_bytes, image_bytes, median_dpi, correction=1.0):
+    # Byte ảnh ~ số pixel (DPI^2) x hệ số theo chất lượng JPEG; phần không phải ảnh coi như giữ nguyên
+    dpi, quality = TARGET_SIZE_LEVELS[index]
+    ratio = min(1.0, (dpi / median_dpi) ** 2) * (quality / TARGET_SIZE_LEVELS[0][1]) ** 1.3 if median_dpi else 1.0
+    return file_bytes - image_bytes + image_bytes * ratio * correction
+
+def _pick_target_level(goal, low, high, model):
+    # Mức chất lượng cao nhất trong [low, high] mà model dự đoán vừa mục tiêu; không mức nào vừa thì lấy mức thấp nhất
+    return next((index for index in range(low, high + 1) if model(index) <= goal), high)
+
+def compress_pdf_to_target(input_path, output_path, target_bytes, scratch_path):
+    file_bytes = os.path.getsize(input_path)
+    if file_bytes <= target_bytes: # Đã dưới mục tiêu: bản gốc là chất lượng cao nhất
+        shutil.copyfile(input_path, output_path); return {'target_met': True, 'level': 'original', 'size': file_bytes}
+    input_hash = known_input_hash(input_path) or file_sha256(input_path) # Băm 1 lần; key single_flight của mọi lần thử dựng từ hash này
+    image_bytes, median_dpi = analyze_pdf_image_bytes(input_path)
+    page_count = get_pdf_page_count(input_path)
+    if page_count > TARGET_SIZE_SAMPLE_PAGES: # Trang mẫu rải đều cả file
+        step = page_count / TARGET_SIZE_SAMPLE_PAGES
+        sample_path = extract_pdf_pages(input_path, scratch_path("target_sample.pdf"), sorted({int(step * index + step / 2) + 1 for index in range(TARGET_SIZE_SAMPLE_PAGES)}))
+    else: sample_path = input_path # File ngắn: lần thử chính là lần nén thật
+    # Trang mẫu chỉ phụ thuộc input + TARGET_SIZE_SAMPLE_PAGES; dpi/quality của từng lần thử đã nằm trong key single_flight
+    sample_hash = input_hash if sample_path == input_path else f"{input_hash}:sample{TARGET_SIZE_SAMPLE_PAGES}"
+    sample_bytes = os.path.getsize(sample_path)
+    trial_outputs = {}
+
+    def run_level(index, source_path, name):
+        dpi, quality = TARGET_SIZE_LEVELS[index]; level_output = scratch_path(f"{name}_{dpi}_{quality}.pdf")
+        compress_pdf_images(source_path, level_output, target_dpi=dpi, jpeg_quality=quality, flight_hash=sample_hash if source_path == sample_path else input_hash)
+        return level_output
+
+    # Thu hẹp khoảng [low, high] như tìm nhị phân, nhưng mỗi lần thử chọn mức theo model đã hiệu chỉnh bằng kết quả thử trước
+    goal = target_bytes * TARGET_SIZE_MARGIN; low, high = 0, len(TARGET_SIZE_LEVELS) - 1; best = None; correction = 1.0; tried = set()
+    model = lambda index: _target_model_bytes(index, file_bytes, image_bytes, median_dpi, correction)
+    probe = _pick_target_level(goal, low, high, model)
+    logger.info(f"Target size {target_bytes} bytes for {file_bytes}-byte PDF: images {image_bytes} bytes (median {median_dpi and round(median_dpi)} DPI), starting at level {probe}")
+    for _ in range(TARGET_SIZE_MAX_TRIALS):
+        trial_output = run_level(probe, sample_path, "target_trial"); tried.add(probe)
+        if sample_path == input_path: trial_outputs[probe] = trial_output
+        predicted = file_bytes * os.path.getsize(trial_output) / sample_bytes
+        logger.info(f"Target size trial level {probe} {TARGET_SIZE_LEVELS[probe]}: predicted {predicted:.0f} bytes")
+        modeled_images = _target_model_bytes(probe, file_bytes, image_bytes, median_dpi) - (file_bytes - image_bytes)
+        if modeled_images > 0 and predicted > file_bytes - image_bytes: correction = (predicted - (file_bytes - image_bytes)) / modeled_images
+        if predicted <= goal: best = probe; high = probe - 1
+        else: low = probe + 1
+        if low > high: break
+        probe = _pick_target_level(goal, low, high, model)
+        if probe in tried: break
+    chosen = best if best is not None else min(low, len(TARGET_SIZE_LEVELS) - 1)
+
+    result_path = result_size = None
+    for _ in range(TARGET_SIZE_MAX_FULL_RUNS):
+        result_path = trial_outputs.get(chosen) or run_level(chosen, input_path, "target_full"); result_size = os.path.getsize(result_path)
+        if result_size <= target_bytes or chosen == len(TARGET_SIZE_LEVELS) - 1: break
+        chosen += 1 # Mẫu đoán hụt: hạ thêm một mức
+    result = {'target_met': result_size <= target_bytes, 'level': TARGET_SIZE_LEVELS[chosen], 'size': result_size}
+    if not result['target_met'] and get_gs_path():
+        # Nén ảnh không đủ (PDF nhiều vector/font): thử Ghostscript mức thấp nhất một lần, lấy file nhỏ hơn
+        try:
+            gs_output = scratch_path("target_gs.pdf"); compress_pdf_ghostscript(input_path, gs_output, 'low', flight_hash=input_hash)
+            if os.path.getsize(gs_output) < result_size:
+                result_path = gs_output; result = {'target_met': os.path.getsize(gs_output) <= target_bytes, 'level': 'ghostscript', 'size': os.path.getsize(gs_output)}
+        except RuntimeError as gs_err: logger.warning(f"Ghostscript fallback for target size failed: {gs_err}")
+    shutil.move(result_path, output_path)
+    logger.info(f"Target size {target_bytes}: {'met' if result['target_met'] else 'NOT met'} with {result['level']} ({result['size']} bytes)")
+    return result
+
+
+#Thư mục làm việc riêng cho từng job: input, file trung gian và output của một job nằm chung một thư mục,
+#dọn bằng một lần rmtree. Job nhỏ (<= TMPFS_SPOOL_THRESHOLD) nằm trên tmpfs trong giới hạn TMPFS_RAM_BUDGET
+#dùng chung cho cả process; job lớn hoặc khi hết budget thì dùng đĩa. Engine vẫn nhận đường dẫn thật.
+JOBS_FOLDER = os.path.join(UPLOAD_FOLDER, 'jobs')
+TMPFS_JOBS_FOLDER = os.environ.get('TMPFS_JOBS_FOLDER', os.path.join('/dev/shm', 'convert_all_files_jobs') if os.path.isdir('/dev/shm') else '')
+TMPFS_SPOOL_THRESHOLD = int(os.environ.get('TMPFS_SPOOL_THRESHOLD', 16 * 1024 * 1024)) # Input lớn hơn ngưỡng này -> đĩa
+TMPFS_RAM_BUDGET = int(os.environ.get('TMPFS_RAM_BUDGET', 256 * 1024 * 1024)) # Tổng RAM tối đa các workspace tmpfs được giữ
+WORKSPACE_SIZE_FACTOR = 4 # Ước lượng dung lượng job cần = input x 4 (input, trung gian, output)
+WORKSPACE_MIN_RESERVE = 1024 * 1024 # Không biết content length thì vẫn giữ chỗ tối thiểu
+TMPFS_MIN_FREE_BYTES = 64 * 1024 * 1024
+LO_PROFILE_FOLDER = os.path.join(tempfile.gettempdir(), 'convert_all_files_lo_profiles')
+_lo_profile_pool = queue.LifoQueue()
+_lo_profile_counter = itertools.count()
+_ram_budget_lock = threading.Lock()
+_ram_budget_state = {'reserved': 0, 'active_workspaces': 0, 'spilled': 0}
+
+def _reserve_ram(nbytes):
+    with _ram_budget_lock:
+        if _ram_budget_state['reserved'] + nbytes > TMPFS_RAM_BUDGET: return False
+        _ram_budget_state['reserved'] += nbytes; return True
+
+def _release_ram(nbytes):
+    with _ram_budget_lock: _ram_budget_state['reserved'] = max(0, _ram_budget_state['reserved'] - nbytes)
+
+def get_spool_stats():
+    with _ram_budget_lock: stats = dict(_ram_budget_state)
+    stats.update({'budget': TMPFS_RAM_BUDGET, 'threshold': TMPFS_SPOOL_THRESHOLD, 'tmpfs_folder': TMPFS_JOBS_FOLDER or None})
+    return stats
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try: total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError: pass
+    return total
+
+def _pick_workspace_root(expected_bytes):
+    # Trả về (thư mục gốc, số byte RAM đã giữ chỗ)
+    if TMPFS_JOBS_FOLDER and expected_bytes <= TMPFS_SPOOL_THRESHOLD:
+        reserve = max(expected_bytes, WORKSPACE_MIN_RESERVE) * WORKSPACE_SIZE_FACTOR
+        try:
+            tmpfs_free = shutil.disk_usage(os.path.dirname(TMPFS_JOBS_FOLDER)).free
+            if tmpfs_free - reserve > TMPFS_MIN_FREE_BYTES and _reserve_ram(reserve): return TMPFS_JOBS_FOLDER, reserve
+        except OSError as e: logger.debug(f"tmpfs check failed for {TMPFS_JOBS_FOLDER}: {e}")
+    return JOBS_FOLDER, 0
+
+class JobWorkspace:
+    def __init__(self, expected_bytes=0, prefix='job_', on_disk=False):
+        root, self.reserved = (JOBS_FOLDER, 0) if on_disk else _pick_workspace_root(expected_bytes)
+        self.prefix = prefix
+        try:
+            os.makedirs(root, exist_ok=True)
+            self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+        except Exception:
+            _release_ram(self.reserved); raise
+        self.on_tmpfs = root == TMPFS_JOBS_FOLDER; self.closed = False; self._previous_paths = []
+        with _ram_budget_lock: _ram_budget_state['active_workspaces'] += 1
+        logger.debug(f"Created job workspace {self.path} (tmpfs={self.on_tmpfs}, expected={expected_bytes} bytes, reserved={self.reserved})")
+    def file(self, name): return os.path.join(self.path, name)
+    def subdir(self, name):
+        path = os.path.join(self.path, name); os.makedirs(path, exist_ok=True); return path
+    def spool(self, path):
+        # Gọi sau khi ghi xong input. Nếu dung lượng thật vượt phần đã giữ chỗ thì xin thêm budget,
+        # vượt ngưỡng hoặc hết budget thì chuyển cả workspace xuống đĩa. Trả về đường dẫn (có thể đã đổi) của file.
+        if not self.on_tmpfs: return self.rebase(path)
+        usage = _dir_size(self.path); needed = usage * WORKSPACE_SIZE_FACTOR
+        if usage > TMPFS_SPOOL_THRESHOLD: return self._spill_to_disk(path, usage)
+        if needed > self.reserved:
+            if not _reserve_ram(needed - self.reserved): return self._spill_to_disk(path, usage)
+            self.reserved = needed
+        return path
+    def rebase(self, path):
+        # Đường dẫn lấy trước khi workspace bị chuyển xuống đĩa -> đường dẫn tương ứng hiện tại
+        for old_path in self._previous_paths:
+            if path.startswith(old_path + os.sep): return os.path.join(self.path, os.path.relpath(path, old_path))
+        return path
+    def _spill_to_disk(self, path, usage):
+        os.makedirs(JOBS_FOLDER, exist_ok=True)
+        disk_path = tempfile.mkdtemp(prefix=self.prefix, dir=JOBS_FOLDER)
+        for name in os.listdir(self.path): shutil.move(os.path.join(self.path, name), os.path.join(disk_path, name))
+        logger.info(f"Spilled job workspace {self.path} ({usage} bytes) to disk: {disk_path}")
+        relative = os.path.relpath(path, self.path)
+        safe_remove(self.path); _release_ram(self.reserved)
+        self._previous_paths.append(self.path)
+        self.path, self.reserved, self.on_tmpfs = disk_path, 0, False
+        with _ram_budget_lock: _ram_budget_state['spilled'] += 1
+        return os.path.join(disk_path, relative)
+    def cleanup(self):
+        removed = safe_remove(self.path)
+        if not self.closed:
+            self.closed = True; _release_ram(self.reserved); self.reserved = 0
+            with _ram_budget_lock: _ram_budget_state['active_workspaces'] -= 1
+        return removed
+    def __enter__(self): return self
+    def __exit__(self, exc_type, exc, tb): self.cleanup(); return False
+
+#Upload chia chunk (/upload/...) khi finalize sẽ gọi lại đúng view convert với file đã ghép sẵn trong workspace,
+#nên các route đọc file/form/workspace qua các hàm dưới thay vì request trực tiếp
+def request_files(): return g.get('chunked_files') or request.files
+def request_form(): return g.get('chunked_form') or request.form
+def new_job_workspace(): return g.pop('chunked_workspace', None) or JobWorkspace(request.content_length or 0)
+
+def _sweep_stale_workspaces(now, max_age):
+    removed = 0
+    with _upload_sessions_lock: live = {session['workspace'].path for session in _upload_sessions.values()} # Upload chunk còn đang chạy
+    for root in filter(None, {JOBS_FOLDER, TMPFS_JOBS_FOLDER, SINGLE_FLIGHT_FOLDER}):
+        try: names = os.listdir(root)
+        except OSError: continue
+        for name in names:
+            path = os.path.join(root, name)
+            if path in live: continue
+            try:
+                if now - os.stat(path).st_mtime > max_age and safe_remove(path): removed += 1
+            except FileNotFoundError: continue
+    return removed
+
+@contextlib.contextmanager
+def _libreoffice_profile():
+    # Mỗi tiến trình soffice chạy đồng thời cần UserInstallation riêng, nếu không chúng tranh nhau profile/lock.
+    # Profile được tái sử dụng qua pool nên chỉ lần đầu mỗi slot phải khởi tạo profile.
+    try: profile_dir = _lo_profile_pool.get_nowait()
+    except queue.Empty: profile_dir = os.path.join(LO_PROFILE_FOLDER, f"profile_{os.getpid()}_{next(_lo_profile_counter)}")
+    try: yield pathlib.Path(profile_dir).as_uri()
+    finally: _lo_profile_pool.put(profile_dir)
+
+@tracked_engine('libreoffice')
+def convert_with_libreoffice(input_path, output_path, target_ext):
+    soffice_path = get_soffice_path()
+    if not soffice_path: raise RuntimeError("err-libreoffice")
+    # LO đặt tên output theo tên input, nên cho nó một outdir riêng trong workspace rồi move sang output_path
+    lo_out_dir = tempfile.mkdtemp(prefix="lo_out_", dir=os.path.dirname(os.path.abspath(output_path)))
+    lo_output = os.path.join(lo_out_dir, f"{os.path.splitext(os.path.basename(input_path))[0]}.{target_ext}")
+    try:
+        with _libreoffice_profile() as profile_url:
+            cmd = [soffice_path, f'-env:UserInstallation={profile_url}', '--headless', '--convert-to', target_ext, '--outdir', lo_out_dir, input_path]
+            logger.info("Running LO (%s) on %s", target_ext, input_path)
+            if engine_logger.isEnabledFor(logging.DEBUG): engine_logger.debug("LO command: %s", ' '.join(cmd))
+            lo_timeout = job_timeout(LIBREOFFICE_TIMEOUT)
+            result = run_engine(cmd, lo_timeout, 'libreoffice')
+        if result.stdout and engine_logger.isEnabledFor(logging.DEBUG): engine_logger.debug("LO stdout (tail):\n%s", output_tail(result.stdout))
+        if result.stderr: engine_logger.warning("LO stderr (tail):\n%s", output_tail(result.stderr))
+        if os.path.exists(lo_output) and os.path.getsize(lo_output) > 0:
+            shutil.move(lo_output, output_path)
+            logger.info(f"LO conversion successful: {output_path}")
+            return True
+        if result.stderr and "error" in result.stderr.lower(): engine_logger.error("LO stderr indicates error during conversion (tail):\n%s", output_tail(result.stderr))
+        else: logger.error(f"LO ran but output '{lo_output}' missing/empty.")
+        raise RuntimeError("err-libreoffice")
+    except subprocess.TimeoutExpired: logger.error(f"LO timed out ({lo_timeout:.0f}s)."); raise RuntimeError("err-conversion-timeout")
+    except subprocess.CalledProcessError as lo_err:
+        logger.error(f"LO failed. RC: {lo_err.returncode}")
+        if lo_err.stdout: engine_logger.error("LO stdout (tail):\n%s", output_tail(lo_err.stdout))
+        if lo_err.stderr: engine_logger.error("LO stderr (tail):\n%s", output_tail(lo_err.stderr))
+        raise RuntimeError("err-libreoffice")
+    except FileNotFoundError: logger.error(f"LO not found: {soffice_path}"); raise RuntimeError("err-libreoffice")
+    except RuntimeError: raise
+    except Exception as lo_run_err: logger.error(f"Unexpected LO error: {lo_run_err}", exc_info=True); raise RuntimeError("err-libreoffice")
+    finally: safe_remove(lo_out_dir)
+
+@single_flight
+@tracked_engine('pdf2docx')
+@offload_cpu
+def convert_pdf_to_docx_pdf2docx(input_path, output_path, pages=None):
+    cv = None
+    try:
+        logger.info(f"Starting pdf2docx for {input_path}" + (f" (pages {format_page_runs(pages)})" if pages else ""))
+        cv = pdf2docx.Converter(input_path)
+        if pages: cv.convert(output_path, pages=[page - 1 for page in pages]) # pdf2docx đánh số trang từ 0
+        else: cv.convert(output_path)
+        cv.close()
+    except Exception as pdf2docx_err:
+        err_str = str(pdf2docx_err).lower()
+        if "encrypted" in err_str or "password" in err_str or "decrypt" in err_str or "err-pdf-protected" in err_str: raise ValueError("err-pdf-protected")
+        elif "corrupt" in err_str or "eof marker" in err_str or "invalid" in err_str or "err-pdf-corrupt" in err_str: raise ValueError("err-pdf-corrupt")
+        elif "no pages" in err_str or "err-pdf-no-pages" in err_str: raise ValueError("err-pdf-no-pages")
+        logger.error(f"pdf2docx failed for {input_path}: {pdf2docx_err}", exc_info=True); raise RuntimeError("err-conversion")
+    finally:
+        if cv:
+             try: cv.close()
+             except Exception: pass
+    if os.path.isfile(output_path) and os.path.getsize(output_path) > 0:
+        logger.info(f"pdf2docx successful: {output_path}")
+        return True
+    logger.error(f"pdf2docx ran but output file is missing or empty: {output_path}")
+    raise RuntimeError("err-conversion")
+
+
+#PDF -> DOCX mode=text: chỉ lấy đoạn văn, tiêu đề, đậm/nghiêng và ảnh inline bằng text extraction của PyMuPDF rồi ghi bằng python-docx.
+#Không dựng lại layout/bảng/shape như pdf2docx nên rẻ hơn nhiều; đọc từng trang, chỉ giữ dữ liệu của 1 trang trong RAM.
+PDF_TEXT_HEADING_RATIOS = ((1.6, 1), (1.3, 2), (1.15, 3)) # cỡ chữ / cỡ chữ thân bài -> mức heading
+PDF_TEXT_HEADING_MAX_CHARS = 200
+PDF_TEXT_SAMPLE_PAGES = 20 # Số trang đầu dùng để tìm cỡ chữ thân bài
+PDF_TEXT_MIN_IMAGE_POINTS = 24 # Bỏ ảnh nhỏ hơn (icon, đường kẻ)
+PDF_TEXT_MAX_IMAGE_WIDTH = 6.0 # inch, vừa lề trang A4/Letter mặc định
+DOCX_IMAGE_EXTS = ('png', 'jpeg', 'jpg', 'gif', 'bmp', 'tiff')
+_FITZ_FLAG_ITALIC, _FITZ_FLAG_BOLD = 2, 16
+
+def _pdf_body_font_size(document, pages):
+    sizes = collections.Counter()
+    for page_number in pages[:PDF_TEXT_SAMPLE_PAGES]:
+        for block in document.load_page(page_number - 1).get_text('dict', flags=0)['blocks']:
+            for line in block.get('lines', ()):
+                for span in line['spans']: sizes[round(span['size'])] += len(span['text'].strip())
+    return sizes.most_common(1)[0][0] if sizes else 11
+
+def _add_pdf_text_block(document, block, body_size):
+    lines = [[span for span in line['spans'] if span['text']] for line in block['lines']]
+    lines = [line for line in lines if line]
+    text = ' '.join(''.join(span['text'] for span in line).strip() for line in lines).strip()
+    if not text: return
+    largest = max(span['size'] for line in lines for span in line)
+    level = next((level for ratio, level in PDF_TEXT_HEADING_RATIOS if largest >= body_size * ratio), None)
+    if level and len(text) <= PDF_TEXT_HEADING_MAX_CHARS: document.add_heading(text, level=level); return
+    paragraph = document.add_paragraph()
+    for index, line in enumerate(lines):
+        for position, span in enumerate(line):
+            span_text = span['text'].lstrip() if position == 0 else span['text']
+            if position == len(line) - 1:
+                span_text = span_text.rstrip()
+                # Nối dòng: bỏ gạch nối cuối dòng, còn lại thêm khoảng trắng
+                if index < len(lines) - 1:
+                    if span_text.endswith('-') and len(span_text) > 1 and span_text[-2].isalpha(): span_text = span_text[:-1]
+                    else: span_text += ' '
+            if not span_text: continue
+            run = paragraph.add_run(span_text)
+            run.bold = bool(span['flags'] & _FITZ_FLAG_BOLD) or 'bold' in span['font'].lower() or None
+            run.italic = bool(span['flags'] & _FITZ_FLAG_ITALIC) or None
+            if abs(span['size'] - body_size) >= 1.5: run.font.size = docx_shared.Pt(round(span['size'], 1))
+
+def _add_pdf_image_block(document, block):
+    width = block['bbox'][2] - block['bbox'][0]; height = block['bbox'][3] - block['bbox'][1]
+    if width < PDF_TEXT_MIN_IMAGE_POINTS or height < PDF_TEXT_MIN_IMAGE_POINTS or not block.get('image'): return
+    data = block['image']
+    if block.get('ext', '').lower() not in DOCX_IMAGE_EXTS:
+        try: # JPX/JBIG2...: python-docx không nhận -> chuyển PNG
+            buffer = BytesIO(); Image.open(BytesIO(data)).save(buffer, 'PNG'); data = buffer.getvalue()
+        except Exception as image_err: logger.debug("Skipping PDF image (%s): %s", block.get('ext'), image_err); return
+    try: document.add_picture(BytesIO(data), width=docx_shared.Inches(min(PDF_TEXT_MAX_IMAGE_WIDTH, width / 72)))
+    except Exception as image_err: logger.debug("Skipping PDF image: %s", image_err)
+
+@single_flight
+@tracked_engine('pymupdf')
+@offload_cpu
+def convert_pdf_to_docx_text(input_path, output_path, pages=None):
+    logger.info(f"Starting text-mode PDF->DOCX for {input_path}" + (f" (pages {format_page_runs(pages)})" if pages else ""))
+    try: pdf_document = fitz.open(input_path)
+    except Exception as open_err: logger.error(f"PyMuPDF could not open {input_path}: {open_err}"); raise ValueError("err-pdf-corrupt") from open_err
+    try:
+        if pdf_document.needs_pass: raise ValueError("err-pdf-protected")
+        if pdf_document.page_count == 0: raise ValueError("err-pdf-no-pages")
+        pages = pages or list(range(1, pdf_document.page_count + 1))
+        body_size = _pdf_body_font_size(pdf_document, pages)
+        document = docx.Document()
+        for page_number in pages:
+            page = pdf_document.load_page(page_number - 1)
+            for block in page.get_text('dict', flags=fitz.TEXT_PRESERVE_IMAGES | fitz.TEXT_PRESERVE_WHITESPACE, sort=True)['blocks']:
+                if block['type'] == 0: _add_pdf_text_block(document, block, body_size)
+                elif block['type'] == 1: _add_pdf_image_block(document, block)
+            page = None
+        document.save(output_path)
+    except ValueError: raise
+    except Exception as text_err: logger.error(f"Text-mode PDF->DOCX failed for {input_path}: {text_err}", exc_info=True); raise RuntimeError("err-conversion") from text_err
+    finally: pdf_document.close()
+    logger.info(f"Text-mode PDF->DOCX successful: {output_path}")
+    return True
+
+#Đồ thị chuyển đổi: mỗi converter khai báo định dạng vào -> ra, hàm chạy và loại chi phí (COST_PRIORS). Planner tìm chuỗi
+#converter rẻ nhất (Dijkstra) theo đặc trưng input và hệ số hiệu chỉnh học từ thời gian thực tế của từng converter;
+#DOCX/PPT đã có PDF trong cache (preview/lần convert trước) thì bước đó gần như miễn phí. Bước lỗi (không do input)
+#thì loại converter đó và chạy chuỗi rẻ nhất tiếp theo. Thêm engine = thêm một register_converter, không sửa route.
+#'pdf-min' là PDF đã nén bằng Ghostscript (compress_docx bắt buộc đi qua định dạng này); 'docx-text' là DOCX chỉ có văn bản (mode=text).
+CONVERTERS = []
+CACHED_STEP_COST = 0.05 # Giây, bước đọc lại kết quả đã cache
+PLAN_INPUT_ERRORS = ("err-pdf-corrupt", "err-pdf-protected", "err-pdf-no-pages", "err-invalid-pages") # Lỗi do input: thử chuỗi khác cũng vô ích
+
+class Converter:
+    def __init__(self, name, sources, target, run, cost_kind, available=None, missing_error="err-conversion", pages=False, cached=None):
+        self.name = name; self.sources = sources; self.target = target; self.run = run; self.cost_kind = cost_kind
+        self.available = available or (lambda: True); self.missing_error = missing_error
+        self.pages = pages # run() tự chọn trang được; nếu không, planner tách trang trước khi gọi
+        self.cached = cached # cached(context) -> True nếu kết quả đã có sẵn
+    def estimate(self, features, selected_pages=None, context=None):
+        if context is not None and self.cached and self.cached(context): return CACHED_STEP_COST
+        return predict_job_cost(self.cost_kind, features, selected_pages, correction_key=f"converter:{self.name}")
+
+def register_converter(name, sources, target, run, cost_kind, **kwargs):
+    converter = Converter(name, tuple(sources), target, run, cost_kind, **kwargs)
+    CONVERTERS.append(converter)
+    return converter
+
+def _format_ext(fmt): return fmt.split('-', 1)[0]
+
+def _context_hash(context):
+    if not context.get('content_hash'): context['content_hash'] = file_sha256(context['input_path'])
+    return context['content_hash']
+
+def plan_conversion(source, target, features, selected_pages=None, context=None, via=None, exclude=(), require_available=True):
+    # Trạng thái = (định dạng, đã đi qua 'via' chưa). Trả về (chi phí ước lượng, [Converter, ...]) hoặc None
+    heap = [(0.0, 0, source, via is None, [])]; sequence = itertools.count(1); settled = set()
+    while heap:
+        cost, _, fmt, passed, steps = heapq.heappop(heap)
+        if steps:
+            if fmt == target and passed: return cost, steps
+            if (fmt, passed) in settled: continue
+            settled.add((fmt, passed))
+        for converter in CONVERTERS:
+            if fmt not in converter.sources or converter.name in exclude or converter in steps or (require_available and not converter.available()): continue
+            # Cache chỉ áp dụng cho bước đầu (cùng nội dung với file upload)
+            step_cost = converter.estimate(features, selected_pages, context if not steps else None)
+            heapq.heappush(heap, (cost + step_cost, next(sequence), converter.target, passed or converter.target == via, steps + [converter]))
+    return None
+
+def _execute_plan(steps, source, input_path, output_path, scratch_path, pages_spec, pages, features, context, failed_step):
+    current, current_fmt, pages_done = input_path, source, not pages_spec and not pages
+    for index, converter in enumerate(steps):
+        failed_step[0] = converter
+        step_output = output_path if index == len(steps) - 1 else scratch_path(f"plan_{index}_{converter.name}.{_format_ext(converter.target)}")
+        step_pages = None
+        if not pages_done and current_fmt.startswith('pdf'):
+            # Số trang của DOCX/PPT chỉ biết sau khi render -> chọn trang ở bước đầu tiên có input là PDF
+            pages = pages or parse_page_ranges(pages_spec, get_pdf_page_count(current)); pages_done = True
+            if pages and converter.pages: step_pages = pages
+            elif pages: current = extract_pdf_pages(current, scratch_path(f"plan_{index}_pages.pdf"), pages)
+        cached = index == 0 and converter.cached and converter.cached(context)
+        predicted = converter.estimate(features, len(pages) if pages else None); started = time.time()
+        if not converter.run(current, step_output, step_pages, context): raise RuntimeError("err-conversion")
+        if not cached: observe_job_cost(f"converter:{converter.name}", predicted, time.time() - started)
+        current, current_fmt = step_output, converter.target
+    if not pages_done and current_fmt.startswith('pdf'):
+        pages = pages or parse_page_ranges(pages_spec, get_pdf_page_count(current))
+        if pages:
+            full_path = scratch_path("plan_full_output.pdf"); shutil.move(current, full_path); extract_pdf_pages(full_path, output_path, pages)
+    return True
+
+def run_conversion_plan(source, target, input_path, output_path, scratch_path, pages_spec='', pages=None, via=None, content_hash=None, options=None, exclude=()):
+    # Chạy chuỗi rẻ nhất; lỗi engine -> bỏ converter lỗi, lập lại kế hoạch. scratch_path(name) -> đường dẫn file trung gian
+    features = inspect_input_features(input_path)
+    context = dict(options or {}, input_path=input_path, content_hash=content_hash)
+    failed, last_error = set(exclude), None
+    while True:
+        plan = plan_conversion(source, target, features, len(pages) if pages else None, context, via, failed)
+        if not plan:
+            if last_error: raise RuntimeError(last_error)
+            # Báo engine thiếu trên chuỗi rẻ nhất nếu có đủ engine (kể cả bước trung gian, vd. ghostscript của pdf-min khi compress_docx)
+            ideal = plan_conversion(source, target, features, len(pages) if pages else None, context, via, set(exclude), require_available=False)
+            missing = [converter for converter in (ideal[1] if ideal else []) if not converter.available()]
+            raise RuntimeError(missing[0].missing_error if missing else "err-conversion")
+        cost, steps = plan
+        logger.info(f"Conversion plan {source}->{target}: {' -> '.join(converter.name for converter in steps)} (estimated {cost:.1f}s)")
+        failed_step = [None]
+        try: return _execute_plan(steps, source, input_path, output_path, scratch_path, pages_spec, pages, features, context, failed_step)
+        except (ValueError, RuntimeError) as step_err:
+            error_key = str(step_err) if str(step_err).startswith("err-") else "err-conversion"
+            if error_key in PLAN_INPUT_ERRORS or failed_step[0] is None: raise
+            logger.warning(f"Converter {failed_step[0].name} failed ({error_key}), re-planning without it")
+            failed.add(failed_step[0].name); last_error = error_key
+            safe_remove(output_path)
+
+_soffice_available = lambda: bool(get_soffice_path())
+register_converter('pdf2docx', ('pdf', 'pdf-min'), 'docx', lambda src, dst, pages, context: convert_pdf_to_docx_pdf2docx(src, dst, pages), 'pdf_to_docx', pages=True)
+register_converter('pymupdf-text', ('pdf', 'pdf-min'), 'docx-text', lambda src, dst, pages, context: convert_pdf_to_docx_text(src, dst, pages), 'pdf_to_docx_text', pages=True)
+register_converter('libreoffice-pdf', ('docx', 'ppt', 'pptx'), 'pdf', lambda src, dst, pages, context: convert_office_to_pdf_cached(src, dst, content_hash=_context_hash(context)), 'office_to_pdf',
+                   available=_soffice_available, missing_error="err-libreoffice", cached=lambda context: get_preview_source(_context_hash(context)) is not None)
+register_converter('pptx-images', ('pdf',), 'pptx', lambda src, dst, pages, context: convert_pdf_to_pptx_python(src, dst, pages), 'pdf_to_ppt', pages=True)
+register_converter('libreoffice-pptx', ('pdf',), 'pptx', lambda src, dst, pages, context: convert_with_libreoffice(src, dst, 'pptx'), 'pdf_to_ppt_libreoffice',
+                   available=_soffice_available, missing_error="err-libreoffice")
+register_converter('ghostscript', ('pdf',), 'pdf-min', lambda src, dst, pages, context: compress_pdf_ghostscript(src, dst, context.get('quality', 'medium'), pages=pages), 'compress_pdf',
+                   available=lambda: bool(get_gs_path()), missing_error="err-gs-missing", pages=True)
+register_converter('pymupdf-images', ('pdf',), 'pdf-min', lambda src, dst, pages, context: compress_pdf_images(src, dst, context.get('quality', 'medium'), pages=pages), 'compress_pdf_images', pages=True)
+
+def compress_engine_exclusions(quality, engine=None):
+    # Engine nén (mặc định theo COMPRESS_PDF_ENGINES) -> converter bị loại khỏi planner
+    return {'images': ('ghostscript',), 'ghostscript': ('pymupdf-images',)}.get(engine or COMPRESS_PDF_ENGINES.get(quality, 'auto'), ())
 
 @app.errorhandler(CSRFError)
 def handle_csrf_error(e): logger.warning(f"CSRF failed: {e.description}"); return make_error_response("err-csrf-invalid", 400)
@@ -790,6 +2210,14 @@ def get_translations():
             'lang-compress-title': 'Compress PDF', 'lang-compress-desc': 'Reduce PDF file size while optimizing for quality',
             'lang-compress-input-label': 'Select PDF file', 'lang-compress-btn': 'Compress PDF',
             'lang-compressing': 'Compressing PDF...', 'lang-select-quality': 'Compression Level',
+            'lang-pages-label': 'Pages (optional)', 'lang-pages-placeholder': 'All pages, e.g. 1-5,8,10-',
+            'lang-target-size-label': 'Target size in MB (optional)', 'lang-target-size-placeholder': 'e.g. 2 for under 2 MB',
+            'lang-docx-mode-label': 'Word output (PDF → DOCX)', 'lang-docx-mode-layout': 'Keep layout', 'lang-docx-mode-text': 'Text only (faster)',
+            'lang-image-format-label': 'Image format (PDF input)', 'lang-color-mode-label': 'Colour', 'lang-dpi-label': 'Resolution', 'lang-page-size-label': 'Page size (images)',
+            'lang-image-optimize-label': 'Shrink photos on this device before upload (faster on mobile)', 'lang-uploading': 'Uploading', 'lang-preparing-upload': 'Preparing files...',
+            'lang-page-size-fit': 'Fit image', 'lang-page-size-a4': 'A4', 'lang-page-size-letter': 'Letter',
+            'lang-color-color': 'Colour', 'lang-color-gray': 'Grayscale', 'lang-color-mono': 'Black & white (1-bit)',
+            'lang-dpi-72': '72 DPI (thumbnail)', 'lang-dpi-150': '150 DPI (screen)', 'lang-dpi-200': '200 DPI (default)', 'lang-dpi-300': '300 DPI (print / OCR)',
             'lang-quality-low': 'Low Quality (Smallest Size)',
             'lang-quality-medium': 'Medium Quality (Good Balance)',
             'lang-quality-high': 'High Quality (Less Compression)',
@@ -812,7 +2240,7 @@ def get_translations():
             'err-image-format': 'Invalid file type. Select PDF, JPG, or JPEG based on conversion.',
             'err-image-single-pdf': 'Please select only one PDF file to convert to images.',
             'err-image-all-images': 'If selecting multiple files, all must be JPG or JPEG to convert to PDF.',
-            'err-libreoffice': 'Conversion failed (Processing engine error - LO).', 'err-conversion-timeout': 'Processing timed out.',
+            'err-libreoffice': 'Conversion failed (Processing engine error - LO).', 'err-conversion-timeout': 'Processing timed out.', 'err-server-busy': 'The server is busy. Please try again in a few minutes.',
             'err-poppler-missing': 'PDF processing library (Poppler) missing or failed.',
             'err-pdf-corrupt': 'Could not process PDF (corrupt file?).', 'err-unknown': 'An unexpected error occurred. Please try again later.',
             'err-csrf-invalid': 'Security validation failed. Please refresh the page and try again.',
@@ -825,7 +2253,9 @@ def get_translations():
             'err-conversion-img': 'Failed to convert/extract images from PDF.',
             'err-gs-missing': 'Compression engine (Ghostscript) not available.',
             'err-gs-failed': 'Compression failed (Ghostscript error). Check if PDF is valid/not protected.',
-            'err-gs-timeout': 'Compression timed out.', 'err-invalid-quality': 'Invalid compression quality selected.',
+            'err-gs-timeout': 'Compression timed out.', 'err-invalid-quality': 'Invalid compression quality selected.', 'err-invalid-pages': 'Invalid page selection. Use page numbers and ranges within the document, e.g. 1-5,8,10-.', 'err-invalid-image-options': 'Invalid image options. Black & white is available for PNG and TIFF only; DPI must be between 36 and 600.', 'err-invalid-target-size': 'Invalid target size. Enter a size of at least 10 KB.', 'err-target-size-not-met': 'The file could not be compressed below the target size; the smallest achievable version was downloaded.',
+            'err-download-expired': 'This download link has expired. Please convert the file again.', 'err-preview-expired': 'Preview expired. Please select the file again.',
+            'err-upload-expired': 'The upload session has expired. Please upload the file again.', 'err-upload-limit': 'Too many unfinished uploads. Finish or cancel one and try again.', 'err-upload-offset': 'Upload position mismatch.', 'err-upload-chunk': 'Invalid upload chunk.', 'err-upload-checksum': 'Upload data was corrupted in transit. Please retry.',
             'lang-clear-all': 'Clear All', 'lang-upload-a-file': 'Upload files',
             'lang-drag-drop': 'or drag and drop', 'lang-image-types': 'PDF, JPG, JPEG up to 100MB total',
             'lang-compress-docx-title': 'Compress Word',
@@ -841,6 +2271,14 @@ def get_translations():
             'lang-compress-title': 'Nén PDF', 'lang-compress-desc': 'Giảm dung lượng tệp PDF mà vẫn tối ưu chất lượng',
             'lang-compress-input-label': 'Chọn tệp PDF', 'lang-compress-btn': 'Nén PDF',
             'lang-compressing': 'Đang nén PDF...', 'lang-select-quality': 'Mức độ nén',
+            'lang-pages-label': 'Trang (tùy chọn)', 'lang-pages-placeholder': 'Tất cả các trang, ví dụ 1-5,8,10-',
+            'lang-target-size-label': 'Dung lượng mục tiêu, MB (tùy chọn)', 'lang-target-size-placeholder': 'vd. 2 để dưới 2 MB',
+            'lang-docx-mode-label': 'Kết quả Word (PDF → DOCX)', 'lang-docx-mode-layout': 'Giữ bố cục', 'lang-docx-mode-text': 'Chỉ văn bản (nhanh hơn)',
+            'lang-image-format-label': 'Định dạng ảnh (khi tải PDF)', 'lang-color-mode-label': 'Màu', 'lang-dpi-label': 'Độ phân giải', 'lang-page-size-label': 'Khổ trang (ảnh)',
+            'lang-image-optimize-label': 'Thu nhỏ ảnh ngay trên máy trước khi tải lên (nhanh hơn trên điện thoại)', 'lang-uploading': 'Đang tải lên', 'lang-preparing-upload': 'Đang chuẩn bị tệp...',
+            'lang-page-size-fit': 'Theo ảnh', 'lang-page-size-a4': 'A4', 'lang-page-size-letter': 'Letter',
+            'lang-color-color': 'Màu', 'lang-color-gray': 'Thang xám', 'lang-color-mono': 'Đen trắng (1 bit)',
+            'lang-dpi-72': '72 DPI (ảnh nhỏ)', 'lang-dpi-150': '150 DPI (màn hình)', 'lang-dpi-200': '200 DPI (mặc định)', 'lang-dpi-300': '300 DPI (in / OCR)',
             'lang-quality-low': 'Nén Mạnh (Nhẹ Nhất)',
             'lang-quality-medium': 'Nén Vừa (Cân Bằng)',
             'lang-quality-high': 'Nén Nhẹ (Nén Ít)',
@@ -863,7 +2301,7 @@ def get_translations():
             'err-image-format': 'Loại tệp không hợp lệ. Chọn PDF, JPG, hoặc JPEG tùy theo chuyển đổi.',
             'err-image-single-pdf': 'Vui lòng chỉ chọn một file PDF để chuyển đổi sang ảnh.',
             'err-image-all-images': 'Nếu chọn nhiều tệp, tất cả phải là JPG hoặc JPEG để chuyển đổi sang PDF.',
-            'err-libreoffice': 'Chuyển đổi thất bại (Lỗi bộ xử lý - LO).', 'err-conversion-timeout': 'Quá trình xử lý quá thời gian.',
+            'err-libreoffice': 'Chuyển đổi thất bại (Lỗi bộ xử lý - LO).', 'err-conversion-timeout': 'Quá trình xử lý quá thời gian.', 'err-server-busy': 'Máy chủ đang bận. Vui lòng thử lại sau vài phút.',
             'err-poppler-missing': 'Thiếu hoặc lỗi thư viện xử lý PDF (Poppler).',
             'err-pdf-corrupt': 'Không thể xử lý PDF (tệp lỗi?).', 'err-unknown': 'Đã xảy ra lỗi không mong muốn. Vui lòng thử lại sau.',
             'err-csrf-invalid': 'Xác thực bảo mật thất bại. Vui lòng tải lại trang và thử lại.',
@@ -876,7 +2314,9 @@ def get_translations():
             'err-conversion-img': 'Không thể chuyển đổi/trích xuất ảnh từ PDF.',
             'err-gs-missing': 'Không tìm thấy công cụ nén (Ghostscript).',
             'err-gs-failed': 'Nén thất bại (Lỗi Ghostscript). Kiểm tra PDF hợp lệ/không bị khóa.',
-            'err-gs-timeout': 'Nén quá thời gian.', 'err-invalid-quality': 'Đã chọn mức nén không hợp lệ.',
+            'err-gs-timeout': 'Nén quá thời gian.', 'err-invalid-quality': 'Đã chọn mức nén không hợp lệ.', 'err-invalid-pages': 'Chọn trang không hợp lệ. Nhập số trang hoặc khoảng trang trong tài liệu, ví dụ 1-5,8,10-.', 'err-invalid-image-options': 'Tùy chọn ảnh không hợp lệ. Đen trắng chỉ dùng được cho PNG và TIFF; DPI phải từ 36 đến 600.', 'err-invalid-target-size': 'Dung lượng mục tiêu không hợp lệ. Nhập tối thiểu 10 KB.', 'err-target-size-not-met': 'Không nén được xuống dưới dung lượng mục tiêu; đã tải về bản nhỏ nhất có thể.',
+            'err-download-expired': 'Liên kết tải xuống đã hết hạn. Vui lòng chuyển đổi lại tệp.', 'err-preview-expired': 'Bản xem trước đã hết hạn. Vui lòng chọn lại tệp.',
+            'err-upload-expired': 'Phiên tải lên đã hết hạn. Vui lòng tải tệp lên lại.', 'err-upload-limit': 'Quá nhiều lượt tải lên chưa hoàn tất. Hãy hoàn tất hoặc hủy bớt rồi thử lại.', 'err-upload-offset': 'Vị trí tải lên không khớp.', 'err-upload-chunk': 'Phần dữ liệu tải lên không hợp lệ.', 'err-upload-checksum': 'Dữ liệu tải lên bị lỗi khi truyền. Vui lòng thử lại.',
             'lang-clear-all': 'Xóa tất cả', 'lang-upload-a-file': 'Tải tệp lên',
             'lang-drag-drop': 'hoặc kéo và thả', 'lang-image-types': 'PDF, JPG, JPEG tối đa 100MB tổng',
             'lang-compress-docx-title': 'Nén Word',
@@ -893,32 +2333,111 @@ def get_translations():
 def index():
     try:
         translations_url = url_for('get_translations', _external=False)
-        gs_available = GS_PATH is not None
-        soffice_available = SOFFICE_PATH is not None
-        return render_template('index.html',
-                               translations_url=translations_url,
-                               gs_available=gs_available,
-                               soffice_available=soffice_available)
+        gs_available = get_gs_path() is not None
+        soffice_available = get_soffice_path() is not None
+        app_config = {'translations_url': translations_url, 'gs_available': gs_available, 'soffice_available': soffice_available,
+                      'pdf_page_sizes': PDF_PAGE_SIZES, # Web UI thu nhỏ ảnh trước khi upload theo cùng khổ trang/DPI với convert_images_to_pdf
+                      'image_worker_url': asset_url('image-worker.js')}
+        return render_template('index.html', app_config=app_config, assets_built=ASSETS_BUILT)
     except Exception as e:
         logger.error(f"Error rendering index page: {e}", exc_info=True)
         return make_error_response("err-unknown", 500)
 
+def _engine_status():
+    in_flight, last_success = get_job_stats()
+    status = {
+        'libreoffice': {'discovered': 'soffice' in _engine_paths, 'available': _engine_paths.get('soffice') is not None},
+        'ghostscript': {'discovered': 'gs' in _engine_paths, 'available': _engine_paths.get('gs') is not None},
+    }
+    for engine_name in set(in_flight) | set(last_success) | set(status):
+        engine_status = status.setdefault(engine_name, {'available': True})
+        engine_status['in_flight'] = in_flight.get(engine_name, 0)
+        engine_status['last_success_latency'] = last_success.get(engine_name, {}).get('latency')
+        engine_status['last_success_at'] = last_success.get(engine_name, {}).get('at')
+    with _job_stats_lock:
+        for engine_name, usage in _last_engine_usage.items(): status.setdefault(engine_name, {'available': True})['last_run'] = dict(usage)
+    return status
+
+def _disk_status():
+    disk_path = UPLOAD_FOLDER if os.path.isdir(UPLOAD_FOLDER) else os.path.dirname(UPLOAD_FOLDER)
+    try:
+        free_bytes = shutil.disk_usage(disk_path).free
+        return {'free_bytes': free_bytes, 'min_free_bytes': MIN_FREE_DISK_BYTES, 'ok': free_bytes >= MIN_FREE_DISK_BYTES}
+    except OSError as e:
+        logger.warning(f"disk_usage failed for {disk_path}: {e}")
+        return {'free_bytes': None, 'min_free_bytes': MIN_FREE_DISK_BYTES, 'ok': False}
+
+@app.route('/healthz')
+@limiter.exempt
+def healthz():
+    # Liveness: process còn phục vụ được request. Không chạm engine, template hay thư mục upload
+    return jsonify({'status': 'ok', 'uptime': round(time.time() - PROCESS_STARTED_AT, 1)})
+
+@app.route('/readyz')
+@limiter.exempt
+def readyz():
+    # Readiness: warm-up xong, hàng đợi job chưa quá ADMISSION_MAX_WAIT và còn dung lượng đĩa. Không render template, không probe lại engine
+    if ENGINE_WARMUP:
+        warmup_done = _warmup_state['done'].is_set(); warmup_status = 'done' if warmup_done else 'running'
+    else: # Engine được dò ở request đầu tiên cần tới nó
+        warmup_done = True; warmup_status = 'disabled' if 'soffice' in _engine_paths and 'gs' in _engine_paths else 'discovery pending'
+    engines = _engine_status()
+    jobs_in_flight = sum(engine_status.get('in_flight', 0) for engine_status in engines.values())
+    # Bão hòa = job medium/large mới sẽ bị admit_job từ chối (err-server-busy); mọi slot đều bận mà hàng đợi rỗng thì vẫn ready
+    queue_wait = _job_scheduler.queue_wait(); scheduler_stats = _job_scheduler.stats()
+    waiting_large = sum(scheduler_stats['lanes'][lane]['waiting'] for lane in JOB_LANES if lane != 'small')
+    full = scheduler_stats['max_waiting'] is not None and waiting_large >= scheduler_stats['max_waiting']
+    jobs = {'in_flight': jobs_in_flight, 'capacity': MAX_CONCURRENT_JOBS, 'waiting': scheduler_stats['waiting'],
+            'expected_wait': round(queue_wait, 1), 'max_wait': ADMISSION_MAX_WAIT, 'saturated': queue_wait >= ADMISSION_MAX_WAIT or full}
+    disk = _disk_status()
+    ready = warmup_done and not jobs['saturated'] and disk['ok']
+    status = {'ready': ready, 'warmup': warmup_status, 'engines': engines, 'jobs': jobs, 'disk': disk, 'spool': get_spool_stats(), 'logging': get_log_stats(), 'scheduler': get_cost_stats(), 'single_flight': get_single_flight_stats(), 'engine_pool': get_engine_pool_stats()}
+    if _warmup_state['error']: status['warmup_error'] = _warmup_state['error']
+    response = jsonify(status)
+    response.status_code = 200 if ready else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/download/<token>')
+@limiter.limit("120 per minute") # Cho phép client tải song song nhiều range
+def download_result(token):
+    try:
+        return make_download_response(token)
+    except RuntimeError as e:
+        logger.info("Download token not found or expired.")
+        return make_error_response(str(e), 404)
+
+@app.route('/result/lookup', methods=['POST'])
+@limiter.limit("60 per minute")
+def lookup_result():
+    # JSON {endpoint, sha256: [hash từng file theo thứ tự upload], fields: [[tên, giá trị], ...]} -> token tải nếu đã có kết quả
+    data = request.get_json(silent=True) or {}
+    endpoint, content_hashes, fields = data.get('endpoint'), data.get('sha256'), data.get('fields') or []
+    if endpoint not in CHUNKED_UPLOAD_ENDPOINTS or not isinstance(content_hashes, list) or not content_hashes or not isinstance(fields, list) \
+            or not all(isinstance(value, str) and CONTENT_HASH_PATTERN.match(value) for value in content_hashes) \
+            or not all(isinstance(field, list) and len(field) == 2 for field in fields):
+        return make_error_response("err-select-file", 400)
+    token = lookup_result_token(endpoint, content_hashes, fields)
+    if not token: return jsonify({'cached': False})
+    logger.info(f"Result lookup hit for /{endpoint} ({len(content_hashes)} input(s)), skipping upload")
+    return jsonify({'cached': True, 'download_url': url_for('download_result', token=token)})
+
 @app.route('/convert', methods=['POST'])
 @limiter.limit("10 per minute")
 def convert_file():
-    output_path = temp_libreoffice_output = input_path_for_process = None
-    saved_input_paths = []; actual_conversion_type = None; start_time = time.time()
+    output_path = input_path_for_process = workspace = None
+    actual_conversion_type = None; start_time = time.time()
     error_key = "err-conversion"; conversion_success = False
     response_to_send = None
     try:
-        if 'file' not in request.files: raise RuntimeError("err-select-file")
-        file = request.files['file']
+        if 'file' not in request_files(): raise RuntimeError("err-select-file")
+        file = request_files()['file']
         if not file or not file.filename: raise RuntimeError("err-select-file")
         filename = secure_filename(file.filename)
         file_ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
         allowed_office_ext = {'pdf', 'docx', 'ppt', 'pptx'}
         if not _allowed_file_extension(filename, allowed_office_ext): raise RuntimeError("err-invalid-mime-type")
-        actual_conversion_type = request.form.get('conversion_type')
+        actual_conversion_type = request_form().get('conversion_type')
         valid_conversion_types = ['pdf_to_docx', 'docx_to_pdf', 'pdf_to_ppt', 'ppt_to_pdf']
         if not actual_conversion_type or actual_conversion_type not in valid_conversion_types: raise RuntimeError("err-select-conversion")
         required_ext = []
@@ -930,7 +2449,11 @@ def convert_file():
              error_key_cv = "err-format-docx" if 'docx' in required_ext else "err-format-ppt" if 'ppt' in required_ext or 'pptx' in required_ext else "err-format-pdf"
              logger.warning(f"Ext mismatch: file '{filename}' ({file_ext}), required {required_ext} for type '{actual_conversion_type}'")
              raise RuntimeError(error_key_cv)
-        logger.info(f"Request /convert: file='{filename}', type='{actual_conversion_type}'")
+        pages_spec = request_form().get('pages', '').strip()
+        docx_mode = (request_form().get('mode') or 'layout').lower() # pdf_to_docx: 'layout' (pdf2docx) hoặc 'text' (chỉ văn bản, nhanh)
+        if docx_mode not in ('layout', 'text'): raise RuntimeError("err-select-conversion")
+        text_mode = actual_conversion_type == 'pdf_to_docx' and docx_mode == 'text'
+        logger.info(f"Request /convert: file='{filename}', type='{actual_conversion_type}'" + (f", pages='{pages_spec}'" if pages_spec else "") + (", mode='text'" if text_mode else ""))
         detected_mime = get_actual_mime_type(file) # Dùng hàm đã sửa
         if detected_mime: # Chỉ kiểm tra MIME nếu lấy được
              expected_mimes = []
@@ -948,145 +2471,39 @@ def convert_file():
                  elif not is_pdf_input: raise RuntimeError("err-invalid-mime-type")
 
         logger.info(f"MIME validated (or bypassed if unavailable) for {filename}: {detected_mime or 'Unavailable'}")
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        workspace = new_job_workspace()
         timestamp = time.strftime("%Y%m%d-%H%M%S")
-        input_filename_ts = f"input_{timestamp}_{filename}"
-        input_path_for_process = os.path.join(UPLOAD_FOLDER, input_filename_ts)
-        try: file.seek(0); file.save(input_path_for_process); saved_input_paths.append(input_path_for_process); logger.info(f"Input saved: {input_path_for_process}")
+        input_path_for_process = workspace.file(f"input_{filename}")
+        try: file.seek(0); file.save(input_path_for_process); input_path_for_process = workspace.spool(input_path_for_process); logger.info(f"Input saved: {input_path_for_process}")
         except Exception as save_err: logger.error(f"File save failed {filename}: {save_err}"); raise RuntimeError("err-unknown") from save_err
         base_name = filename.rsplit('.', 1)[0]
         out_ext_map = {'pdf_to_docx': 'docx', 'docx_to_pdf': 'pdf', 'pdf_to_ppt': 'pptx', 'ppt_to_pdf': 'pdf'}
         out_ext = out_ext_map.get(actual_conversion_type)
         output_filename = f"converted_{timestamp}_{secure_filename(base_name)}.{out_ext}"
-        output_path = os.path.join(UPLOAD_FOLDER, output_filename)
+        output_path = workspace.file(f"output.{out_ext}")
+        # Input PDF: kiểm tra trang đã chọn ngay, trước khi chạy engine
+        pages = parse_page_ranges(pages_spec, get_pdf_page_count(input_path_for_process)) if pages_spec and file_ext == 'pdf' else None
+        content_hash = remember_result_inputs('convert', [input_path_for_process], [getattr(file, 'content_hash', None)])[0]
+        cost_job = admit_job('office_to_pdf' if actual_conversion_type in ['docx_to_pdf', 'ppt_to_pdf'] else 'pdf_to_docx_text' if text_mode else actual_conversion_type, input_path_for_process, pages)
 
         try:
-            if actual_conversion_type == 'pdf_to_docx':
-                cv = None
-                try:
-                    logger.info(f"Starting pdf2docx for {input_path_for_process}")
-                    cv = Converter(input_path_for_process)
-                    cv.convert(output_path)
-                    cv.close()
-                    if os.path.isfile(output_path) and os.path.getsize(output_path) > 0:
-                        conversion_success = True
-                        logger.info(f"pdf2docx successful: {output_path}")
-                    else:
-                        logger.error(f"pdf2docx ran but output file is missing or empty: {output_path}")
-                        error_key = "err-conversion"
-                except (ValueError, RuntimeError, PDFPageCountError, PDFSyntaxError, Exception) as pdf2docx_err:
-                    err_str = str(pdf2docx_err).lower()
-                    if "encrypted" in err_str or "password" in err_str or "decrypt" in err_str or "err-pdf-protected" in err_str: error_key = "err-pdf-protected"
-                    elif "corrupt" in err_str or "eof marker" in err_str or "invalid" in err_str or "err-pdf-corrupt" in err_str: error_key = "err-pdf-corrupt"
-                    elif "no pages" in err_str or "err-pdf-no-pages" in err_str: error_key = "err-pdf-no-pages"
-                    else: logger.error(f"pdf2docx failed: {pdf2docx_err}", exc_info=True); error_key = "err-conversion"
-                finally:
-                    if cv:
-                         try: cv.close()
-                         except Exception: pass
-                if not conversion_success: raise RuntimeError(error_key)
-
-            elif actual_conversion_type in ['docx_to_pdf', 'ppt_to_pdf']:
-                if not SOFFICE_PATH: raise RuntimeError("err-libreoffice")
-                output_dir = os.path.dirname(output_path); input_file_ext_actual = os.path.splitext(input_path_for_process)[1].lower(); expected_lo_output_name = os.path.basename(input_path_for_process).replace(input_file_ext_actual, '.pdf'); temp_libreoffice_output = os.path.join(output_dir, expected_lo_output_name); safe_remove(temp_libreoffice_output)
-                cmd = [SOFFICE_PATH, '--headless', '--convert-to', 'pdf', '--outdir', output_dir, input_path_for_process]; logger.info(f"Running LO: {' '.join(cmd)}")
-                try:
-                    result = subprocess.run(cmd, check=True, timeout=LIBREOFFICE_TIMEOUT, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-                    logger.info(f"LO stdout:\n{result.stdout}")
-                    if result.stderr: logger.warning(f"LO stderr:\n{result.stderr}")
-                    if os.path.exists(temp_libreoffice_output) and os.path.getsize(temp_libreoffice_output) > 0:
-                        os.rename(temp_libreoffice_output, output_path)
-                        conversion_success = True
-                        logger.info(f"LO conversion successful: {output_path}")
-                    else:
-                         if result.stderr and "error" in result.stderr.lower():
-                              logger.error(f"LO stderr indicates error during conversion: {result.stderr}")
-                              error_key = "err-libreoffice"
-                         else:
-                              logger.error(f"LO ran but output '{temp_libreoffice_output}' missing/empty.")
-                              error_key = "err-libreoffice"
-
-                except subprocess.TimeoutExpired: logger.error(f"LO timed out ({LIBREOFFICE_TIMEOUT}s)."); error_key = "err-conversion-timeout"; safe_remove(temp_libreoffice_output)
-                except subprocess.CalledProcessError as lo_err:
-                    logger.error(f"LO failed. RC: {lo_err.returncode}")
-                    if lo_err.stdout: logger.error(f"LO stdout:\n{lo_err.stdout}")
-                    if lo_err.stderr: logger.error(f"LO stderr:\n{lo_err.stderr}")
-                    error_key = "err-libreoffice"
-                    safe_remove(temp_libreoffice_output)
-                except FileNotFoundError: logger.error(f"LO not found: {SOFFICE_PATH}"); error_key = "err-libreoffice"
-                except Exception as lo_run_err: logger.error(f"Unexpected LO error: {lo_run_err}", exc_info=True); error_key = "err-libreoffice"; safe_remove(temp_libreoffice_output)
-                if not conversion_success: raise RuntimeError(error_key)
-
-            elif actual_conversion_type == 'pdf_to_ppt':
-                 # Sử dụng hàm đã được cải thiện
-                 try:
-                     if convert_pdf_to_pptx_python(input_path_for_process, output_path):
-                         conversion_success = True
-                         error_key = None # Thành công, xóa error key
-                         logger.info("PDF->PPTX successful (Python image-based).")
-                     else:
-                         # Hàm trả về False, nhưng nên raise lỗi cụ thể bên trong hàm đó
-                         logger.error("convert_pdf_to_pptx_python returned False without raising exception.")
-                         error_key = "err-conversion" # Lỗi chung nếu hàm không raise
-                 except ValueError as ve: # Bắt lỗi cụ thể từ hàm con
-                      error_key = str(ve) if str(ve).startswith("err-") else "err-conversion"; logger.error(f"PDF->PPTX ValueError: {error_key}")
-                 except RuntimeError as rte:
-                      error_key = str(rte) if str(rte).startswith("err-") else "err-conversion"; logger.error(f"PDF->PPTX RuntimeError: {error_key}")
-                 except Exception as py_ppt_err:
-                      error_key = "err-unknown"; logger.error(f"Unexpected Python PDF->PPTX error: {py_ppt_err}", exc_info=True)
-
-                 can_fallback = ( not conversion_success and SOFFICE_PATH and error_key not in ["err-pdf-corrupt", "err-pdf-protected", "err-poppler-missing"] )
-                 if can_fallback:
-                    logger.info(f"Python PDF->PPTX failed ({error_key}), attempting LO fallback...")
-                    # Reset error key cho fallback
-                    error_key_fallback = "err-libreoffice"
-                    output_dir = os.path.dirname(output_path); input_file_ext_actual = os.path.splitext(input_path_for_process)[1].lower(); expected_lo_output_name = os.path.basename(input_path_for_process).replace(input_file_ext_actual, '.pptx'); temp_libreoffice_output = os.path.join(output_dir, expected_lo_output_name); safe_remove(temp_libreoffice_output)
-                    cmd = [SOFFICE_PATH, '--headless', '--convert-to', 'pptx', '--outdir', output_dir, input_path_for_process]; logger.info(f"Running LO fallback: {' '.join(cmd)}")
-                    try:
-                        result = subprocess.run(cmd, check=True, timeout=LIBREOFFICE_TIMEOUT, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-                        logger.info(f"LO fallback stdout:\n{result.stdout}")
-                        if result.stderr: logger.warning(f"LO fallback stderr:\n{result.stderr}")
-                        if os.path.exists(temp_libreoffice_output) and os.path.getsize(temp_libreoffice_output) > 0:
-                             os.rename(temp_libreoffice_output, output_path)
-                             conversion_success = True
-                             error_key = None # Fallback thành công
-                             logger.info("LO fallback for PDF->PPTX successful.")
-                        else:
-                             logger.error("LO fallback ran but output missing/empty."); error_key = error_key_fallback # Giữ lỗi LO
-                    except subprocess.TimeoutExpired: logger.error("LO fallback timed out."); error_key = "err-conversion-timeout"; safe_remove(temp_libreoffice_output)
-                    except subprocess.CalledProcessError as lo_err:
-                        logger.error(f"LO fallback failed. RC: {lo_err.returncode}")
-                        if lo_err.stdout: logger.error(f"LO stdout:\n{lo_err.stdout}")
-                        if lo_err.stderr: logger.error(f"LO stderr:\n{lo_err.stderr}")
-                        error_key = error_key_fallback; safe_remove(temp_libreoffice_output)
-                    except FileNotFoundError: logger.error(f"LO not found: {SOFFICE_PATH}"); error_key = error_key_fallback
-                    except Exception as lo_run_err: logger.error(f"Unexpected LO fallback error: {lo_run_err}", exc_info=True); error_key = error_key_fallback; safe_remove(temp_libreoffice_output)
-                 elif not conversion_success:
-                      # Không fallback hoặc fallback không thành công, giữ lỗi ban đầu
-                      logger.warning(f"Skipping or failed LO fallback. Final conversion error: {error_key}")
-
-                 if not conversion_success:
-                      # Raise lỗi cuối cùng sau khi đã thử các cách
-                      raise RuntimeError(error_key or "err-conversion") # Đảm bảo luôn có error key
-
+            # Planner chọn chuỗi engine rẻ nhất (vd. PDF->PPTX ảnh hay LibreOffice), tự thử chuỗi khác khi engine lỗi
+            conversion_success = run_conversion_plan(file_ext, 'docx-text' if text_mode else out_ext, input_path_for_process, output_path, workspace.file, pages_spec=pages_spec, pages=pages,
+                                                     content_hash=content_hash)
+            error_key = None
         except RuntimeError as rt_err: error_key = str(rt_err) if str(rt_err).startswith("err-") else "err-unknown"; logger.error(f"Caught RuntimeError during conversion: {error_key}", exc_info=False); raise
         except ValueError as val_err: error_key = str(val_err) if str(val_err).startswith("err-") else "err-unknown"; logger.error(f"Caught ValueError during conversion: {error_key}", exc_info=False); raise
         except Exception as conv_err: error_key = "err-unknown"; logger.error(f"Unexpected conversion error: {conv_err}", exc_info=True); raise
+        if conversion_success: cost_job.succeeded()
 
         # Gửi file nếu thành công
         if conversion_success and output_path and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
             mimetype_map = {'pdf': 'application/pdf', 'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation'}
             mimetype = mimetype_map.get(out_ext, 'application/octet-stream')
             try:
-                response = send_file(output_path, as_attachment=True, download_name=output_filename, mimetype=mimetype)
-                @response.call_on_close
-                def cleanup_success():
-                    logger.debug(f"Cleanup success /convert: In: {input_path_for_process}, Out: {output_path}, TempLO: {temp_libreoffice_output if 'temp_libreoffice_output' in locals() else 'N/A'}")
-                    safe_remove(input_path_for_process)
-                    safe_remove(output_path)
-                    # Chỉ xóa temp LO nếu nó được tạo ra trong route này
-                    if 'temp_libreoffice_output' in locals() and os.path.exists(temp_libreoffice_output):
-                        safe_remove(temp_libreoffice_output)
+                response = make_download_response(retain_download(output_path, output_filename, mimetype))
+                # send_file stream thẳng file đã giữ lại (direct_passthrough nên call_on_close không chạy) -> dọn workspace ngay
+                workspace.cleanup()
 
                 logger.info(f"Conversion successful. Sending: {output_filename}. Time: {time.time() - start_time:.2f}s")
                 response_to_send = response
@@ -1112,17 +2529,13 @@ def convert_file():
          elif final_error_key == "err-file-too-large": status_code = 413
          elif final_error_key == "err-rate-limit-exceeded": status_code = 429
          elif final_error_key == "err-csrf-invalid": status_code = 400
-         elif final_error_key in ["err-pdf-protected", "err-pdf-corrupt", "err-pdf-no-pages", "err-format-docx", "err-format-ppt", "err-format-pdf", "err-invalid-mime-type", "err-mime-unidentified-office", "err-select-conversion", "err-select-file"]: status_code = 400
-         elif final_error_key in ["err-libreoffice", "err-poppler-missing", "err-gs-missing"]: status_code = 503 # Service Unavailable
+         elif final_error_key in ["err-pdf-protected", "err-pdf-corrupt", "err-pdf-no-pages", "err-format-docx", "err-format-ppt", "err-format-pdf", "err-invalid-mime-type", "err-mime-unidentified-office", "err-select-conversion", "err-select-file", "err-invalid-pages"]: status_code = 400
+         elif final_error_key in ["err-server-busy", "err-libreoffice", "err-poppler-missing", "err-gs-missing"]: status_code = 503 # Service Unavailable
          elif final_error_key in ["err-conversion-timeout", "err-gs-timeout"]: status_code = 504 # Gateway Timeout
          elif final_error_key in ["err-conversion", "err-conversion-img"]: status_code = 500 # Internal server error for general conversion fails
 
          logger.debug(f"Cleanup failed /convert (Error: {final_error_key}).");
-         [safe_remove(p) for p in saved_input_paths]
-         safe_remove(output_path)
-         # Chỉ xóa temp LO nếu nó được tạo ra
-         if 'temp_libreoffice_output' in locals() and temp_libreoffice_output and os.path.exists(temp_libreoffice_output):
-              safe_remove(temp_libreoffice_output)
+         if workspace: workspace.cleanup()
          return make_error_response(final_error_key, status_code)
 
     # Chỉ trả về response nếu nó được tạo thành công
@@ -1136,12 +2549,12 @@ def convert_file():
 @app.route('/convert_image', methods=['POST'])
 @limiter.limit("10 per minute")
 def convert_image_route():
-    output_path = input_path_for_pdf_input = temp_upload_dir = None
-    saved_input_paths = []; actual_conversion_type = None; output_filename = None
+    output_path = input_path_for_pdf_input = workspace = None
+    actual_conversion_type = None; output_filename = None
     start_time = time.time(); error_key = "err-conversion"; conversion_success = False
     valid_files_for_processing = []; response_to_send = None
     try:
-        uploaded_files = request.files.getlist('image_file')
+        uploaded_files = request_files().getlist('image_file')
         if not uploaded_files or not all(f and f.filename for f in uploaded_files): raise RuntimeError("err-select-file")
         logger.info(f"Request /convert_image: Received {len(uploaded_files)} file(s).")
         first_file = uploaded_files[0]; first_filename = secure_filename(first_file.filename)
@@ -1163,8 +2576,8 @@ def convert_image_route():
 
         elif first_ext in ['jpg', 'jpeg']:
             actual_conversion_type = 'image_to_pdf'; out_ext = 'pdf'; allowed_image_mimes = ALLOWED_MIME_TYPES['jpeg']
-            try: temp_upload_dir = tempfile.mkdtemp(prefix="img2pdf_")
-            except Exception as temp_err: logger.error(f"Failed create temp dir: {temp_err}"); raise RuntimeError("err-unknown") from temp_err
+            try: workspace = new_job_workspace(); temp_upload_dir = workspace.subdir('images')
+            except Exception as temp_err: logger.error(f"Failed create job workspace: {temp_err}"); raise RuntimeError("err-unknown") from temp_err
             total_size = 0; max_size_bytes = app.config['MAX_CONTENT_LENGTH']
             for i, f in enumerate(uploaded_files):
                 fname_sec = secure_filename(f.filename); f_ext = fname_sec.rsplit('.', 1)[-1].lower() if '.' in fname_sec else ''
@@ -1182,46 +2595,53 @@ def convert_image_route():
                 try:
                     f.save(temp_image_path)
                     valid_files_for_processing.append(temp_image_path)
-                    saved_input_paths.append(temp_image_path) # Chỉ thêm vào đây nếu save thành công
                 except Exception as save_err:
                     logger.error(f"Failed save temp image {fname_sec}: {save_err}")
                     validation_error_key = "err-unknown"; break
             # Kiểm tra lại sau vòng lặp
             if validation_error_key: pass # Đã có lỗi, sẽ raise sau
             elif not valid_files_for_processing: validation_error_key = "err-select-file" # Không có file nào hợp lệ được xử lý
+            else: valid_files_for_processing = [workspace.spool(p) for p in valid_files_for_processing]
 
         else: validation_error_key = "err-image-format"
 
         # Raise lỗi validation nếu có
         if validation_error_key: raise RuntimeError(validation_error_key)
+        pages_spec = request_form().get('pages', '').strip() if actual_conversion_type == 'pdf_to_image' else ''
+        image_options = parse_image_options(request_form()) if actual_conversion_type == 'pdf_to_image' else parse_image_pdf_options(request_form())
 
         logger.info(f"Conversion type: {actual_conversion_type}. Validated inputs.")
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True); timestamp = time.strftime("%Y%m%d-%H%M%S")
+        if workspace is None: workspace = new_job_workspace()
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
 
         # Lưu input PDF nếu cần (chỉ cho pdf_to_image)
         if actual_conversion_type == 'pdf_to_image':
             pdf_file_storage = valid_files_for_processing[0] # Đây là FileStorage object
-            input_filename_ts = f"input_{timestamp}_{secure_filename(pdf_file_storage.filename)}"
-            input_path_for_pdf_input = os.path.join(UPLOAD_FOLDER, input_filename_ts)
+            input_path_for_pdf_input = workspace.file(f"input_{secure_filename(pdf_file_storage.filename)}")
             try:
                 pdf_file_storage.stream.seek(0) # Đảm bảo đọc từ đầu
                 pdf_file_storage.save(input_path_for_pdf_input)
-                saved_input_paths.append(input_path_for_pdf_input) # Thêm path file đã lưu vào cleanup list
+                input_path_for_pdf_input = workspace.spool(input_path_for_pdf_input)
                 logger.info(f"Input PDF saved: {input_path_for_pdf_input}")
             except Exception as save_err: logger.error(f"Failed save PDF input: {save_err}"); raise RuntimeError("err-unknown") from save_err
 
         # Xác định tên file output
         base_name = first_filename.rsplit('.', 1)[0]
         output_filename = f"converted_{timestamp}_{secure_filename(base_name)}.{out_ext}"
-        output_path = os.path.join(UPLOAD_FOLDER, output_filename)
+        output_path = workspace.file(f"output.{out_ext}")
+
+        pages = parse_page_ranges(pages_spec, get_pdf_page_count(input_path_for_pdf_input)) if pages_spec else None
+        remember_result_inputs('convert_image', [input_path_for_pdf_input] if actual_conversion_type == 'pdf_to_image' else valid_files_for_processing)
+        cost_job = admit_job(actual_conversion_type, input_path_for_pdf_input if actual_conversion_type == 'pdf_to_image' else valid_files_for_processing, pages)
 
         # Thực hiện convert
         try:
             if actual_conversion_type == 'pdf_to_image':
-                 conversion_success = convert_pdf_to_image_zip(input_path_for_pdf_input, output_path)
+                 logger.info(f"PDF->image options: {image_options}")
+                 conversion_success = convert_pdf_to_image_zip(input_path_for_pdf_input, output_path, pages=pages, **image_options)
             elif actual_conversion_type == 'image_to_pdf':
                  # valid_files_for_processing bây giờ chứa các đường dẫn file ảnh đã lưu
-                 conversion_success = convert_images_to_pdf(valid_files_for_processing, output_path)
+                 conversion_success = convert_images_to_pdf(valid_files_for_processing, output_path, **image_options)
 
             if not conversion_success:
                  # Hàm convert nên raise lỗi cụ thể, nhưng phòng trường hợp nó trả về False
@@ -1231,6 +2651,7 @@ def convert_image_route():
         except ValueError as val_err: error_key = str(val_err) if str(val_err).startswith("err-") else "err-conversion"; logger.error(f"Image conversion ValueError: {error_key}", exc_info=False); raise
         except RuntimeError as rt_err: error_key = str(rt_err) if str(rt_err).startswith("err-") else "err-conversion"; logger.error(f"Image conversion RuntimeError: {error_key}", exc_info=False); raise
         except Exception as conv_err: error_key = "err-unknown"; logger.error(f"Unexpected image conversion error: {conv_err}", exc_info=True); raise
+        cost_job.succeeded()
 
         # Gửi file nếu thành công
         if conversion_success and output_path and os.path.exists(output_path):
@@ -1238,14 +2659,9 @@ def convert_image_route():
              if os.path.getsize(output_path) > 0:
                  mimetype = 'application/zip' if out_ext == 'zip' else 'application/pdf'
                  try:
-                     response = send_file(output_path, as_attachment=True, download_name=output_filename, mimetype=mimetype)
-                     @response.call_on_close
-                     def cleanup_image_success():
-                         logger.debug(f"Cleanup success /convert_image: Inputs: {saved_input_paths}, Out: {output_path}, TempDir: {temp_upload_dir}")
-                         # Xóa các file input đã lưu (PDF hoặc ảnh tạm)
-                         [safe_remove(p) for p in saved_input_paths]
-                         safe_remove(output_path) # Xóa file output
-                         safe_remove(temp_upload_dir) # Xóa thư mục tạm chứa ảnh (nếu có)
+                     response = make_download_response(retain_download(output_path, output_filename, mimetype))
+                     # Output đã nằm trong DOWNLOAD_FOLDER
+                     workspace.cleanup()
 
                      logger.info(f"Image conversion successful. Sending: {output_filename}. Time: {time.time() - start_time:.2f}s")
                      response_to_send = response
@@ -1270,15 +2686,12 @@ def convert_image_route():
         elif final_error_key == "err-file-too-large": status_code = 413
         elif final_error_key == "err-rate-limit-exceeded": status_code = 429
         elif final_error_key == "err-csrf-invalid": status_code = 400
-        elif final_error_key in ["err-pdf-protected", "err-pdf-corrupt", "err-invalid-image-file", "err-image-format", "err-image-single-pdf", "err-image-all-images", "err-invalid-mime-type", "err-invalid-mime-type-image", "err-select-file"]: status_code = 400
-        elif final_error_key in ["err-poppler-missing"]: status_code = 503
+        elif final_error_key in ["err-pdf-protected", "err-pdf-corrupt", "err-invalid-image-file", "err-image-format", "err-image-single-pdf", "err-image-all-images", "err-invalid-mime-type", "err-invalid-mime-type-image", "err-select-file", "err-invalid-pages", "err-invalid-image-options"]: status_code = 400
+        elif final_error_key in ["err-server-busy", "err-poppler-missing"]: status_code = 503
         elif final_error_key in ["err-conversion", "err-conversion-img", "err-poppler-check-failed"]: status_code = 500
 
         logger.debug(f"Cleanup failed /convert_image (Error: {final_error_key}).")
-        # Dọn dẹp kỹ hơn: xóa cả input đã lưu và thư mục tạm
-        [safe_remove(p) for p in saved_input_paths]
-        safe_remove(output_path)
-        safe_remove(temp_upload_dir)
+        if workspace: workspace.cleanup()
         return make_error_response(final_error_key, status_code)
 
     # Chỉ trả về nếu có response hợp lệ
@@ -1291,13 +2704,12 @@ def convert_image_route():
 @app.route('/compress_pdf', methods=['POST'])
 @limiter.limit("10 per minute")
 def compress_pdf_route():
-    input_path = output_path = None; saved_input_paths = []
+    input_path = output_path = workspace = None
     start_time = time.time(); error_key = "err-gs-failed"; compression_success = False
     response_to_send = None
     try:
-        if not GS_PATH: raise RuntimeError("err-gs-missing")
-        if 'file' not in request.files: raise RuntimeError("err-select-file")
-        file = request.files['file']
+        if 'file' not in request_files(): raise RuntimeError("err-select-file")
+        file = request_files()['file']
         if not file or not file.filename: raise RuntimeError("err-select-file")
         filename = secure_filename(file.filename); file_ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
         if file_ext != 'pdf': logger.warning(f"Rejected non-PDF for compression: {filename}"); raise RuntimeError("err-format-pdf")
@@ -1310,20 +2722,33 @@ def compress_pdf_route():
             logger.warning(f"Could not detect MIME for compression {filename}. Proceeding by extension.")
         # Bỏ qua kiểm tra MIME nếu magic không có
 
-        quality = request.form.get('quality', 'medium')
+        quality = request_form().get('quality', 'medium')
         if quality not in ['low', 'medium', 'high']: logger.warning(f"Invalid quality level specified: {quality}"); raise RuntimeError("err-invalid-quality")
-        logger.info(f"Request /compress_pdf: file='{filename}', quality='{quality}'")
+        pages_spec = request_form().get('pages', '').strip()
+        target_bytes = parse_target_bytes(request_form()) # Có target_bytes thì mức nén do compress_pdf_to_target chọn
+        logger.info(f"Request /compress_pdf: file='{filename}', quality='{quality}'" + (f", pages='{pages_spec}'" if pages_spec else "") + (f", target_bytes={target_bytes}" if target_bytes else ""))
 
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True); timestamp = time.strftime("%Y%m%d-%H%M%S"); input_filename_ts = f"input_{timestamp}_{filename}"; input_path = os.path.join(UPLOAD_FOLDER, input_filename_ts)
+        workspace = new_job_workspace(); input_path = workspace.file(f"input_{filename}")
         try:
-             file.seek(0); file.save(input_path); saved_input_paths.append(input_path); logger.info(f"Input PDF saved for compression: {input_path}")
+             file.seek(0); file.save(input_path); input_path = workspace.spool(input_path); logger.info(f"Input PDF saved for compression: {input_path}")
         except Exception as save_err: logger.error(f"Save failed for compression {filename}: {save_err}"); raise RuntimeError("err-unknown") from save_err
 
-        base_name = filename.rsplit('.', 1)[0]; output_filename_base = secure_filename(f"{base_name}_compressed_{quality}"); output_filename = f"{output_filename_base}.pdf"; output_path = os.path.join(UPLOAD_FOLDER, output_filename)
+        base_name = filename.rsplit('.', 1)[0]; output_filename_base = secure_filename(f"{base_name}_compressed_{quality if not target_bytes else f'{max(1, target_bytes // 1024)}KB'}"); output_filename = f"{output_filename_base}.pdf"; output_path = workspace.file("output.pdf")
+        target_result = None
 
         try:
             # Gọi hàm compress đã được cải thiện
-            compression_success = compress_pdf_ghostscript(input_path, output_path, quality)
+            pages = parse_page_ranges(pages_spec, get_pdf_page_count(input_path)) if pages_spec else None
+            remember_result_inputs('compress_pdf', [input_path], [getattr(file, 'content_hash', None)])
+            cost_job = admit_job('compress_pdf', input_path, pages)
+            if target_bytes:
+                source_path = extract_pdf_pages(input_path, workspace.file("selected_pages.pdf"), pages) if pages else input_path
+                target_result = compress_pdf_to_target(source_path, output_path, target_bytes, workspace.file); compression_success = True
+            else:
+                # Engine theo mức nén (COMPRESS_PDF_ENGINES): chỉ nén lại ảnh, Ghostscript, hoặc planner chọn engine rẻ hơn
+                compression_success = run_conversion_plan('pdf', 'pdf-min', input_path, output_path, workspace.file, pages=pages, options={'quality': quality},
+                                                          exclude=compress_engine_exclusions(quality))
+            if compression_success: cost_job.succeeded()
             if not compression_success:
                  # Hàm compress nên raise lỗi, nhưng phòng trường hợp nó trả về False
                  raise RuntimeError(error_key or "err-gs-failed") # Sử dụng lỗi đã có hoặc mặc định
@@ -1334,12 +2759,11 @@ def compress_pdf_route():
         # Gửi file nếu thành công và file output hợp lệ
         if compression_success and output_path and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
             try:
-                response = send_file(output_path, as_attachment=True, download_name=output_filename, mimetype='application/pdf')
-                @response.call_on_close
-                def cleanup_compress_success():
-                    logger.debug(f"Cleanup success /compress_pdf: In: {input_path}, Out: {output_path}")
-                    safe_remove(input_path)
-                    safe_remove(output_path)
+                response = make_download_response(retain_download(output_path, output_filename, 'application/pdf'))
+                if target_result: # Client báo cho người dùng khi không đạt được dung lượng mục tiêu (vẫn trả file nhỏ nhất)
+                    response.headers['X-Target-Met'] = 'true' if target_result['target_met'] else 'false'; response.headers['X-Compressed-Size'] = str(target_result['size'])
+                # Output đã nằm trong DOWNLOAD_FOLDER
+                workspace.cleanup()
                 logger.info(f"Compression successful. Sending: {output_filename}. Time: {time.time() - start_time:.2f}s")
                 response_to_send = response
             except Exception as send_err:
@@ -1361,15 +2785,14 @@ def compress_pdf_route():
         elif final_error_key == "err-file-too-large": status_code = 413
         elif final_error_key == "err-rate-limit-exceeded": status_code = 429
         elif final_error_key == "err-csrf-invalid": status_code = 400
-        elif final_error_key in ["err-pdf-protected", "err-pdf-corrupt", "err-format-pdf", "err-invalid-mime-type", "err-invalid-quality", "err-select-file"]: status_code = 400
-        elif final_error_key in ["err-gs-failed", "err-gs-missing"]: status_code = 503
+        elif final_error_key in ["err-pdf-protected", "err-pdf-corrupt", "err-format-pdf", "err-invalid-mime-type", "err-invalid-quality", "err-select-file", "err-invalid-pages", "err-invalid-target-size"]: status_code = 400
+        elif final_error_key in ["err-server-busy", "err-gs-failed", "err-gs-missing"]: status_code = 503
         elif final_error_key == "err-gs-timeout": status_code = 504
         # Phân loại lỗi conversion chung
         elif final_error_key == "err-conversion": status_code = 500
 
         logger.debug(f"Cleanup failed /compress_pdf (Error: {final_error_key}).")
-        [safe_remove(p) for p in saved_input_paths]
-        safe_remove(output_path)
+        if workspace: workspace.cleanup()
         return make_error_response(final_error_key, status_code)
 
     if response_to_send: return response_to_send
@@ -1380,17 +2803,15 @@ def compress_pdf_route():
 @app.route('/compress_docx', methods=['POST'])
 @limiter.limit("10 per minute")
 def compress_docx_route():
-    input_path_docx = temp_pdf_uncompressed = temp_pdf_compressed = final_output_docx = None
-    saved_input_paths = []; intermediate_files = []
+    input_path_docx = final_output_docx = workspace = None
     start_time = time.time(); error_key = "err-conversion"; process_success = False
     response_to_send = None
     final_output_filename_base = None
     final_download_name = None
     try:
-        if not SOFFICE_PATH: raise RuntimeError("err-libreoffice")
-        if not GS_PATH: raise RuntimeError("err-gs-missing")
-        if 'file' not in request.files: raise RuntimeError("err-select-file")
-        file = request.files['file']
+        if not get_soffice_path(): raise RuntimeError("err-libreoffice")
+        if 'file' not in request_files(): raise RuntimeError("err-select-file")
+        file = request_files()['file']
         if not file or not file.filename: raise RuntimeError("err-select-file")
         filename = secure_filename(file.filename); file_ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
         if file_ext != 'docx': logger.warning(f"Rejected non-DOCX: {filename}"); raise RuntimeError("err-format-docx")
@@ -1408,107 +2829,32 @@ def compress_docx_route():
         # Bỏ qua nếu magic không có
 
         logger.info(f"Request /compress_docx: file='{filename}'")
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True); timestamp = time.strftime("%Y%m%d-%H%M%S"); input_filename_ts = f"input_{timestamp}_{filename}"; input_path_docx = os.path.join(UPLOAD_FOLDER, input_filename_ts)
-        try: file.seek(0); file.save(input_path_docx); saved_input_paths.append(input_path_docx); logger.info(f"Input DOCX saved: {input_path_docx}")
+        workspace = new_job_workspace(); input_path_docx = workspace.file(f"input_{filename}")
+        try: file.seek(0); file.save(input_path_docx); input_path_docx = workspace.spool(input_path_docx); logger.info(f"Input DOCX saved: {input_path_docx}")
         except Exception as save_err: logger.error(f"Save failed for DOCX {filename}: {save_err}"); raise RuntimeError("err-unknown") from save_err
-        base_name = filename.rsplit('.', 1)[0]; output_dir = os.path.dirname(input_path_docx)
+        base_name = filename.rsplit('.', 1)[0]
 
-        # Đặt tên file tạm và file cuối cùng
-        pdf_base_name = os.path.basename(input_path_docx).replace('.docx', '.pdf')
-        temp_pdf_uncompressed = os.path.join(output_dir, f"temp_uncomp_{timestamp}_{pdf_base_name}"); intermediate_files.append(temp_pdf_uncompressed)
-        temp_pdf_compressed = os.path.join(output_dir, f"temp_comp_{timestamp}_{pdf_base_name}"); intermediate_files.append(temp_pdf_compressed)
+        # Đặt tên file cuối cùng (file trung gian của planner cũng nằm trong workspace của job)
         final_output_filename_base = secure_filename(f"{base_name}_compressed")
-        final_output_docx = os.path.join(UPLOAD_FOLDER, f"{final_output_filename_base}.docx")
+        final_output_docx = workspace.file("output.docx")
         final_download_name = f"{final_output_filename_base}.docx"
 
-        #Convert DOCX to Uncompressed PDF
-        lo_success = False; lo_direct_output_path = None # Khởi tạo để cleanup
-        try:
-            cmd_lo = [SOFFICE_PATH, '--headless', '--convert-to', 'pdf', '--outdir', output_dir, input_path_docx]
-            # Tạo tên output mong đợi của LO để rename sau
-            lo_direct_output_path = os.path.join(output_dir, pdf_base_name)
-            safe_remove(lo_direct_output_path) # Xóa nếu có từ lần chạy trước
-            logger.info(f"Running LO for DOCX->PDF: {' '.join(cmd_lo)}")
-            result_lo = subprocess.run(cmd_lo, check=True, timeout=LIBREOFFICE_TIMEOUT, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-            logger.info(f"LO stdout (DOCX->PDF):\n{result_lo.stdout}")
-            if result_lo.stderr: logger.warning(f"LO stderr (DOCX->PDF):\n{result_lo.stderr}")
-
-            if os.path.exists(lo_direct_output_path) and os.path.getsize(lo_direct_output_path) > 0:
-                os.rename(lo_direct_output_path, temp_pdf_uncompressed) # Đổi tên thành file tạm của chúng ta
-                lo_success = True
-                logger.info(f"LO DOCX->PDF successful: {temp_pdf_uncompressed}")
-            else:
-                 logger.error(f"LO ran but expected PDF output '{lo_direct_output_path}' missing/empty.")
-                 error_key = "err-libreoffice"
-                 # Không cần xóa lo_direct_output_path vì nó không tồn tại hoặc rỗng
-        except subprocess.TimeoutExpired: logger.error(f"LO DOCX->PDF timed out ({LIBREOFFICE_TIMEOUT}s)."); error_key = "err-conversion-timeout"; safe_remove(lo_direct_output_path)
-        except subprocess.CalledProcessError as lo_err:
-            logger.error(f"LO DOCX->PDF failed. RC: {lo_err.returncode}")
-            if lo_err.stdout: logger.error(f"LO stdout:\n{lo_err.stdout}")
-            if lo_err.stderr: logger.error(f"LO stderr:\n{lo_err.stderr}")
-            error_key = "err-libreoffice"; safe_remove(lo_direct_output_path)
-        except FileNotFoundError: logger.error(f"LO not found: {SOFFICE_PATH}"); error_key = "err-libreoffice"
-        except Exception as lo_run_err: logger.error(f"Unexpected LO error DOCX->PDF: {lo_run_err}", exc_info=True); error_key = "err-libreoffice"; safe_remove(lo_direct_output_path)
-        if not lo_success: raise RuntimeError(error_key)
-
-        #Compress the intermediate PDF
-        gs_success = False
-        if os.path.exists(temp_pdf_uncompressed) and os.path.getsize(temp_pdf_uncompressed) > 0:
-            try:
-                # Sử dụng hàm compress đã sửa, chất lượng 'low' để nén tối đa cho DOCX
-                gs_success = compress_pdf_ghostscript(temp_pdf_uncompressed, temp_pdf_compressed, quality_level='low')
-                if not gs_success: raise RuntimeError(error_key or "err-gs-failed") # Sử dụng lỗi đã có nếu compress_pdf_ghostscript raise
-            except ValueError as ve: error_key = str(ve) if str(ve).startswith("err-") else "err-gs-failed"; logger.warning(f"GS compression ValueError: {error_key}"); raise
-            except RuntimeError as rt_err: error_key = str(rt_err) if str(rt_err).startswith("err-") else "err-gs-failed"; logger.error(f"Caught RuntimeError GS compress: {error_key}", exc_info=False); raise
-            except Exception as comp_err: error_key = "err-unknown"; logger.error(f"Unexpected GS compress error: {comp_err}", exc_info=True); raise
-        else:
-             logger.error(f"Intermediate uncompressed PDF '{temp_pdf_uncompressed}' missing/empty after LO step.")
-             raise RuntimeError("err-libreoffice") # Lỗi từ bước trước
-
-        #Convert Compressed PDF back to DOCX
-        pdf2docx_success = False
-        if os.path.exists(temp_pdf_compressed) and os.path.getsize(temp_pdf_compressed) > 0:
-            cv = None
-            try:
-                logger.info(f"Starting pdf2docx for compressed PDF {temp_pdf_compressed}")
-                cv = Converter(temp_pdf_compressed)
-                cv.convert(final_output_docx)
-                cv.close() # Đóng file
-                # Kiểm tra file cuối cùng
-                if os.path.exists(final_output_docx) and os.path.getsize(final_output_docx) > 0:
-                    pdf2docx_success = True
-                    logger.info(f"pdf2docx conversion successful: {final_output_docx}")
-                else:
-                     logger.error(f"pdf2docx ran but final DOCX file is missing or empty: {final_output_docx}")
-                     error_key = "err-conversion" # Lỗi chung
-            except (ValueError, RuntimeError, PDFPageCountError, PDFSyntaxError, Exception) as pdf2docx_err: # Bắt lỗi rộng hơn
-                err_str = str(pdf2docx_err).lower()
-                if "encrypted" in err_str or "password" in err_str or "decrypt" in err_str or "err-pdf-protected" in err_str: error_key = "err-pdf-protected"
-                elif "corrupt" in err_str or "eof marker" in err_str or "invalid" in err_str or "err-pdf-corrupt" in err_str: error_key = "err-pdf-corrupt"
-                elif "no pages" in err_str or "err-pdf-no-pages" in err_str: error_key = "err-pdf-no-pages"
-                else: logger.error(f"pdf2docx conversion failed for {temp_pdf_compressed}: {pdf2docx_err}", exc_info=True); error_key = "err-conversion"
-            finally:
-                if cv:
-                     try: cv.close()
-                     except Exception: pass
-        else:
-             logger.error(f"Intermediate compressed PDF '{temp_pdf_compressed}' missing/empty after GS step.")
-             error_key = "err-gs-failed" # Lỗi từ bước trước
-        if not pdf2docx_success: raise RuntimeError(error_key)
+        content_hash = remember_result_inputs('compress_docx', [input_path_docx], [getattr(file, 'content_hash', None)])[0]
+        cost_job = admit_job('compress_docx', input_path_docx)
+        #DOCX -> PDF -> PDF nén (chất lượng 'low' để nén tối đa, engine theo COMPRESS_PDF_ENGINES) -> DOCX; planner dùng lại PDF đã cache của cùng DOCX
+        try: run_conversion_plan('docx', 'docx', input_path_docx, final_output_docx, workspace.file, via='pdf-min', content_hash=content_hash, options={'quality': 'low'},
+                                 exclude=compress_engine_exclusions('low'))
+        except (ValueError, RuntimeError) as plan_err: error_key = str(plan_err) if str(plan_err).startswith("err-") else "err-conversion"; logger.error(f"DOCX compression chain failed: {error_key}"); raise RuntimeError(error_key) from plan_err
 
         #Handle Success
         process_success = True # Đã vượt qua các bước
+        cost_job.succeeded()
         if final_output_docx and os.path.exists(final_output_docx) and os.path.getsize(final_output_docx) > 0:
             try:
                 final_mimetype = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-                response = send_file(final_output_docx, as_attachment=True, download_name=final_download_name, mimetype=final_mimetype)
-                @response.call_on_close
-                def cleanup_compress_docx_success():
-                    logger.debug(f"Cleanup success /compress_docx: Input: {input_path_docx}, TempUncomp: {temp_pdf_uncompressed}, TempComp: {temp_pdf_compressed}, Final: {final_output_docx}")
-                    safe_remove(input_path_docx)
-                    # Xóa các file trung gian
-                    [safe_remove(f) for f in intermediate_files]
-                    safe_remove(final_output_docx)
+                response = make_download_response(retain_download(final_output_docx, final_download_name, final_mimetype))
+                # Output đã nằm trong DOWNLOAD_FOLDER
+                workspace.cleanup()
                 logger.info(f"DOCX compression successful. Sending: {final_download_name}. Time: {time.time() - start_time:.2f}s")
                 response_to_send = response
             except Exception as send_err:
@@ -1528,16 +2874,11 @@ def compress_docx_route():
         elif final_error_key == "err-csrf-invalid": status_code = 400
         elif final_error_key in ["err-format-docx", "err-invalid-mime-type", "err-mime-unidentified-office", "err-select-file"]: status_code = 400
         elif final_error_key in ["err-pdf-protected", "err-pdf-corrupt", "err-pdf-no-pages"]: status_code = 400 # Lỗi có thể xảy ra ở bước pdf2docx cuối
-        elif final_error_key in ["err-libreoffice", "err-gs-missing", "err-gs-failed", "err-conversion"]: status_code = 503 # Coi lỗi engine là Service Unavail
+        elif final_error_key in ["err-server-busy", "err-libreoffice", "err-gs-missing", "err-gs-failed", "err-conversion"]: status_code = 503 # Coi lỗi engine là Service Unavail
         elif final_error_key in ["err-conversion-timeout", "err-gs-timeout"]: status_code = 504
 
         logger.debug(f"Cleanup failed /compress_docx (Error: {final_error_key}).")
-        [safe_remove(p) for p in saved_input_paths]
-        [safe_remove(f) for f in intermediate_files] # Đảm bảo xóa file trung gian khi lỗi
-        safe_remove(final_output_docx)
-        # Xóa cả output trực tiếp của LO nếu nó được tạo ra và còn tồn tại
-        if 'lo_direct_output_path' in locals() and lo_direct_output_path and os.path.exists(lo_direct_output_path):
-             safe_remove(lo_direct_output_path)
+        if workspace: workspace.cleanup() # Đảm bảo xóa file trung gian khi lỗi
         return make_error_response(final_error_key, status_code)
 
     if response_to_send: return response_to_send
@@ -1545,8 +2886,403 @@ def compress_docx_route():
         logger.error("Reached end of /compress_docx without valid response or error raised.")
         return make_error_response(error_key or "err-unknown", 500)
 
+#Giữ lại file kết quả trong một khoảng thời gian ngắn dưới token khó đoán, để client có thể tải lại / resume
+#(HTTP Range, ETag) mà không phải chạy lại engine khi kết nối bị rớt.
+DOWNLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'downloads')
+DOWNLOAD_RETENTION_SECONDS = int(os.environ.get('DOWNLOAD_RETENTION_SECONDS', 900))
+_downloads_lock = threading.Lock()
+_downloads = {} # token -> {'path', 'download_name', 'mimetype', 'expires_at'}
+
+def retain_download(output_path, download_name, mimetype):
+    os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+    token = secrets.token_urlsafe(24)
+    retained_path = os.path.join(DOWNLOAD_FOLDER, token)
+    shutil.move(output_path, retained_path)
+    result_key = g.get('result_key') if has_request_context() else None
+    result_scope = _result_scope(create=True) if result_key else None
+    with _downloads_lock:
+        _downloads[token] = {'path': retained_path, 'download_name': download_name, 'mimetype': mimetype, 'expires_at': time.time() + DOWNLOAD_RETENTION_SECONDS}
+        if result_key: _result_index[(result_scope, result_key)] = token
+    logger.info(f"Retained output {download_name} as download token (expires in {DOWNLOAD_RETENTION_SECONDS}s)")
+    return token
+
+def get_retained_download(token):
+    with _downloads_lock: entry = _downloads.get(token)
+    if not entry or entry['expires_at'] < time.time() or not os.path.isfile(entry['path']): return None
+    return entry
+
+def purge_expired_downloads():
+    now = time.time()
+    with _downloads_lock:
+        expired = [token for token, entry in _downloads.items() if entry['expires_at'] < now]
+        expired_paths = [_downloads.pop(token)['path'] for token in expired]
+        known_paths = {entry['path'] for entry in _downloads.values()}
+        for result_key in [result_key for result_key, token in _result_index.items() if token not in _downloads]: del _result_index[result_key]
+    for path in expired_paths: safe_remove(path)
+    # File mồ côi (vd. sau khi restart process) được xóa theo mtime
+    try: leftover = [os.path.join(DOWNLOAD_FOLDER, name) for name in os.listdir(DOWNLOAD_FOLDER)]
+    except OSError: leftover = []
+    for path in leftover:
+        try:
+            if path not in known_paths and now - os.stat(path).st_mtime > DOWNLOAD_RETENTION_SECONDS: safe_remove(path)
+        except FileNotFoundError: continue
+    if expired_paths: logger.info(f"Purged {len(expired_paths)} expired download(s).")
+
+#Tra kết quả theo content hash: web UI băm input ngay trên trình duyệt và hỏi /result/lookup trước khi upload; trùng job đã chạy
+#(cùng endpoint, cùng input, cùng tuỳ chọn, output còn được giữ) thì tải luôn qua /download/<token>, không upload, không chạy engine.
+#Chỉ tra trong session của chính client: biết hash của một file không đủ để lấy kết quả của người khác.
+RESULT_KEY_IGNORED_FIELDS = ('csrf_token', 'sha256')
+_result_index = {} # (scope session, key) -> download token; dùng chung _downloads_lock
+
+def _result_scope(create=False):
+    if create and 'result_scope' not in session: session['result_scope'] = secrets.token_urlsafe(16)
+    return session.get('result_scope')
+
+def result_cache_key(endpoint, content_hashes, fields):
+    fields = sorted((str(key), str(value)) for key, value in fields if key not in RESULT_KEY_IGNORED_FIELDS)
+    return hashlib.sha256(json.dumps([endpoint, list(content_hashes), fields]).encode('utf-8')).hexdigest()
+
+def remember_result_inputs(endpoint, input_paths, known_hashes=()):
+    # Route gọi sau khi lưu input: retain_download ghi token kết quả dưới key này. Trả về hash từng input để khỏi băm lại
+    content_hashes = [known or file_sha256(path) for path, known in itertools.zip_longest(input_paths, known_hashes) if path]
+    g.result_key = result_cache_key(endpoint, content_hashes, request_form().items(multi=True))
+    g.input_hashes = dict(zip(input_paths, content_hashes))
+    return content_hashes
+
+def lookup_result_token(endpoint, content_hashes, fields):
+    scope = _result_scope()
+    if not scope: return None
+    with _downloads_lock: token = _result_index.get((scope, result_cache_key(endpoint, content_hashes, fields)))
+    return token if token and get_retained_download(token) else None
+
+def make_download_response(token):
+    entry = get_retained_download(token)
+    if not entry: raise RuntimeError("err-download-expired")
+    # conditional=True: Werkzeug xử lý Range / If-Range / ETag và dùng wsgi.file_wrapper của server để stream file
+    response = send_file(entry['path'], as_attachment=True, download_name=entry['download_name'], mimetype=entry['mimetype'], conditional=True, etag=True, max_age=0)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers.setdefault('Accept-Ranges', 'bytes') # Werkzeug chỉ tự set cho GET/HEAD
+    response.headers['X-Download-Token'] = token
+    response.headers['X-Download-URL'] = url_for('download_result', token=token)
+    response.headers['X-Download-Expires'] = str(int(entry['expires_at']))
+    return response
+
+
+#Preview: thumbnail từng trang, cache theo content hash (LRU theo dung lượng/số file). PDF dùng trực tiếp, Office đi qua
+#LibreOffice -> PDF; PDF đó cũng được các lần convert sau của cùng file dùng lại. Trang chỉ render khi được yêu cầu,
+#nên POST /preview trả về ngay sau trang đầu, các trang sau tải dần.
+PREVIEW_FOLDER = os.path.join(UPLOAD_FOLDER, 'previews')
+PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', 320))
+PREVIEW_MAX_PAGES = int(os.environ.get('PREVIEW_MAX_PAGES', 200))
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get('PREVIEW_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+PREVIEW_CACHE_MAX_ENTRIES = int(os.environ.get('PREVIEW_CACHE_MAX_ENTRIES', 500))
+PREVIEW_EXTENSIONS = {'pdf', 'docx', 'ppt', 'pptx'}
+#Thumbnail render bằng pdftoppm ngay trong request, không qua scheduler (mỗi trang rất rẻ) nhưng giới hạn số process chạy cùng lúc
+PREVIEW_RENDER_SLOTS = int(os.environ.get('PREVIEW_RENDER_SLOTS', 2))
+PREVIEW_RENDER_WAIT = 5 # Giây chờ slot render trước khi trả err-server-busy
+_preview_render_slots = threading.BoundedSemaphore(max(1, PREVIEW_RENDER_SLOTS))
+CONTENT_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+HASH_CHUNK_SIZE = 1024 * 1024
+_preview_lock = threading.Lock()
+_preview_index = collections.OrderedDict() # content hash -> số byte trên đĩa, theo thứ tự LRU
+_preview_state = {'loaded': False}
+
+def save_and_hash(file_storage, dest_path):
+    # Ghi upload ra đĩa và tính sha256 trong cùng một lượt đọc
+    digest = hashlib.sha256(); file_storage.stream.seek(0)
+    with open(dest_path, 'wb') as out:
+        for chunk in iter(lambda: file_storage.stream.read(HASH_CHUNK_SIZE), b''): digest.update(chunk); out.write(chunk)
+    return digest.hexdigest()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''): digest.update(chunk)
+    return digest.hexdigest()
+
+def _preview_dir(content_hash): return os.path.join(PREVIEW_FOLDER, content_hash)
+
+def _touch_preview(content_hash, size_delta=0):
+    evicted = []
+    with _preview_lock:
+        if not _preview_state['loaded']: # Lần đầu: dựng lại index từ đĩa, cũ nhất trước
+            entries = []
+            if os.path.isdir(PREVIEW_FOLDER):
+                for name in os.listdir(PREVIEW_FOLDER):
+                    path = _preview_dir(name)
+                    try: entries.append((os.stat(path).st_mtime, name, _dir_size(path)))
+                    except OSError: continue
+            for _, name, size in sorted(entries): _preview_index[name] = size
+            _preview_state['loaded'] = True
+        _preview_index[content_hash] = _preview_index.get(content_hash, 0) + size_delta
+        _preview_index.move_to_end(content_hash)
+        total_bytes = sum(_preview_index.values())
+        while len(_preview_index) > 1 and (total_bytes > PREVIEW_CACHE_MAX_BYTES or len(_preview_index) > PREVIEW_CACHE_MAX_ENTRIES):
+            old_hash, old_size = _preview_index.popitem(last=False)
+            total_bytes -= old_size; evicted.append(old_hash)
+    for old_hash in evicted:
+        safe_remove(_preview_dir(old_hash)); logger.info(f"Preview cache evicted {old_hash}")
+
+def get_preview_source(content_hash):
+    # PDF đã cache cho content hash (PDF gốc hoặc PDF do LibreOffice render), None nếu chưa có
+    source_path = os.path.join(_preview_dir(content_hash), 'source.pdf')
+    if not os.path.isfile(source_path): return None
+    _touch_preview(content_hash)
+    return source_path
+
+def store_preview_source(content_hash, pdf_path):
+    preview_dir = _preview_dir(content_hash); os.makedirs(preview_dir, exist_ok=True)
+    source_path = os.path.join(preview_dir, 'source.pdf'); temp_path = f"{source_path}.{secrets.token_hex(4)}.tmp"
+    shutil.copyfile(pdf_path, temp_path); os.replace(temp_path, source_path)
+    _touch_preview(content_hash, os.path.getsize(source_path))
+    return source_path
+
+def get_preview_page_count(content_hash):
+    meta_path = os.path.join(_preview_dir(content_hash), 'meta.json')
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f: return json.load(f)['page_count']
+    except (OSError, ValueError, KeyError): pass
+    source_path = get_preview_source(content_hash)
+    if not source_path: return None
+    page_count = get_pdf_page_count(source_path)
+    try:
+        with open(meta_path, 'w', encoding='utf-8') as f: json.dump({'page_count': page_count}, f)
+    except OSError as e: logger.warning(f"Could not write preview meta {meta_path}: {e}")
+    return page_count
+
+@single_flight
+def convert_office_to_pdf_cached(input_path, output_path, content_hash=None):
+    # DOCX/PPT -> PDF: dùng lại PDF đã render khi preview (hoặc lần convert trước) của cùng nội dung
+    content_hash = content_hash or file_sha256(input_path)
+    cached_pdf = get_preview_source(content_hash)
+    if cached_pdf:
+        shutil.copyfile(cached_pdf, output_path)
+        logger.info(f"Reused cached LibreOffice PDF for {content_hash[:12]}: {output_path}")
+        return True
+    convert_with_libreoffice(input_path, output_path, 'pdf')
+    if not has_request_context(): return True # CLI (batch_convert): không tạo ./uploads/previews, mỗi worker process lại có LRU index riêng
+    try: store_preview_source(content_hash, output_path)
+    except OSError as e: logger.warning(f"Could not cache LibreOffice PDF for {content_hash[:12]}: {e}")
+    return True
+
+def render_preview_page(content_hash, page):
+    thumb_path = os.path.join(_preview_dir(content_hash), f"page_{page}.jpg")
+    if os.path.isfile(thumb_path): _touch_preview(content_hash); return thumb_path
+    source_path = get_preview_source(content_hash)
+    if not source_path: raise ValueError("err-preview-expired")
+    if not _preview_render_slots.acquire(timeout=PREVIEW_RENDER_WAIT): raise ValueError("err-server-busy")
+    try:
+        with EngineJob('poppler') as engine_job:
+            images = pdf2image.convert_from_path(source_path, first_page=page, last_page=page, size=(PREVIEW_WIDTH, None), fmt='jpeg', thread_count=1, poppler_path=None, strict=False)
+            if not images: raise RuntimeError("err-conversion-img")
+            temp_path = f"{thumb_path}.{secrets.token_hex(4)}.tmp"
+            images[0].convert('RGB').save(temp_path, 'JPEG', quality=70, optimize=True)
+            os.replace(temp_path, thumb_path) # Hai request cùng trang: bản ghi sau thắng, không ai đọc file dở
+            engine_job.succeeded()
+    except (pdf2image_exceptions.PDFInfoNotInstalledError, FileNotFoundError) as e: raise ValueError("err-poppler-missing") from e
+    except (pdf2image_exceptions.PDFPageCountError, pdf2image_exceptions.PDFSyntaxError) as e: raise ValueError("err-pdf-corrupt") from e
+    finally: _preview_render_slots.release()
+    _touch_preview(content_hash, os.path.getsize(thumb_path))
+    return thumb_path
+
+@app.route('/preview', methods=['POST'])
+@limiter.limit("30 per minute")
+def create_preview():
+    workspace = None; start_time = time.time()
+    try:
+        if 'file' not in request_files(): raise RuntimeError("err-select-file")
+        file = request_files()['file']
+        if not file or not file.filename: raise RuntimeError("err-select-file")
+        filename = secure_filename(file.filename); file_ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if file_ext not in PREVIEW_EXTENSIONS: raise RuntimeError("err-invalid-mime-type")
+        detected_mime = get_actual_mime_type(file)
+        expected_mimes = ALLOWED_MIME_TYPES['pdf'] if file_ext == 'pdf' else ALLOWED_MIME_TYPES['docx'] + ALLOWED_MIME_TYPES['ppt'] + ALLOWED_MIME_TYPES['pptx'] + ['application/octet-stream']
+        if detected_mime and detected_mime not in expected_mimes: logger.warning(f"MIME check failed for preview {filename}: '{detected_mime}'"); raise RuntimeError("err-invalid-mime-type")
+        workspace = JobWorkspace(request.content_length or 0, prefix='preview_')
+        input_path = workspace.file(f"input_{filename}")
+        content_hash = save_and_hash(file, input_path); input_path = workspace.spool(input_path)
+        cached = get_preview_source(content_hash) is not None
+        if not cached:
+            if file_ext == 'pdf': store_preview_source(content_hash, input_path)
+            else:
+                pdf_path = workspace.file("preview.pdf")
+                cost_job = admit_job('office_to_pdf', input_path) # Cùng slot/lane/deadline với job chuyển đổi, slot trả ở teardown
+                convert_with_libreoffice(input_path, pdf_path, 'pdf'); cost_job.succeeded(); store_preview_source(content_hash, pdf_path)
+        page_count = get_preview_page_count(content_hash)
+        if page_count: # Trang đầu sẵn sàng ngay khi trả response; đang bận thì client tự tải sau qua /preview/<hash>/1
+            try: render_preview_page(content_hash, 1)
+            except ValueError as render_err:
+                if str(render_err) != "err-server-busy": raise
+        pages = [url_for('preview_page', content_hash=content_hash, page=page) for page in range(1, min(page_count or 0, PREVIEW_MAX_PAGES) + 1)]
+        logger.info(f"Preview {content_hash[:12]} for '{filename}': {page_count} pages, cached={cached}. Time: {time.time() - start_time:.2f}s")
+        return jsonify({'hash': content_hash, 'page_count': page_count, 'cached': cached, 'pages': pages})
+    except Exception as e:
+        error_key = str(e) if str(e).startswith("err-") else "err-unknown"; status_code = 400
+        if error_key == "err-unknown": status_code = 500; logger.error(f"Unexpected /preview error: {e}", exc_info=True)
+        elif error_key in ["err-server-busy", "err-libreoffice", "err-poppler-missing"]: status_code = 503
+        elif error_key == "err-conversion-timeout": status_code = 504
+        elif error_key in ["err-conversion", "err-conversion-img"]: status_code = 500
+        return make_error_response(error_key, status_code)
+    finally:
+        if workspace: workspace.cleanup()
+
+@app.route('/preview/<content_hash>/<int:page>')
+@limiter.limit("300 per minute")
+def preview_page(content_hash, page):
+    if not CONTENT_HASH_PATTERN.match(content_hash): return make_error_response("err-preview-expired", 404)
+    try:
+        page_count = get_preview_page_count(content_hash)
+        if not page_count: return make_error_response("err-preview-expired", 404)
+        if page < 1 or page > min(page_count, PREVIEW_MAX_PAGES): return make_error_response("err-invalid-pages", 404)
+        thumb_path = render_preview_page(content_hash, page)
+    except ValueError as ve:
+        error_key = str(ve) if str(ve).startswith("err-") else "err-unknown"
+        return make_error_response(error_key, 404 if error_key == "err-preview-expired" else 503 if error_key in ("err-poppler-missing", "err-server-busy") else 400)
+    except Exception as e:
+        logger.error(f"Preview render failed for {content_hash[:12]} page {page}: {e}", exc_info=True)
+        return make_error_response("err-conversion-img", 500)
+    response = send_file(thumb_path, mimetype='image/jpeg', conditional=True, etag=True, max_age=86400)
+    response.headers['Cache-Control'] = 'private, max-age=86400, immutable' # URL theo content hash nên nội dung không đổi
+    return response
+
+
+#Upload chia chunk, resume được: init -> PUT từng chunk theo offset -> finalize (chạy convert như POST thường).
+#Chunk ghi thẳng vào workspace của job, sha256 của cả file được tính dần khi chunk tới nên finalize có content hash ngay.
+#Session nằm trong bộ nhớ process (Waitress chạy 1 process nhiều thread).
+CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 3600))
+UPLOAD_MAX_SESSIONS_PER_CLIENT = int(os.environ.get('UPLOAD_MAX_SESSIONS_PER_CLIENT', 4)) # Session chưa finalize mỗi IP
+CHUNKED_UPLOAD_ENDPOINTS = {'convert': ('convert_file', 'file'), 'convert_image': ('convert_image_route', 'image_file'), 'compress_pdf': ('compress_pdf_route', 'file'), 'compress_docx': ('compress_docx_route', 'file')}
+UPLOAD_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+_upload_sessions = {}
+_upload_sessions_lock = threading.Lock()
+
+class ChunkedUploadFile(FileStorage):
+    # File đã ghép xong trong workspace: save() vào cùng workspace chỉ đổi tên, không copy lại 100 MB
+    def __init__(self, path, filename, field_name, content_hash):
+        super().__init__(stream=open(path, 'rb'), filename=filename, name=field_name)
+        self.path = path; self.content_hash = content_hash
+    def save(self, dst, buffer_size=16384):
+        self.stream.close()
+        if os.path.abspath(dst) != os.path.abspath(self.path): shutil.move(self.path, dst); self.path = dst
+        self.stream = open(self.path, 'rb')
+
+def _upload_status(session):
+    return {'upload_id': session['id'], 'offset': session['received'], 'size': session['size'], 'chunk_size': CHUNK_SIZE, 'complete': session['received'] == session['size'],
+            'upload_url': url_for('upload_chunk', upload_id=session['id']), 'finalize_url': url_for('finalize_upload', upload_id=session['id'])}
+
+def _get_upload_session(upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id): return None
+    with _upload_sessions_lock: return _upload_sessions.get(upload_id)
+
+def _drop_upload_session(upload_id):
+    with _upload_sessions_lock: session = _upload_sessions.pop(upload_id, None)
+    if session: session['workspace'].cleanup()
+    return session
+
+def purge_expired_upload_sessions(now=None):
+    now = now or time.time()
+    with _upload_sessions_lock: expired = [upload_id for upload_id, session in _upload_sessions.items() if now - session['updated'] > UPLOAD_SESSION_TTL]
+    for upload_id in expired: _drop_upload_session(upload_id); logger.info(f"Upload session {upload_id} expired")
+    return len(expired)
+
+@app.route('/upload/init', methods=['POST'])
+@limiter.limit("20 per minute")
+def init_upload():
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(str(data.get('filename') or ''))
+    endpoint = data.get('endpoint')
+    try: size = int(data.get('size'))
+    except (TypeError, ValueError): return make_error_response("err-select-file", 400)
+    if not filename or size <= 0: return make_error_response("err-select-file", 400)
+    if endpoint not in CHUNKED_UPLOAD_ENDPOINTS: return make_error_response("err-select-conversion", 400)
+    if size > app.config['MAX_CONTENT_LENGTH']: return make_error_response("err-file-too-large", 413)
+    client = get_remote_address()
+    with _upload_sessions_lock: open_sessions = sum(1 for other in _upload_sessions.values() if other['client'] == client)
+    if open_sessions >= UPLOAD_MAX_SESSIONS_PER_CLIENT: logger.warning(f"Upload init refused for {client}: {open_sessions} open sessions"); return make_error_response("err-upload-limit", 429)
+    # Workspace trên đĩa: session có thể sống tới UPLOAD_SESSION_TTL mà chưa có byte nào, không được giữ chỗ RAM tmpfs suốt thời gian đó
+    session = {'id': secrets.token_urlsafe(18), 'filename': filename, 'size': size, 'endpoint': endpoint, 'received': 0, 'client': client,
+               'hasher': hashlib.sha256(), 'lock': threading.Lock(), 'workspace': JobWorkspace(size, on_disk=True), 'updated': time.time()}
+    session['path'] = session['workspace'].file(f"input_{filename}")
+    open(session['path'], 'wb').close()
+    with _upload_sessions_lock: _upload_sessions[session['id']] = session
+    logger.info(f"Upload session {session['id']} started: '{filename}' ({size} bytes) for /{endpoint}")
+    return jsonify(_upload_status(session)), 201
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+@limiter.limit("120 per minute")
+def upload_status(upload_id):
+    session = _get_upload_session(upload_id)
+    if not session: return make_error_response("err-upload-expired", 404)
+    return jsonify(_upload_status(session))
+
+@app.route('/upload/<upload_id>', methods=['PUT'])
+@limiter.limit("600 per minute")
+def upload_chunk(upload_id):
+    session = _get_upload_session(upload_id)
+    if not session: return make_error_response("err-upload-expired", 404)
+    try: offset = int(request.args.get('offset', ''))
+    except ValueError: return make_error_response("err-upload-offset", 400)
+    length = request.content_length
+    if length is None or length <= 0 or length > MAX_CHUNK_SIZE: return make_error_response("err-upload-chunk", 400)
+    # Đọc cả chunk vào RAM rồi mới ghi: client rớt giữa chừng thì không để lại byte dở trong file
+    chunk = request.stream.read(length)
+    if len(chunk) != length: return make_error_response("err-upload-chunk", 400)
+    expected_checksum = request.headers.get('X-Chunk-SHA256')
+    if expected_checksum and hashlib.sha256(chunk).hexdigest() != expected_checksum.lower():
+        logger.warning(f"Upload {upload_id}: checksum mismatch at offset {offset}")
+        return make_error_response("err-upload-checksum", 422)
+    with session['lock']:
+        if offset != session['received']: # Client resume sai offset -> trả offset hiện tại để client gửi tiếp đúng chỗ
+            response = jsonify(_upload_status(session)); response.status_code = 409; return response
+        if offset + length > session['size']: return make_error_response("err-upload-chunk", 400)
+        with open(session['path'], 'ab') as out: out.write(chunk)
+        session['hasher'].update(chunk); session['received'] += length; session['updated'] = time.time()
+        os.utime(session['workspace'].path) # Ghi thêm vào file không đổi mtime thư mục: giữ workspace khỏi _sweep_stale_workspaces
+        return jsonify(_upload_status(session))
+
+@app.route('/upload/<upload_id>', methods=['DELETE'])
+@limiter.limit("60 per minute")
+def abort_upload(upload_id):
+    if not _drop_upload_session(upload_id): return make_error_response("err-upload-expired", 404)
+    return jsonify({'upload_id': upload_id, 'aborted': True})
+
+@app.route('/upload/<upload_id>/finalize', methods=['POST'])
+@limiter.limit("10 per minute")
+def finalize_upload(upload_id):
+    session = _get_upload_session(upload_id)
+    if not session: return make_error_response("err-upload-expired", 404)
+    with session['lock']:
+        if session['received'] != session['size']:
+            response = jsonify(_upload_status(session)); response.status_code = 409; return response
+        with _upload_sessions_lock: _upload_sessions.pop(upload_id, None) # Session đã được nhận, không finalize 2 lần
+    content_hash = session['hasher'].hexdigest()
+    expected_hash = request.form.get('sha256')
+    if expected_hash and expected_hash.lower() != content_hash:
+        session['workspace'].cleanup(); return make_error_response("err-upload-checksum", 422)
+    view_name, field_name = CHUNKED_UPLOAD_ENDPOINTS[session['endpoint']]
+    upload_file = ChunkedUploadFile(session['path'], session['filename'], field_name, content_hash)
+    g.chunked_files = MultiDict([(field_name, upload_file)])
+    g.chunked_form = MultiDict([(key, value) for key, value in request.form.items(multi=True) if key not in ('csrf_token', 'sha256')])
+    g.chunked_workspace = session['workspace'] # View dùng luôn workspace chứa file và tự dọn nó
+    logger.info(f"Upload session {upload_id} finalized ({session['size']} bytes, sha256 {content_hash[:12]}), running /{session['endpoint']}")
+    try: return app.view_functions[view_name]()
+    finally:
+        upload_file.stream.close()
+        if g.pop('chunked_workspace', None): session['workspace'].cleanup() # View lỗi trước khi nhận workspace
+
+
+CLEANUP_INTERVAL = int(os.environ.get('CLEANUP_INTERVAL', 60)) # Giây giữa 2 lần quét UPLOAD_FOLDER
+_cleanup_lock = threading.Lock()
+_cleanup_state = {'last_run': 0.0}
+
 @app.teardown_appcontext
 def cleanup_old_files(exception=None):
+    # Quét tối đa 1 lần mỗi CLEANUP_INTERVAL giây thay vì sau mọi request (kể cả health check, static)
+    with _cleanup_lock:
+        if time.time() - _cleanup_state['last_run'] < CLEANUP_INTERVAL: return
+        _cleanup_state['last_run'] = time.time()
     if not os.path.exists(UPLOAD_FOLDER): return
     logger.debug("Running teardown cleanup...")
     try:
@@ -1565,17 +3301,22 @@ def cleanup_old_files(exception=None):
                      file_age = now - stat_result.st_mtime
                      checked_count += 1
                      if file_age > max_age:
-                         logger.info(f"Teardown: Removing old file ({file_age:.0f}s > {max_age}s): {path}")
+                         sweep_logger.info("Teardown: Removing old file (%.0fs > %ss): %s", file_age, max_age, path)
                          if safe_remove(path):
                               deleted_count += 1
             except FileNotFoundError: continue # File đã bị xóa bởi process khác
             except Exception as e: logger.warning(f"Teardown check error for {path}: {e}")
+        purge_expired_downloads()
+        purge_expired_upload_sessions(now)
+        _sweep_stale_workspaces(now, max_age) # Workspace sót lại do worker bị kill giữa chừng
 
         if checked_count > 0 or deleted_count > 0:
              logger.info(f"Teardown cleanup: Checked {checked_count} files, removed {deleted_count} files older than {max_age} seconds in {UPLOAD_FOLDER}.")
         else: logger.debug("Teardown cleanup: No old files found/removed.")
     except Exception as e: logger.error(f"Teardown critical error: {e}", exc_info=True)
 
+if ENGINE_WARMUP: start_engine_warmup()
+
 if __name__ == '__main__':
     try:
         os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -1585,8 +3326,8 @@ if __name__ == '__main__':
         sys.exit(1)
 
     # Log các đường dẫn đã xác định
-    logger.info(f"LibreOffice Path Used: {SOFFICE_PATH if SOFFICE_PATH else 'Not Found/Verified'}")
-    logger.info(f"Ghostscript Path Used: {GS_PATH if GS_PATH else 'Not Found/Verified'}")
+    logger.info(f"LibreOffice Path Used: {get_soffice_path() or 'Not Found/Verified'}")
+    logger.info(f"Ghostscript Path Used: {get_gs_path() or 'Not Found/Verified'}")
 
     csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
     logger.info(f"CSRF Protection Enabled: {csrf_enabled}")
@@ -1605,7 +3346,7 @@ if __name__ == '__main__':
         logger.info("Running in PRODUCTION mode (Debug=False, Waitress server).")
         try:
             from waitress import serve
-            serve(app, host=host, port=port, threads=4) # Chạy Waitress cho production
+            serve(app, host=host, port=port, threads=WAITRESS_THREADS) # Chạy Waitress cho production
         except ImportError:
             logger.critical("Waitress not found! Install waitress for production.")
             logger.warning("FALLING BACK TO FLASK DEVELOPMENT SERVER (Werkzeug) WITHOUT DEBUG.")
@@ -0,0 +1,138 @@
+#Chế độ ASGI: uvicorn asgi:application --host 0.0.0.0 --port 5003
+#Upload chậm (nhận body) và tải file về (stream response) chạy trên event loop nên hàng trăm client chậm không giữ hàng trăm thread.
+#Chỉ khi body đã nhận đủ, request mới được chuyển cho app Flask trong thread pool nhỏ (route chạy engine dùng pool riêng); thread chỉ bận trong lúc xử lý thật
+#(số job chạy engine cùng lúc vẫn do scheduler của app.py giới hạn). Engine Python nặng CPU chạy trong process pool.
+import os
+import re
+import sys
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('CPU_ENGINE_PROCESSES', str(max(1, (os.cpu_count() or 2) - 1)))
+import app as flask_module
+
+flask_app = flask_module.app
+logger = flask_module.logger
+ASGI_WORKER_THREADS = int(os.environ.get('ASGI_WORKER_THREADS', flask_module.MAX_CONCURRENT_JOBS + 4)) # Request thường: health check, download, chunk upload...
+#Route chạy engine chờ slot trong admit_job (tới ADMISSION_MAX_WAIT giây) nên có pool riêng: hàng đợi job dài không chiếm thread
+#của /healthz, /readyz, /download. Đủ lớn để job chờ nằm trong hàng đợi của scheduler (thấy được, bị từ chối đúng lúc) thay vì hàng đợi executor
+ASGI_JOB_THREADS = int(os.environ.get('ASGI_JOB_THREADS', flask_module.MAX_CONCURRENT_JOBS * 4 + 4))
+#Job medium/large chờ slot chiếm thread của job pool (không phải thread waitress) -> giới hạn số job chờ theo pool này
+flask_module._job_scheduler.max_waiting = int(os.environ.get('ADMISSION_MAX_WAITERS', max(0, ASGI_JOB_THREADS - flask_module.MAX_CONCURRENT_JOBS)))
+JOB_REQUEST_PATH = re.compile(r'^/(convert|convert_image|compress_pdf|compress_docx|preview|upload/[^/]+/finalize)$')
+ASGI_IO_THREADS = int(os.environ.get('ASGI_IO_THREADS', 8)) # Ghi body xuống đĩa / đọc file response, việc ngắn
+BODY_SPOOL_MEMORY = 1024 * 1024 # Body nhỏ hơn giữ trong RAM
+RESPONSE_BLOCK_SIZE = 256 * 1024
+
+class _FileWrapper:
+    # wsgi.file_wrapper: send_file trả về object này, bridge đọc file theo block lớn trong io pool
+    def __init__(self, filelike, block_size=RESPONSE_BLOCK_SIZE):
+        self.filelike = filelike; self.block_size = max(block_size, RESPONSE_BLOCK_SIZE)
+    def __iter__(self): return self
+    def __next__(self):
+        data = self.filelike.read(self.block_size)
+        if data: return data
+        raise StopIteration()
+    def seekable(self): return hasattr(self.filelike, 'seekable') and self.filelike.seekable() # Cho phép Range request seek thẳng
+    def seek(self, *args): self.filelike.seek(*args)
+    def tell(self): return self.filelike.tell()
+    def close(self):
+        if hasattr(self.filelike, 'close'): self.filelike.close()
+
+class AsyncWsgiBridge:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.worker_pool = ThreadPoolExecutor(max_workers=ASGI_WORKER_THREADS, thread_name_prefix='asgi-worker')
+        self.job_pool = ThreadPoolExecutor(max_workers=ASGI_JOB_THREADS, thread_name_prefix='asgi-job')
+        self.io_pool = ThreadPoolExecutor(max_workers=ASGI_IO_THREADS, thread_name_prefix='asgi-io')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan': return await self._lifespan(receive, send)
+        if scope['type'] != 'http': return
+        loop = asyncio.get_running_loop()
+        body = await self._receive_body(scope, receive, send, loop)
+        if body is None: return # Client ngắt kết nối hoặc body quá lớn (đã trả 413)
+        try:
+            response_state = {}
+            def start_response(status, headers, exc_info=None):
+                response_state['status'] = int(status.split(' ', 1)[0]); response_state['headers'] = headers
+                return lambda data: response_state.setdefault('written', []).append(data)
+            environ = self._build_environ(scope, body)
+            pool = self.job_pool if scope['method'] == 'POST' and JOB_REQUEST_PATH.match(scope['path']) else self.worker_pool
+            iterable = await loop.run_in_executor(pool, self.wsgi_app, environ, start_response)
+            iterator = iter(iterable)
+            first_chunk = await loop.run_in_executor(self.io_pool, next, iterator, None) # Generator gọi start_response ở lần next đầu
+            await send({'type': 'http.response.start', 'status': response_state['status'],
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_state['headers']]})
+            for pending in response_state.pop('written', []): await send({'type': 'http.response.body', 'body': pending, 'more_body': True})
+            chunk = first_chunk
+            while chunk is not None:
+                if chunk: await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.io_pool, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except OSError as send_err: logger.info(f"ASGI client went away during response: {send_err}")
+        finally:
+            if 'iterable' in locals() and hasattr(iterable, 'close'): await loop.run_in_executor(self.io_pool, iterable.close)
+            body.close()
+
+    async def _receive_body(self, scope, receive, send, loop):
+        max_length = flask_app.config.get('MAX_CONTENT_LENGTH')
+        declared = next((int(value) for name, value in scope['headers'] if name == b'content-length' and value.isdigit()), None)
+        if max_length and declared and declared > max_length: await self._send_simple(send, 413, b"Conversion failed: err-file-too-large"); return None
+        body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_MEMORY, dir=flask_module.UPLOAD_FOLDER if os.path.isdir(flask_module.UPLOAD_FOLDER) else None)
+        received = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect': body.close(); return None
+            chunk = message.get('body', b'')
+            if chunk:
+                received += len(chunk)
+                if max_length and received > max_length:
+                    body.close(); await self._send_simple(send, 413, b"Conversion failed: err-file-too-large"); return None
+                if received > BODY_SPOOL_MEMORY: await loop.run_in_executor(self.io_pool, body.write, chunk) # Đã/đang chuyển xuống đĩa
+                else: body.write(chunk)
+            if not message.get('more_body', False): break
+        body.seek(0)
+        return body
+
+    def _build_environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'], 'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'), 'SERVER_NAME': str(server[0]), 'SERVER_PORT': str(server[1]),
+            'REMOTE_ADDR': client[0], 'REMOTE_PORT': str(client[1]), 'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': scope.get('scheme', 'http'), 'wsgi.input': body, 'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False, 'wsgi.file_wrapper': _FileWrapper,
+            'wsgi.input_terminated': True, # Body đã nhận đủ (và đã giới hạn MAX_CONTENT_LENGTH) trước khi gọi app
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_'); value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'): environ[name] = value; continue
+            key = f"HTTP_{name}"
+            separator = '; ' if key == 'HTTP_COOKIE' else ',' # HTTP/2 tách Cookie thành nhiều header: nối bằng dấu phẩy làm hỏng cookie session
+            environ[key] = f"{environ[key]}{separator}{value}" if key in environ else value
+        if 'CONTENT_LENGTH' not in environ: # Upload chunked / HTTP/2 không có header: thiếu CONTENT_LENGTH thì Werkzeug coi wsgi.input là rỗng
+            body.seek(0, os.SEEK_END); environ['CONTENT_LENGTH'] = str(body.tell()); body.seek(0)
+        return environ
+
+    async def _send_simple(self, send, status, body):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup': await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.worker_pool.shutdown(wait=False); self.job_pool.shutdown(wait=False); self.io_pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'}); return
+
+application = AsyncWsgiBridge(flask_app)
+
+if __name__ == '__main__':
+    try: import uvicorn
+    except ImportError: logger.critical("uvicorn not found! Install uvicorn to run the ASGI mode."); sys.exit(1)
+    uvicorn.run(application, host=os.environ.get('HOST', '0.0.0.0'), port=int(os.environ.get('PORT', 5003)), proxy_headers=True, log_level='info')
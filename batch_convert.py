@@ -0,0 +1,151 @@
+#Batch convert không qua HTTP: dùng lại các hàm engine của app.py cho job offline (archive DOCX, backlog PDF cần nén...)
+#Ví dụ: python batch_convert.py compress_pdf /data/scans -o /data/compressed --quality low --workers 8
+#        python batch_convert.py docx_to_pdf --manifest files.txt -o /data/pdf
+#Output đã có (mới hơn input) được bỏ qua nên chạy lại sau khi bị ngắt sẽ tiếp tục từ chỗ dừng.
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+os.environ.setdefault('ENGINE_WARMUP', 'False') # CLI không cần warm-up của web server
+os.environ.setdefault('CPU_ENGINE_PROCESSES', '0') # Batch đã chạy mỗi file trong 1 process riêng, không lồng thêm engine pool
+
+OPERATIONS = { # tên -> (đuôi input, đuôi output)
+    'pdf_to_docx': (('pdf',), 'docx'),
+    'docx_to_pdf': (('docx',), 'pdf'),
+    'ppt_to_pdf': (('ppt', 'pptx'), 'pdf'),
+    'pdf_to_ppt': (('pdf',), 'pptx'),
+    'pdf_to_image': (('pdf',), 'zip'),
+    'image_to_pdf': (('jpg', 'jpeg', 'png', 'webp', 'tif', 'tiff'), 'pdf'),
+    'compress_pdf': (('pdf',), 'pdf'),
+}
+
+def collect_inputs(sources, manifest, operation):
+    # Trả về list (input_path, thư mục gốc để giữ cấu trúc thư mục con ở output)
+    input_exts = OPERATIONS[operation][0]
+    matches = lambda path: os.path.isfile(path) and path.rsplit('.', 1)[-1].lower() in input_exts
+    items = []
+    if manifest:
+        with open(manifest, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'): continue
+                path = json.loads(line)['input'] if line.startswith('{') else line
+                if matches(path): items.append((os.path.abspath(path), os.path.dirname(os.path.abspath(path))))
+    for source in sources:
+        if os.path.isdir(source):
+            root = os.path.abspath(source)
+            for dirpath, _, filenames in os.walk(root):
+                items.extend((os.path.join(dirpath, name), root) for name in sorted(filenames) if matches(os.path.join(dirpath, name)))
+        else:
+            for path in sorted(glob.glob(source, recursive=True)):
+                if matches(path): items.append((os.path.abspath(path), os.path.dirname(os.path.abspath(path))))
+    seen = set()
+    return [item for item in items if not (item[0] in seen or seen.add(item[0]))]
+
+def output_path_for(input_path, root, output_dir, operation):
+    relative = os.path.splitext(os.path.relpath(input_path, root))[0]
+    return os.path.join(output_dir, f"{relative}.{OPERATIONS[operation][1]}")
+
+def is_done(input_path, output_path):
+    return os.path.isfile(output_path) and os.path.getsize(output_path) > 0 and os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+
+def run_conversion(operation, input_path, output_path, options):
+    import app # Import trong worker: mỗi process có engine/profile LibreOffice riêng
+    pages = None
+    if options.get('pages') and input_path.lower().endswith('.pdf'):
+        pages = app.parse_page_ranges(options['pages'], app.get_pdf_page_count(input_path))
+    if operation in ('pdf_to_docx', 'docx_to_pdf', 'ppt_to_pdf', 'pdf_to_ppt'):
+        # Cùng planner với route /convert: chuỗi engine rẻ nhất, engine lỗi thì thử chuỗi khác
+        with tempfile.TemporaryDirectory(prefix='batch_plan_', dir=os.path.dirname(output_path)) as scratch_dir:
+            target = 'docx-text' if operation == 'pdf_to_docx' and options.get('docx_mode') == 'text' else OPERATIONS[operation][1]
+            return app.run_conversion_plan(input_path.rsplit('.', 1)[-1].lower(), target, input_path, output_path,
+                                           lambda name: os.path.join(scratch_dir, name), pages_spec=options.get('pages', ''), pages=pages)
+    if operation == 'pdf_to_image':
+        image_options = app.parse_image_options({'image_format': options['image_format'], 'color_mode': options['color'], 'dpi': options['dpi']})
+        return app.convert_pdf_to_image_zip(input_path, output_path, pages=pages, **image_options)
+    if operation == 'image_to_pdf':
+        return app.convert_images_to_pdf([input_path], output_path, **app.parse_image_pdf_options({'page_size': options['page_size'], 'dpi': options['dpi']}))
+    if operation == 'compress_pdf':
+        exclude = app.compress_engine_exclusions(options['quality'], options.get('compress_engine'))
+        with tempfile.TemporaryDirectory(prefix='batch_plan_', dir=os.path.dirname(output_path)) as scratch_dir:
+            return app.run_conversion_plan('pdf', 'pdf-min', input_path, output_path, lambda name: os.path.join(scratch_dir, name), pages=pages,
+                                           options={'quality': options['quality']}, exclude=exclude)
+    raise ValueError(f"Unknown operation {operation}")
+
+def process_file(operation, input_path, output_path, options):
+    # Chạy trong process pool. Ghi ra file tạm rồi os.replace: file output dở dang không bao giờ bị coi là xong
+    started = time.time()
+    record = {'input': input_path, 'output': output_path, 'bytes_in': os.path.getsize(input_path)}
+    ext = output_path.rsplit('.', 1)[-1]
+    partial_path = f"{output_path}.partial.{ext}"
+    try:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        if not run_conversion(operation, input_path, partial_path, options) or not os.path.isfile(partial_path) or os.path.getsize(partial_path) == 0:
+            raise RuntimeError("err-conversion")
+        os.replace(partial_path, output_path)
+        record.update(status='ok', bytes_out=os.path.getsize(output_path))
+    except Exception as e:
+        record.update(status='failed', error=str(e) if str(e).startswith('err-') else f"err-unknown: {e}")
+        if os.path.exists(partial_path): os.remove(partial_path)
+    record['seconds'] = round(time.time() - started, 3)
+    return record
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch convert files with the Convert All Files engines (no web server).")
+    parser.add_argument('operation', choices=sorted(OPERATIONS))
+    parser.add_argument('sources', nargs='*', help="Input files, directories (recursive) or glob patterns")
+    parser.add_argument('--manifest', help="Text file with one input path per line (or JSON lines with an 'input' key)")
+    parser.add_argument('-o', '--output-dir', required=True)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--summary', help="JSON summary path (default: <output-dir>/batch_summary.json)")
+    parser.add_argument('--force', action='store_true', help="Convert again even if the output is up to date")
+    parser.add_argument('--pages', default='', help="Page selection for PDF inputs, e.g. 1-5,8")
+    parser.add_argument('--quality', choices=['low', 'medium', 'high'], default='medium')
+    parser.add_argument('--image-format', default='jpeg')
+    parser.add_argument('--color', default='color')
+    parser.add_argument('--dpi', type=int, default=200)
+    parser.add_argument('--page-size', default='fit')
+    parser.add_argument('--compress-engine', choices=['images', 'ghostscript', 'auto'], help="compress_pdf engine (default: COMPRESS_PDF_ENGINES for the quality). "
+                        "Run once per engine on the same inputs and compare the summaries' totals to benchmark them")
+    parser.add_argument('--docx-mode', choices=['layout', 'text'], default='layout', help="pdf_to_docx: full layout (pdf2docx) or text only (faster)")
+    args = parser.parse_args(argv)
+    if not args.sources and not args.manifest: parser.error("give at least one source or --manifest")
+
+    options = {'pages': args.pages, 'quality': args.quality, 'image_format': args.image_format, 'color': args.color, 'dpi': args.dpi, 'page_size': args.page_size, 'docx_mode': args.docx_mode, 'compress_engine': args.compress_engine}
+    output_dir = os.path.abspath(args.output_dir)
+    jobs, records = [], []
+    for input_path, root in collect_inputs(args.sources, args.manifest, args.operation):
+        output_path = output_path_for(input_path, root, output_dir, args.operation)
+        if not args.force and is_done(input_path, output_path): records.append({'input': input_path, 'output': output_path, 'status': 'skipped', 'seconds': 0.0})
+        else: jobs.append((input_path, output_path))
+    print(f"{args.operation}: {len(jobs)} to convert, {len(records)} already done, {max(1, args.workers)} workers", file=sys.stderr)
+
+    started = time.time()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(process_file, args.operation, input_path, output_path, options): input_path for input_path, output_path in jobs}
+        for done_count, future in enumerate(as_completed(futures), 1):
+            try: record = future.result()
+            except Exception as worker_err: record = {'input': futures[future], 'status': 'failed', 'error': f"err-unknown: {worker_err}", 'seconds': None} # Worker chết (OOM...)
+            records.append(record)
+            print(f"[{done_count}/{len(jobs)}] {record['status']} {record['input']} ({record.get('seconds')}s){' ' + record['error'] if record.get('error') else ''}", file=sys.stderr)
+
+    counts = {status: sum(1 for record in records if record['status'] == status) for status in ('ok', 'skipped', 'failed')}
+    converted = [record for record in records if record['status'] == 'ok']
+    bytes_in = sum(record['bytes_in'] for record in converted); bytes_out = sum(record['bytes_out'] for record in converted)
+    totals = {'bytes_in': bytes_in, 'bytes_out': bytes_out, 'ratio': round(bytes_out / bytes_in, 4) if bytes_in else None,
+              'engine_seconds': round(sum(record['seconds'] for record in converted), 3)}
+    summary = {'operation': args.operation, 'options': options, 'started_at': started, 'elapsed': round(time.time() - started, 3), 'counts': counts, 'totals': totals,
+               'files': sorted(records, key=lambda record: record['input'])}
+    summary_path = args.summary or os.path.join(output_dir, 'batch_summary.json')
+    os.makedirs(os.path.dirname(summary_path) or '.', exist_ok=True)
+    with open(summary_path, 'w', encoding='utf-8') as f: json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"Done in {summary['elapsed']}s: {counts}, output/input {totals['ratio']}. Summary: {summary_path}", file=sys.stderr)
+    return 1 if counts['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
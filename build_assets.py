@@ -0,0 +1,144 @@
+#Build asset frontend cho production, thay Tailwind CDN (compile CSS trong trình duyệt mỗi lần tải trang) + Google Fonts:
+#  - CSS Tailwind chỉ gồm class thật sự dùng trong templates/ và static/app.js (Tailwind standalone CLI v3, không cần Node)
+#  - font Roboto 400/500/700/900 tự host, subset Latin + tiếng Việt, WOFF2, font-display: swap
+#  - app.css = Tailwind + @font-face + styles.css + page.css (1 request CSS chặn render thay vì 4 request tới 3 host)
+#  - tên file theo hash nội dung trong static/dist + bản .br/.gz nén sẵn; app.py đọc manifest.json (asset_url) và trả
+#    Cache-Control immutable. Không có static/dist thì app.py quay về chế độ dev (CDN) như trước.
+#Ví dụ: TAILWIND_BIN=/opt/tailwindcss python build_assets.py
+#       python build_assets.py --report     (dung lượng truyền của trang chủ sau khi build)
+#Cần: Tailwind standalone CLI v3 (TAILWIND_BIN hoặc tailwindcss trong PATH), requirements-build.txt,
+#     Roboto TTF (apt: fonts-roboto-unhinted, hoặc FONT_SOURCE_DIR=thư mục chứa Roboto-Regular.ttf...)
+import os
+import sys
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+try: import brotli
+except ImportError: brotli = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(REPO_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+TAILWIND_CONFIG = os.path.join(REPO_DIR, 'tailwind.config.js')
+CSS_SOURCES = ('styles.css', 'page.css') # Nạp sau Tailwind, cùng thứ tự với <head> ở chế độ dev
+JS_SOURCES = ('app.js', 'image-worker.js')
+FONT_SOURCE_DIRS = ('/usr/share/fonts/truetype/roboto/unhinted/RobotoTTF', '/usr/share/fonts/truetype/roboto/unhinted',
+                    '/usr/share/fonts/truetype/roboto/hinted', '/usr/share/fonts/truetype/roboto')
+FONT_FILES = {400: 'Roboto-Regular.ttf', 500: 'Roboto-Medium.ttf', 700: 'Roboto-Bold.ttf', 900: 'Roboto-Black.ttf'}
+FONT_UNICODE_RANGE = ('U+0000-00FF, U+0102-0103, U+0110-0111, U+0128-0129, U+0168-0169, U+01A0-01A1, U+01AF-01B0, '
+                      'U+0300-0301, U+0303-0304, U+0308-0309, U+0323, U+1EA0-1EF9, U+2000-206F, U+20AB, U+20AC, U+2190-2193, U+2212') # Latin + tiếng Việt
+FONT_LAYOUT_FEATURES = ['kern', 'liga', 'ccmp', 'locl', 'mark', 'mkmk'] # mark/mkmk: dấu tiếng Việt dạng tổ hợp
+PRECOMPRESS_MIN_BYTES = 512
+PRECOMPRESS_SKIP_EXTS = ('.woff2',) # Đã nén sẵn trong định dạng
+
+def content_name(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+def minify_css(css):
+    # Chỉ bỏ comment/khoảng trắng thừa (không đụng selector) - brotli lo phần còn lại
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    return re.sub(r'\s*([{};,])\s*', r'\1', css).replace(';}', '}').strip() + '\n'
+
+def find_tailwind():
+    binary = os.environ.get('TAILWIND_BIN') or shutil.which('tailwindcss')
+    if not binary or not os.access(binary, os.X_OK):
+        sys.exit("Tailwind standalone CLI not found. Download tailwindcss-linux-x64 (v3) from "
+                 "https://github.com/tailwindlabs/tailwindcss/releases and set TAILWIND_BIN or put it in PATH as 'tailwindcss'.")
+    return binary
+
+def build_tailwind_css():
+    # Cùng theme mặc định với CDN; content trong tailwind.config.js quyết định class nào được giữ lại
+    with tempfile.TemporaryDirectory(prefix='tailwind_build_') as work_dir:
+        input_path = os.path.join(work_dir, 'input.css'); output_path = os.path.join(work_dir, 'tailwind.css')
+        with open(input_path, 'w', encoding='utf-8') as f: f.write("@tailwind base;\n@tailwind components;\n@tailwind utilities;\n")
+        subprocess.run([find_tailwind(), '--config', TAILWIND_CONFIG, '--input', input_path, '--output', output_path, '--minify'],
+                       cwd=REPO_DIR, check=True, stdout=subprocess.DEVNULL)
+        with open(output_path, encoding='utf-8') as f: return f.read()
+
+def find_font_dir():
+    candidates = ([os.environ['FONT_SOURCE_DIR']] if os.environ.get('FONT_SOURCE_DIR') else []) + list(FONT_SOURCE_DIRS)
+    for directory in candidates:
+        if all(os.path.isfile(os.path.join(directory, filename)) for filename in FONT_FILES.values()): return directory
+    sys.exit(f"Roboto TTF files {sorted(FONT_FILES.values())} not found in {candidates}. Install fonts-roboto-unhinted or set FONT_SOURCE_DIR.")
+
+def subset_font(path):
+    from fontTools import subset
+    options = subset.Options(); options.flavor = 'woff2'; options.layout_features = FONT_LAYOUT_FEATURES
+    font = subset.load_font(path, options)
+    try:
+        subsetter = subset.Subsetter(options); subsetter.populate(unicodes=subset.parse_unicodes(FONT_UNICODE_RANGE)); subsetter.subset(font)
+        buffer = BytesIO(); subset.save_font(font, buffer, options)
+        return buffer.getvalue()
+    finally: font.close()
+
+def write_asset(name, data, manifest):
+    hashed = content_name(name, data)
+    with open(os.path.join(DIST_DIR, hashed), 'wb') as f: f.write(data)
+    if len(data) >= PRECOMPRESS_MIN_BYTES and not hashed.endswith(PRECOMPRESS_SKIP_EXTS):
+        for suffix, compressed in (('.br', brotli.compress(data, quality=11)), ('.gz', gzip.compress(data, compresslevel=9, mtime=0))):
+            if len(compressed) < len(data): # Nén không lợi thì để server gửi bản gốc
+                with open(os.path.join(DIST_DIR, hashed + suffix), 'wb') as f: f.write(compressed)
+    manifest[name] = hashed
+    return hashed
+
+def build():
+    if not brotli: sys.exit("brotli not installed (needed for WOFF2 fonts and .br files): pip install -r requirements-build.txt")
+    tailwind_css = build_tailwind_css()
+    font_dir = find_font_dir()
+    if os.path.isdir(DIST_DIR): shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+    manifest = {}
+    font_faces = []
+    for weight, filename in sorted(FONT_FILES.items()):
+        font_name = write_asset(f"roboto-{weight}.woff2", subset_font(os.path.join(font_dir, filename)), manifest)
+        font_faces.append(f"@font-face{{font-family:'Roboto';font-style:normal;font-weight:{weight};font-display:swap;"
+                          f"src:url({font_name}) format('woff2');unicode-range:{FONT_UNICODE_RANGE}}}") # url tương đối: cùng thư mục dist
+    own_css = ''
+    for name in CSS_SOURCES:
+        with open(os.path.join(STATIC_DIR, name), encoding='utf-8') as f: own_css += f.read() + '\n'
+    write_asset('app.css', ('\n'.join(font_faces) + '\n' + tailwind_css.strip() + '\n' + minify_css(own_css)).encode('utf-8'), manifest)
+    for name in JS_SOURCES:
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f: write_asset(name, f.read(), manifest)
+    with open(os.path.join(DIST_DIR, 'manifest.json'), 'w', encoding='utf-8') as f: json.dump(manifest, f, indent=2, sort_keys=True) # Ghi cuối: app.py chỉ bật khi đủ file
+    print(f"Built {len(manifest)} assets into {os.path.relpath(DIST_DIR, REPO_DIR)}", file=sys.stderr)
+    return manifest
+
+def encoded_size(path):
+    # Dung lượng truyền thực tế: bản nén tốt nhất mà server sẽ gửi cho trình duyệt hiện đại
+    return min(os.path.getsize(candidate) for candidate in (path, path + '.br', path + '.gz') if os.path.isfile(candidate))
+
+def report():
+    os.environ.setdefault('ENGINE_WARMUP', 'False'); os.environ.setdefault('CPU_ENGINE_PROCESSES', '0')
+    sys.path.insert(0, REPO_DIR)
+    import app as flask_module
+    if not flask_module.ASSETS_BUILT: sys.exit("No built assets (static/dist/manifest.json): run python build_assets.py first")
+    flask_module.app.config['WTF_CSRF_ENABLED'] = False
+    html = flask_module.app.test_client().get('/').get_data()
+    rows = [('index.html (gzip)', len(html), len(gzip.compress(html, 9)))] # HTML động: nén bởi reverse proxy
+    for name, hashed in sorted(flask_module.ASSET_MANIFEST.items()):
+        path = os.path.join(DIST_DIR, hashed)
+        rows.append((name, os.path.getsize(path), encoded_size(path)))
+    print(f"{'asset':<22}{'raw bytes':>12}{'transfer':>12}")
+    for name, raw, transferred in rows: print(f"{name:<22}{raw:>12}{transferred:>12}")
+    # Lần tải đầu: HTML + CSS + JS trang + font thường (các weight khác chỉ tải khi cần). Lần sau: chỉ HTML (asset immutable).
+    first_view = rows[0][2] + sum(transferred for name, _, transferred in rows[1:] if name in ('app.css', 'app.js', 'roboto-400.woff2'))
+    print(f"first view ~{first_view} bytes from 1 origin, 0 third-party render-blocking requests; repeat view ~{rows[0][2]} bytes")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build hashed, precompressed frontend assets into static/dist.")
+    parser.add_argument('--report', action='store_true', help="Print the transfer size of the index page with the built assets (no build)")
+    args = parser.parse_args(argv)
+    if args.report: report()
+    else: build()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,535 @@
+#Load/soak test: chạy app local (Waitress hoặc ASGI) với corpus tự sinh, đo throughput, latency đuôi, RSS, fd, file tạm còn sót và process soffice/gs mồ côi
+#Ví dụ: python load_test.py mix app.log -o mix.json                          (mix loại job + kích thước từ log "Job <kind> (<lane>): features=...")
+#        python load_test.py ramp --levels 1,2,4,8,16,32 --step-seconds 120 --mix mix.json -o runs/ramp
+#        python load_test.py soak --concurrency 8 --hours 4 --mix mix.json -o runs/soak
+#        python load_test.py replay --url http://127.0.0.1:5003 --server-pid 1234 --mix mix.json --requests 500 -o runs/replay
+#Kết quả trong thư mục -o: requests.csv, samples.csv, summary.json, report.html (biểu đồ SVG, không cần thư viện vẽ)
+import os
+import re
+import io
+import ast
+import csv
+import sys
+import json
+import time
+import uuid
+import random
+import signal
+import shutil
+import socket
+import argparse
+import threading
+import subprocess
+import http.cookiejar
+import urllib.request
+import urllib.error
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+JOB_LOG_PATTERN = re.compile(r"Job (\w+) \((\w+)\): features=(\{[^}]*\})")
+CSRF_PATTERN = re.compile(r'name="csrf_token" value="([^"]+)"')
+ENGINE_PROCESS_NAMES = ('soffice', 'soffice.bin', 'oosplash', 'gs', 'gswin64c', 'pdftoppm')
+TEMP_FOLDERS = ('jobs', 'flights') # Thư mục chỉ chứa file của job đang chạy: còn file sau cool-down là rò rỉ
+CACHE_FOLDERS = ('downloads', 'previews') # Giữ có chủ đích (TTL), báo riêng
+MAX_CORPUS_PAGES = 400
+MAX_CORPUS_BYTES = 80 * 1024 * 1024
+REQUEST_TIMEOUT = 1900 # Lớn hơn JOB_TIMEOUT_RANGE tối đa của app
+
+KIND_REQUESTS = { # kind trong log -> (route, field file, đuôi corpus, form thêm)
+    'pdf_to_docx': ('/convert', 'file', 'pdf', {'conversion_type': 'pdf_to_docx'}),
+    'pdf_to_docx_text': ('/convert', 'file', 'pdf', {'conversion_type': 'pdf_to_docx', 'mode': 'text'}),
+    'pdf_to_ppt': ('/convert', 'file', 'pdf', {'conversion_type': 'pdf_to_ppt'}),
+    'office_to_pdf': ('/convert', 'file', 'docx', {'conversion_type': 'docx_to_pdf'}),
+    'pdf_to_image': ('/convert_image', 'image_file', 'pdf', {'image_format': 'jpeg', 'dpi': '150'}),
+    'image_to_pdf': ('/convert_image', 'image_file', 'jpg', {}),
+    'compress_pdf': ('/compress_pdf', 'file', 'pdf', {'quality': 'medium'}),
+    'compress_docx': ('/compress_docx', 'file', 'docx', {}),
+}
+
+DEFAULT_MIX = [
+    {'kind': 'pdf_to_docx', 'pages': 3, 'bytes': 300_000, 'images': 2, 'weight': 4},
+    {'kind': 'pdf_to_docx', 'pages': 25, 'bytes': 2_500_000, 'images': 10, 'weight': 1},
+    {'kind': 'office_to_pdf', 'pages': 5, 'bytes': 200_000, 'images': 1, 'weight': 3},
+    {'kind': 'compress_pdf', 'pages': 10, 'bytes': 6_000_000, 'images': 10, 'weight': 2},
+    {'kind': 'pdf_to_image', 'pages': 4, 'bytes': 400_000, 'images': 2, 'weight': 1},
+    {'kind': 'image_to_pdf', 'pages': 3, 'bytes': 1_500_000, 'images': 3, 'weight': 1},
+    {'kind': 'pdf_to_ppt', 'pages': 8, 'bytes': 800_000, 'images': 4, 'weight': 1},
+]
+
+# ---------- Mix từ log ----------
+
+def _log_message(line):
+    # Log text hoặc JSON lines (LOG_FORMAT=json): lấy phần message
+    if line.lstrip().startswith('{'):
+        try: return json.loads(line).get('message', '')
+        except ValueError: return line
+    return line
+
+def build_mix(log_paths, buckets_per_kind=4):
+    # Gom job theo kind + bucket kích thước log2, đại diện mỗi bucket bằng median. Log chỉ có số trang/byte/ảnh, không có tên file
+    samples = {}
+    for log_path in log_paths:
+        with open(log_path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = JOB_LOG_PATTERN.search(_log_message(line))
+                if not match or match.group(1) not in KIND_REQUESTS: continue
+                try: features = ast.literal_eval(match.group(3))
+                except (ValueError, SyntaxError): continue
+                samples.setdefault(match.group(1), []).append(features)
+    mix = []
+    for kind, features_list in sorted(samples.items()):
+        groups = {}
+        for features in features_list: groups.setdefault(max(0, int(features.get('bytes', 0))).bit_length(), []).append(features)
+        ordered = sorted(groups.items(), key=lambda item: -len(item[1]))
+        merged = {bucket: group for bucket, group in ordered[:buckets_per_kind]}
+        for bucket, group in ordered[buckets_per_kind:]: # Bucket hiếm gộp vào bucket giữ lại gần nhất
+            merged[min(merged, key=lambda kept: abs(kept - bucket))].extend(group)
+        for bucket, group in sorted(merged.items()):
+            median = lambda key: sorted(int(features.get(key, 0)) for features in group)[len(group) // 2]
+            mix.append({'kind': kind, 'pages': max(1, median('pages')), 'bytes': max(1, median('bytes')), 'images': median('images'), 'weight': len(group)})
+    return mix
+
+def load_mix(mix_path):
+    if not mix_path: return DEFAULT_MIX
+    with open(mix_path, encoding='utf-8') as f: mix = json.load(f)
+    mix = mix.get('items', mix) if isinstance(mix, dict) else mix
+    unknown = sorted({item['kind'] for item in mix} - set(KIND_REQUESTS))
+    if unknown: raise SystemExit(f"Unknown job kinds in mix: {', '.join(unknown)}")
+    return mix
+
+# ---------- Corpus ----------
+
+def _noise_jpeg(target_bytes, seed):
+    # Ảnh nhiễu + gradient: JPEG q85 khoảng 0.75 byte/pixel, nén kém như ảnh scan thật
+    from PIL import Image
+    side = max(64, min(4000, int((max(target_bytes, 4096) / 0.75) ** 0.5)))
+    rng = random.Random(seed)
+    noise = Image.frombytes('L', (side, side), bytes(rng.getrandbits(8) for _ in range(side * side)))
+    image = Image.merge('RGB', (noise, noise.rotate(90), Image.linear_gradient('L').resize((side, side))))
+    buffer = io.BytesIO(); image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+def _filler_text(rng, words=220):
+    vocabulary = ('hợp đồng', 'báo cáo', 'invoice', 'quarterly', 'revenue', 'tài liệu', 'phụ lục', 'signature', 'table', 'summary', 'điều khoản', 'delivery')
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+def make_corpus_file(item, corpus_dir):
+    # Mỗi (kind, pages, bytes, images) sinh một lần rồi dùng lại giữa các lần chạy
+    ext = KIND_REQUESTS[item['kind']][2]
+    pages = max(1, min(MAX_CORPUS_PAGES, int(item.get('pages', 1))))
+    total_bytes = max(10_000, min(MAX_CORPUS_BYTES, int(item.get('bytes', 100_000))))
+    images = max(1 if ext == 'jpg' else 0, min(pages * 4, int(item.get('images', 0))))
+    stem = f"{ext}_{pages}p_{total_bytes}b_{images}i"
+    if ext == 'jpg':
+        paths = [os.path.join(corpus_dir, f"{stem}_{index}.jpg") for index in range(images)]
+        for index, path in enumerate(paths):
+            if not os.path.isfile(path):
+                with open(path, 'wb') as f: f.write(_noise_jpeg(total_bytes // images, f"{stem}-{index}"))
+        return paths
+    path = os.path.join(corpus_dir, f"{stem}.{ext}")
+    if os.path.isfile(path): return [path]
+    rng = random.Random(stem)
+    image_bytes = max(0, total_bytes - pages * 3000) // images if images else 0
+    image_blob = lambda index: _noise_jpeg(image_bytes, f"{stem}-{index}") # Mỗi ảnh khác nhau: PyMuPDF/python-docx dedup ảnh trùng nên file sẽ nhỏ hơn mix
+    partial_path = f"{path}.partial"
+    if ext == 'pdf':
+        import fitz
+        document = fitz.open()
+        for page_index in range(pages):
+            page = document.new_page()
+            page.insert_textbox(fitz.Rect(50, 50, 545, 420), _filler_text(rng), fontsize=10)
+            for image_index in range(page_index, images, pages):
+                slot = image_index // pages
+                page.insert_image(fitz.Rect(50 + 130 * (slot % 4), 440 + 130 * (slot // 4 % 3), 170 + 130 * (slot % 4), 560 + 130 * (slot // 4 % 3)), stream=image_blob(image_index))
+        document.save(partial_path, garbage=3, deflate=True); document.close()
+    else:
+        import docx
+        from docx.shared import Inches
+        document = docx.Document()
+        document.add_heading(f"Load test {stem}", level=1)
+        for page_index in range(pages):
+            for _ in range(4): document.add_paragraph(_filler_text(rng, 90))
+            for image_index in range(page_index, images, pages): document.add_picture(io.BytesIO(image_blob(image_index)), width=Inches(2.5))
+            if page_index < pages - 1: document.add_page_break()
+        document.save(partial_path)
+    os.replace(partial_path, path)
+    return [path]
+
+def prepare_corpus(mix, corpus_dir):
+    os.makedirs(corpus_dir, exist_ok=True)
+    started = time.time()
+    files = [make_corpus_file(item, corpus_dir) for item in mix]
+    print(f"Corpus ready in {time.time() - started:.1f}s: {sum(len(paths) for paths in files)} files in {corpus_dir}", file=sys.stderr)
+    return files
+
+# ---------- HTTP client ----------
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+    for name, path in files:
+        mime = 'image/jpeg' if path.endswith('.jpg') else 'application/pdf' if path.endswith('.pdf') else 'application/octet-stream'
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{os.path.basename(path)}"\r\nContent-Type: {mime}\r\n\r\n'.encode('utf-8'))
+        with open(path, 'rb') as f: shutil.copyfileobj(f, body)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode('utf-8'))
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+class LoadClient:
+    # Mỗi worker một client: cookie session + CSRF token riêng như trình duyệt thật
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.csrf_token = None
+
+    def refresh_token(self):
+        with self.opener.open(f"{self.base_url}/", timeout=60) as response: html = response.read().decode('utf-8', errors='replace')
+        match = CSRF_PATTERN.search(html)
+        self.csrf_token = match.group(1) if match else ''
+
+    def run_job(self, item, paths):
+        route, field, _, form = KIND_REQUESTS[item['kind']]
+        if self.csrf_token is None: self.refresh_token()
+        body, content_type = encode_multipart(dict(form, csrf_token=self.csrf_token), [(field, path) for path in paths])
+        request = urllib.request.Request(f"{self.base_url}{route}", data=body, headers={'Content-Type': content_type, 'Referer': f"{self.base_url}/"})
+        started = time.time(); error = ''; response_bytes = 0
+        try:
+            with self.opener.open(request, timeout=REQUEST_TIMEOUT) as response:
+                status = response.status
+                while True:
+                    chunk = response.read(256 * 1024)
+                    if not chunk: break
+                    response_bytes += len(chunk)
+        except urllib.error.HTTPError as http_err:
+            status = http_err.code
+            text = http_err.read().decode('utf-8', errors='replace')
+            error = next(iter(re.findall(r'err-[\w-]+', text)), text[:80].replace('\n', ' '))
+            if 'csrf' in error: self.csrf_token = None # Token hết hạn: lấy lại cho request sau
+        except (urllib.error.URLError, OSError) as net_err:
+            status = 0; error = f"network: {getattr(net_err, 'reason', net_err)}"
+        return {'kind': item['kind'], 'pages': item.get('pages'), 'bytes_in': len(body), 'status': status, 'error': error,
+                'bytes_out': response_bytes, 'started': round(started, 3), 'latency': round(time.time() - started, 3)}
+
+# ---------- Server + tài nguyên ----------
+
+SERVER_BOOTSTRAP = {
+    'waitress': "import app; app.limiter.enabled = {limits}; from waitress import serve; serve(app.app, host='127.0.0.1', port={port}, threads=app.WAITRESS_THREADS)",
+    'asgi': "import asgi, uvicorn; asgi.flask_module.limiter.enabled = {limits}; uvicorn.run(asgi.application, host='127.0.0.1', port={port}, log_level='warning')",
+}
+
+def _free_port():
+    with socket.socket() as probe: probe.bind(('127.0.0.1', 0)); return probe.getsockname()[1]
+
+def start_server(kind, workdir, keep_limits, env_overrides):
+    # cwd riêng => UPLOAD_FOLDER riêng; tmpfs jobs riêng => đếm file sót không lẫn với process khác
+    port = _free_port()
+    server_dir = os.path.join(workdir, 'server'); os.makedirs(server_dir, exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    if os.path.isdir('/dev/shm'): env.setdefault('TMPFS_JOBS_FOLDER', os.path.join('/dev/shm', f"convert_all_files_loadtest_{port}"))
+    env.update(env_overrides)
+    log_file = open(os.path.join(workdir, 'server.log'), 'ab')
+    process = subprocess.Popen([sys.executable, '-c', SERVER_BOOTSTRAP[kind].format(limits=bool(keep_limits), port=port)], cwd=server_dir, env=env,
+                               stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 180
+    while time.time() < deadline: # Chờ /readyz (warm-up xong) trước khi bắt đầu đo
+        if process.poll() is not None: raise SystemExit(f"Server exited with {process.returncode}, see {log_file.name}")
+        try:
+            with urllib.request.urlopen(f"{base_url}/readyz", timeout=5) as response:
+                if response.status == 200: break
+        except (urllib.error.URLError, OSError): pass
+        time.sleep(1)
+    else: print("Server not ready after 180s, starting anyway", file=sys.stderr)
+    return process, base_url, os.path.join(server_dir, 'uploads'), env.get('TMPFS_JOBS_FOLDER', '')
+
+def stop_server(process):
+    if process.poll() is not None: return
+    process.send_signal(signal.SIGTERM)
+    try: process.wait(timeout=30)
+    except subprocess.TimeoutExpired: process.kill(); process.wait()
+
+def _read_proc(pid, name):
+    try:
+        with open(f"/proc/{pid}/{name}", encoding='utf-8', errors='replace') as f: return f.read()
+    except OSError: return ''
+
+def process_table():
+    # pid -> (ppid, tên, rss byte, giây từ lúc boot khi start). Chỉ Linux (/proc)
+    table = {}
+    page_size = os.sysconf('SC_PAGE_SIZE'); ticks = os.sysconf('SC_CLK_TCK')
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not entry.isdigit(): continue
+        stat = _read_proc(entry, 'stat')
+        if not stat: continue
+        name = stat[stat.find('(') + 1:stat.rfind(')')]
+        fields = stat[stat.rfind(')') + 2:].split()
+        table[int(entry)] = (int(fields[1]), name, int(fields[21]) * page_size, int(fields[19]) / ticks)
+    return table
+
+def _descendants(table, root_pid):
+    children = {}
+    for pid, (ppid, *_) in table.items(): children.setdefault(ppid, []).append(pid)
+    found, stack = set(), [root_pid]
+    while stack:
+        pid = stack.pop()
+        if pid in table and pid not in found: found.add(pid); stack.extend(children.get(pid, []))
+    return found
+
+def _folder_usage(path):
+    count = size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try: size += os.path.getsize(os.path.join(dirpath, name)); count += 1
+            except OSError: pass
+    return count, size
+
+def sample_resources(server_pid, uploads_dir, tmpfs_dir):
+    table = process_table()
+    tree = _descendants(table, server_pid) if server_pid else set()
+    engines = [(pid, table[pid][1]) for pid in table if table[pid][1] in ENGINE_PROCESS_NAMES]
+    sample = {'time': round(time.time(), 3), 'server_rss': table.get(server_pid, (0, '', 0))[2], 'tree_rss': sum(table[pid][2] for pid in tree),
+              'open_fds': len(os.listdir(f"/proc/{server_pid}/fd")) if server_pid and os.path.isdir(f"/proc/{server_pid}/fd") else 0,
+              'threads': int(next(iter(re.findall(r'Threads:\s+(\d+)', _read_proc(server_pid, 'status'))), 0)) if server_pid else 0,
+              'engine_procs': sum(1 for pid, _ in engines if pid in tree), 'orphan_engine_procs': sum(1 for pid, _ in engines if pid not in tree)}
+    temp_files = temp_bytes = 0
+    for folder in [os.path.join(uploads_dir, name) for name in TEMP_FOLDERS] + ([tmpfs_dir] if tmpfs_dir else []):
+        count, size = _folder_usage(folder); temp_files += count; temp_bytes += size
+    uploads_files, uploads_bytes = _folder_usage(uploads_dir)
+    sample.update(temp_files=temp_files, temp_bytes=temp_bytes, uploads_files=uploads_files, uploads_bytes=uploads_bytes)
+    return sample
+
+def leak_report(server_pid, uploads_dir, tmpfs_dir, baseline_engines):
+    # Sau cool-down: file còn trong thư mục job (không phải cache có TTL) và process engine không thuộc cây process của server
+    leftovers = []
+    for folder in [os.path.join(uploads_dir, name) for name in TEMP_FOLDERS] + ([tmpfs_dir] if tmpfs_dir else []):
+        for dirpath, _, filenames in os.walk(folder):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try: leftovers.append({'path': path, 'bytes': os.path.getsize(path), 'age': round(time.time() - os.path.getmtime(path), 1)})
+                except OSError: pass
+    loose = [name for name in (os.listdir(uploads_dir) if os.path.isdir(uploads_dir) else []) if os.path.isfile(os.path.join(uploads_dir, name))]
+    table = process_table()
+    tree = _descendants(table, server_pid) if server_pid else set()
+    with open('/proc/stat', encoding='utf-8') as f: boot_time = next((float(line.split()[1]) for line in f if line.startswith('btime')), 0)
+    orphans = [{'pid': pid, 'name': table[pid][1], 'ppid': table[pid][0], 'started': round(boot_time + table[pid][3], 1)}
+               for pid in table if table[pid][1] in ENGINE_PROCESS_NAMES and pid not in tree and pid not in baseline_engines]
+    engines_alive = [{'pid': pid, 'name': table[pid][1]} for pid in tree if table[pid][1] in ENGINE_PROCESS_NAMES]
+    caches = {name: dict(zip(('files', 'bytes'), _folder_usage(os.path.join(uploads_dir, name)))) for name in CACHE_FOLDERS}
+    return {'leftover_temp_files': leftovers, 'loose_upload_files': loose, 'orphan_engine_processes': orphans, 'server_engine_processes': engines_alive, 'caches': caches}
+
+class ResourceSampler(threading.Thread):
+    def __init__(self, server_pid, uploads_dir, tmpfs_dir, interval, writer):
+        super().__init__(daemon=True)
+        self.args = (server_pid, uploads_dir, tmpfs_dir); self.interval = interval; self.writer = writer
+        self.stop_event = threading.Event(); self.samples = []; self.phase = ''
+    def run(self):
+        while not self.stop_event.is_set():
+            sample = dict(sample_resources(*self.args), phase=self.phase)
+            self.samples.append(sample); self.writer(sample)
+            self.stop_event.wait(self.interval)
+
+# ---------- Chạy tải ----------
+
+class CsvLog:
+    def __init__(self, path, fields):
+        self.file = open(path, 'w', newline='', encoding='utf-8'); self.lock = threading.Lock()
+        self.writer = csv.DictWriter(self.file, fieldnames=fields, extrasaction='ignore'); self.writer.writeheader()
+    def __call__(self, row):
+        with self.lock: self.writer.writerow(row); self.file.flush()
+    def close(self): self.file.close()
+
+REQUEST_FIELDS = ['phase', 'concurrency', 'kind', 'pages', 'bytes_in', 'status', 'error', 'bytes_out', 'started', 'latency']
+SAMPLE_FIELDS = ['time', 'phase', 'server_rss', 'tree_rss', 'open_fds', 'threads', 'engine_procs', 'orphan_engine_procs', 'temp_files', 'temp_bytes', 'uploads_files', 'uploads_bytes']
+
+def run_phase(base_url, mix, corpus, concurrency, phase, log_request, duration=None, max_requests=None, seed=0):
+    # Closed loop: `concurrency` client, mỗi client gửi job kế tiếp ngay khi job trước xong. Dừng theo thời gian hoặc số request
+    weights = [max(0, float(item.get('weight', 1))) for item in mix]
+    deadline = time.time() + duration if duration else None
+    counter = {'sent': 0}; counter_lock = threading.Lock(); records = []
+    def worker(worker_index):
+        rng = random.Random(f"{seed}-{phase}-{worker_index}")
+        client = LoadClient(base_url)
+        while True:
+            with counter_lock:
+                if (deadline and time.time() >= deadline) or (max_requests and counter['sent'] >= max_requests): return
+                counter['sent'] += 1
+            index = rng.choices(range(len(mix)), weights=weights)[0]
+            record = dict(client.run_job(mix[index], corpus[index]), phase=phase, concurrency=concurrency)
+            records.append(record); log_request(record)
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+    started = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return records, time.time() - started
+
+def _percentile(values, fraction):
+    if not values: return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+def summarize(records, elapsed):
+    ok = [record for record in records if record['status'] == 200]
+    latencies = [record['latency'] for record in ok]
+    errors = {}
+    for record in records:
+        if record['status'] != 200: key = f"{record['status']} {record['error']}".strip(); errors[key] = errors.get(key, 0) + 1
+    return {'requests': len(records), 'ok': len(ok), 'elapsed': round(elapsed, 1), 'throughput_per_min': round(len(ok) / elapsed * 60, 2) if elapsed else 0,
+            'p50': _percentile(latencies, 0.5), 'p95': _percentile(latencies, 0.95), 'p99': _percentile(latencies, 0.99), 'max': max(latencies) if latencies else None,
+            'mb_in_per_min': round(sum(record['bytes_in'] for record in ok) / 1e6 / elapsed * 60, 2) if elapsed else 0, 'errors': errors,
+            'by_kind': {kind: {'ok': sum(1 for record in ok if record['kind'] == kind), 'p95': _percentile([record['latency'] for record in ok if record['kind'] == kind], 0.95)}
+                        for kind in sorted({record['kind'] for record in records})}}
+
+# ---------- Báo cáo HTML ----------
+
+def svg_chart(title, series, y_label, x_label='', width=760, height=260):
+    # series: {tên: [(x, y), ...]}. Polyline đơn giản, trục min/max, không phụ thuộc thư viện vẽ
+    points = [point for values in series.values() for point in values if point[1] is not None]
+    if not points: return f"<h3>{title}</h3><p>no data</p>"
+    x_min, x_max = min(x for x, _ in points), max(x for x, _ in points)
+    y_max = max(y for _, y in points) or 1
+    x_span = (x_max - x_min) or 1
+    left, bottom, right, top = 60, height - 30, width - 10, 20
+    scale = lambda x, y: (left + (x - x_min) / x_span * (right - left), bottom - y / y_max * (bottom - top))
+    colors = ('#1f77b4', '#d62728', '#2ca02c', '#ff7f0e', '#9467bd', '#8c564b')
+    parts = [f'<h3>{title}</h3><svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg" font-family="sans-serif" font-size="11">',
+             f'<line x1="{left}" y1="{bottom}" x2="{right}" y2="{bottom}" stroke="#999"/><line x1="{left}" y1="{top}" x2="{left}" y2="{bottom}" stroke="#999"/>',
+             f'<text x="4" y="{top + 4}">{y_max:.4g}</text><text x="4" y="{bottom}">0</text><text x="4" y="{(top + bottom) // 2}">{y_label}</text>',
+             f'<text x="{left}" y="{height - 8}">{x_min:.4g}</text><text x="{right - 40}" y="{height - 8}">{x_max:.4g}</text><text x="{(left + right) // 2}" y="{height - 8}">{x_label}</text>']
+    for index, (name, values) in enumerate(series.items()):
+        color = colors[index % len(colors)]
+        coords = ' '.join(f"{px:.1f},{py:.1f}" for px, py in (scale(x, y) for x, y in values if y is not None))
+        parts.append(f'<polyline fill="none" stroke="{color}" stroke-width="1.5" points="{coords}"/>')
+        parts.append(f'<text x="{left + 10 + 120 * index}" y="{top - 6}" fill="{color}">{name}</text>')
+    parts.append('</svg>')
+    return ''.join(parts)
+
+def write_report(out_dir, summary, samples, records):
+    sections = [f"<h1>Load test: {summary['mode']}</h1><pre>{json.dumps({key: summary[key] for key in ('mode', 'server', 'mix_items', 'started_at', 'elapsed')}, indent=2)}</pre>"]
+    levels = summary.get('levels') or []
+    if len(levels) > 1: # Đường cong scaling theo concurrency
+        sections.append(svg_chart('Throughput vs concurrency', {'ok jobs/min': [(level['concurrency'], level['throughput_per_min']) for level in levels]}, 'jobs/min', 'concurrency'))
+        sections.append(svg_chart('Latency vs concurrency', {name: [(level['concurrency'], level[name]) for level in levels] for name in ('p50', 'p95', 'p99')}, 'seconds', 'concurrency'))
+        sections.append(svg_chart('Errors vs concurrency', {'non-200': [(level['concurrency'], level['requests'] - level['ok']) for level in levels]}, 'requests', 'concurrency'))
+    windows = summary.get('windows') or []
+    if windows: # Soak: theo thời gian
+        sections.append(svg_chart('Throughput over time', {'ok jobs/min': [(window['minute'], window['throughput_per_min']) for window in windows]}, 'jobs/min', 'minutes'))
+        sections.append(svg_chart('Latency over time', {name: [(window['minute'], window[name]) for window in windows] for name in ('p50', 'p95', 'p99')}, 'seconds', 'minutes'))
+    if samples:
+        start = samples[0]['time']
+        minutes = lambda sample: round((sample['time'] - start) / 60, 2)
+        sections.append(svg_chart('Memory (RSS)', {'server MB': [(minutes(sample), sample['server_rss'] / 1e6) for sample in samples],
+                                                   'server + engines MB': [(minutes(sample), sample['tree_rss'] / 1e6) for sample in samples]}, 'MB', 'minutes'))
+        sections.append(svg_chart('Open file descriptors / threads', {'fds': [(minutes(sample), sample['open_fds']) for sample in samples],
+                                                                       'threads': [(minutes(sample), sample['threads']) for sample in samples]}, 'count', 'minutes'))
+        sections.append(svg_chart('Temp files and engine processes', {'job temp files': [(minutes(sample), sample['temp_files']) for sample in samples],
+                                                                       'engine procs': [(minutes(sample), sample['engine_procs']) for sample in samples],
+                                                                       'orphan engine procs': [(minutes(sample), sample['orphan_engine_procs']) for sample in samples]}, 'count', 'minutes'))
+        sections.append(svg_chart('UPLOAD_FOLDER size', {'MB': [(minutes(sample), sample['uploads_bytes'] / 1e6) for sample in samples]}, 'MB', 'minutes'))
+    leaks = summary['leaks']
+    sections.append(f"<h2>After cool-down</h2><p>{len(leaks['leftover_temp_files'])} leftover temp files, {len(leaks['loose_upload_files'])} loose files in UPLOAD_FOLDER, "
+                    f"{len(leaks['orphan_engine_processes'])} orphaned engine processes, {len(leaks['server_engine_processes'])} engine processes still owned by the server.</p>"
+                    f"<pre>{json.dumps(leaks, indent=2)[:20000]}</pre>")
+    rows = ''.join(f"<tr><td>{level['concurrency']}</td><td>{level['requests']}</td><td>{level['ok']}</td><td>{level['throughput_per_min']}</td><td>{level['p50']}</td>"
+                   f"<td>{level['p95']}</td><td>{level['p99']}</td><td>{json.dumps(level['errors'])}</td></tr>" for level in levels)
+    if rows: sections.append(f"<h2>Levels</h2><table border=1 cellpadding=4><tr><th>concurrency</th><th>requests</th><th>ok</th><th>ok/min</th><th>p50</th><th>p95</th><th>p99</th><th>errors</th></tr>{rows}</table>")
+    with open(os.path.join(out_dir, 'report.html'), 'w', encoding='utf-8') as f:
+        f.write(f"<!doctype html><meta charset='utf-8'><title>Load test report</title><body style='font-family:sans-serif'>{''.join(sections)}</body>")
+
+# ---------- CLI ----------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load, scaling and soak tests for Convert All Files against a local server.")
+    sub = parser.add_subparsers(dest='mode', required=True)
+    mix_parser = sub.add_parser('mix', help="Build a job mix (kinds + size distribution) from server logs")
+    mix_parser.add_argument('logs', nargs='+'); mix_parser.add_argument('-o', '--output', required=True)
+    mix_parser.add_argument('--buckets', type=int, default=4, help="Size buckets kept per job kind")
+    for mode, help_text in (('ramp', "Step through concurrency levels"), ('soak', "Hold one concurrency level for hours"), ('replay', "Send a fixed number of requests")):
+        run_parser = sub.add_parser(mode, help=help_text)
+        run_parser.add_argument('-o', '--output-dir', required=True)
+        run_parser.add_argument('--mix', help="Mix JSON from the 'mix' command (default: built-in mix)")
+        run_parser.add_argument('--corpus-dir', help="Where generated inputs are cached (default: <output-dir>/corpus)")
+        run_parser.add_argument('--url', help="Test an already running server instead of starting one")
+        run_parser.add_argument('--server-pid', type=int, help="With --url: pid to sample RSS/fds/engine processes from")
+        run_parser.add_argument('--uploads-dir', help="With --url: the server's UPLOAD_FOLDER")
+        run_parser.add_argument('--server', choices=sorted(SERVER_BOOTSTRAP), default='waitress')
+        run_parser.add_argument('--keep-limits', action='store_true', help="Keep the rate limiter on (it rejects most load otherwise)")
+        run_parser.add_argument('--env', action='append', default=[], help="Extra server env, e.g. --env MAX_CONCURRENT_JOBS=8")
+        run_parser.add_argument('--sample-seconds', type=float, default=2.0)
+        run_parser.add_argument('--cooldown', type=float, default=30.0, help="Idle seconds before the leftover/orphan check")
+        run_parser.add_argument('--seed', type=int, default=0)
+        if mode == 'ramp':
+            run_parser.add_argument('--levels', default='1,2,4,8,16,32')
+            run_parser.add_argument('--step-seconds', type=float, default=120.0)
+        else:
+            run_parser.add_argument('--concurrency', type=int, default=8)
+        if mode == 'soak':
+            run_parser.add_argument('--hours', type=float, default=2.0)
+            run_parser.add_argument('--window-minutes', type=float, default=5.0)
+        if mode == 'replay': run_parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    if args.mode == 'mix':
+        mix = build_mix(args.logs, args.buckets)
+        if not mix: print("No 'Job <kind> (<lane>): features=...' lines found", file=sys.stderr); return 1
+        with open(args.output, 'w', encoding='utf-8') as f: json.dump({'items': mix, 'sources': args.logs}, f, indent=2)
+        print(f"{len(mix)} mix items from {sum(item['weight'] for item in mix)} jobs -> {args.output}", file=sys.stderr)
+        return 0
+
+    out_dir = os.path.abspath(args.output_dir); os.makedirs(out_dir, exist_ok=True)
+    mix = load_mix(args.mix)
+    corpus = prepare_corpus(mix, args.corpus_dir or os.path.join(out_dir, 'corpus'))
+    baseline_engines = {pid for pid, (_, name, *_) in process_table().items() if name in ENGINE_PROCESS_NAMES} # Process engine có sẵn từ trước không tính là mồ côi
+    process = None
+    if args.url:
+        base_url, server_pid, uploads_dir, tmpfs_dir = args.url, args.server_pid, args.uploads_dir or '', ''
+    else:
+        process, base_url, uploads_dir, tmpfs_dir = start_server(args.server, out_dir, args.keep_limits, dict(item.split('=', 1) for item in args.env))
+        server_pid = process.pid
+    request_log = CsvLog(os.path.join(out_dir, 'requests.csv'), REQUEST_FIELDS)
+    sample_log = CsvLog(os.path.join(out_dir, 'samples.csv'), SAMPLE_FIELDS)
+    sampler = ResourceSampler(server_pid, uploads_dir, tmpfs_dir, args.sample_seconds, sample_log); sampler.start()
+    started = time.time(); all_records = []; summary = {'mode': args.mode, 'server': base_url, 'mix_items': len(mix), 'started_at': started}
+    try:
+        if args.mode == 'ramp':
+            summary['levels'] = []
+            for concurrency in [int(level) for level in args.levels.split(',') if level.strip()]:
+                sampler.phase = f"c{concurrency}"
+                records, elapsed = run_phase(base_url, mix, corpus, concurrency, sampler.phase, request_log, duration=args.step_seconds, seed=args.seed)
+                level = dict(summarize(records, elapsed), concurrency=concurrency); summary['levels'].append(level); all_records.extend(records)
+                print(f"c={concurrency}: {level['ok']}/{level['requests']} ok, {level['throughput_per_min']}/min, p95 {level['p95']}s, errors {level['errors']}", file=sys.stderr)
+        elif args.mode == 'soak':
+            summary['windows'] = []
+            for window_index in range(max(1, int(args.hours * 60 / args.window_minutes))):
+                sampler.phase = f"w{window_index}"
+                records, elapsed = run_phase(base_url, mix, corpus, args.concurrency, sampler.phase, request_log, duration=args.window_minutes * 60, seed=f"{args.seed}-{window_index}")
+                window = dict(summarize(records, elapsed), minute=round((time.time() - started) / 60, 1)); summary['windows'].append(window); all_records.extend(records)
+                last = sampler.samples[-1] if sampler.samples else {}
+                print(f"{window['minute']}min: {window['throughput_per_min']}/min, p95 {window['p95']}s, RSS {last.get('tree_rss', 0) / 1e6:.0f}MB, "
+                      f"fds {last.get('open_fds')}, temp files {last.get('temp_files')}, errors {window['errors']}", file=sys.stderr)
+        else:
+            sampler.phase = 'replay'
+            records, elapsed = run_phase(base_url, mix, corpus, args.concurrency, 'replay', request_log, max_requests=args.requests, seed=args.seed)
+            summary['levels'] = [dict(summarize(records, elapsed), concurrency=args.concurrency)]; all_records.extend(records)
+        summary['overall'] = summarize(all_records, time.time() - started)
+        sampler.phase = 'cooldown'
+        time.sleep(args.cooldown)
+        summary['leaks'] = leak_report(server_pid, uploads_dir, tmpfs_dir, baseline_engines)
+    except KeyboardInterrupt:
+        print("Interrupted, writing partial report", file=sys.stderr)
+        summary.setdefault('overall', summarize(all_records, time.time() - started))
+        summary['leaks'] = leak_report(server_pid, uploads_dir, tmpfs_dir, baseline_engines)
+    finally:
+        sampler.stop_event.set(); sampler.join(timeout=10)
+        if process: stop_server(process)
+        request_log.close(); sample_log.close()
+    summary['elapsed'] = round(time.time() - started, 1)
+    with open(os.path.join(out_dir, 'summary.json'), 'w', encoding='utf-8') as f: json.dump(summary, f, ensure_ascii=False, indent=2)
+    write_report(out_dir, summary, sampler.samples, all_records)
+    leaks = summary['leaks']
+    print(f"Done in {summary['elapsed']}s: {summary['overall']['ok']}/{summary['overall']['requests']} ok. Leftover temp files: {len(leaks['leftover_temp_files'])}, "
+          f"orphaned engine processes: {len(leaks['orphan_engine_processes'])}. Report: {os.path.join(out_dir, 'report.html')}", file=sys.stderr)
+    return 1 if leaks['leftover_temp_files'] or leaks['orphan_engine_processes'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
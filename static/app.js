@@ -0,0 +1,378 @@
+// Giá trị từ server nằm trong <script id="appConfig" type="application/json"> của index.html: file JS tĩnh, cache được lâu dài
+const APP_CONFIG = JSON.parse(document.getElementById('appConfig').textContent);
+const TRANSLATIONS_URL = APP_CONFIG.translations_url;
+const GS_AVAILABLE = APP_CONFIG.gs_available;
+const SOFFICE_AVAILABLE = APP_CONFIG.soffice_available;
+const PDF_PAGE_SIZES = APP_CONFIG.pdf_page_sizes;
+const IMAGE_WORKER_URL = APP_CONFIG.image_worker_url;
+let currentTranslations = {};
+let currentLang = 'en';
+
+// DOM Elements
+const languageSelector = document.getElementById('languageSelector');
+const errorAlert = document.getElementById('errorAlert');
+const errorMessage = document.getElementById('errorMessage');
+// Card 1 Elements
+const fileInput = document.getElementById('fileInput');
+const conversionTypeSelect = document.getElementById('conversionType');
+const actualConversionTypeInput = document.getElementById('actualConversionType');
+const fileStatus = document.getElementById('fileStatus');
+const convertForm = document.getElementById('convertForm');
+const convertButton = document.getElementById('convertButton');
+// Card 2 Elements
+const imageFileInput = document.getElementById('imageFileInput');
+const imageConvertForm = document.getElementById('imageConvertForm');
+const imageConvertButton = document.getElementById('imageConvertButton');
+const imageDropZone = document.getElementById('imageDropZone');
+const imageVerticalFileList = document.getElementById('imageVerticalFileList');
+const imageDropZoneInstructions = document.getElementById('imageDropZoneInstructions');
+const imageConversionModeInput = document.getElementById('imageConversionMode');
+const clearAllImageFilesButton = document.getElementById('clearAllImageFiles');
+// Card 3 (Compress DOCX) Elements
+const compressDocxCard = document.getElementById('compressDocxCard');
+const compressDocxFileInput = document.getElementById('compressDocxFileInput');
+const compressDocxFileStatus = document.getElementById('compressDocxFileStatus');
+const compressDocxForm = document.getElementById('compressDocxForm');
+const compressDocxButton = document.getElementById('compressDocxButton');
+// Card 4 (Compress PDF) Elements
+const compressCard = document.getElementById('compressCard');
+const compressFileInput = document.getElementById('compressFileInput');
+const compressFileStatus = document.getElementById('compressFileStatus');
+const compressQualitySelect = document.getElementById('compressQuality');
+const compressForm = document.getElementById('compressForm');
+const compressButton = document.getElementById('compressButton');
+
+let selectedImageFiles = [];
+
+// --- Functions ---
+function showError(errorKeyOrMessage, alertElement = errorAlert, messageElement = errorMessage) {
+    let message = errorKeyOrMessage; let errorKey = '';
+    if (typeof errorKeyOrMessage === 'string' && errorKeyOrMessage.startsWith('Conversion failed:')) { errorKey = errorKeyOrMessage.substring(18).trim(); message = errorKey; }
+    else { errorKey = errorKeyOrMessage; }
+    if (currentTranslations && currentTranslations[errorKey]) { message = currentTranslations[errorKey]; }
+    else if (errorKey === 'err-format-docx' && !currentTranslations[errorKey]) { message = (currentLang === 'vi' ? 'Vui lòng chọn một tệp DOCX.' : 'Please select a DOCX file.'); }
+    else if (errorKey === 'err-compressing-docx' && !currentTranslations[errorKey]) { message = (currentLang === 'vi' ? 'Đang nén Word...' : 'Compressing Word...'); }
+    else if (errorKey && !currentTranslations[errorKey]){ const genericError = currentTranslations['err-conversion'] || (currentLang === 'vi' ? 'Đã xảy ra lỗi.' : 'An error occurred.'); message = genericError + (errorKey.includes(' ') || errorKey.length < 5 ? '' : ` (${errorKey})`); console.warn(`Missing translation for error key: ${errorKey}`); }
+    else { message = currentTranslations['err-unknown'] || errorKeyOrMessage || (currentLang === 'vi' ? 'Đã xảy ra lỗi không xác định.' : 'An unknown error occurred.'); }
+    messageElement.textContent = message;
+    const errorTitle = alertElement.querySelector('.lang-error-title');
+    if(errorTitle && currentTranslations && currentTranslations['lang-error-title']){ errorTitle.textContent = currentTranslations['lang-error-title']; }
+    alertElement.classList.remove('hidden');
+    window.scrollTo({ top: errorAlert.offsetTop - 20, behavior: 'smooth' });
+}
+
+function hideError(alertElement = errorAlert) {
+    alertElement.classList.add('hidden');
+}
+
+function applyTranslations(translations) {
+    document.documentElement.lang = currentLang;
+    document.title = (translations['lang-title'] || "PDF Tools") + " - Easy File Conversion";
+    document.querySelectorAll('[class*="lang-"]').forEach(element => {
+        const langClass = Array.from(element.classList).find(cls => cls.startsWith('lang-'));
+        if (langClass && translations[langClass]) {
+            const text = translations[langClass];
+            if (['BUTTON', 'OPTION', 'LABEL', 'P', 'H2', 'H3', 'SPAN', 'STRONG', 'TITLE', 'A'].includes(element.tagName)) {
+                if (element.tagName === 'SELECT' && element.options.length > 0 && element.options[0].disabled) { element.options[0].textContent = text; }
+                else { if (element.children.length === 0 || ['SPAN', 'STRONG', 'A', 'BUTTON'].includes(element.tagName)) { element.textContent = text; } else if (element.tagName === 'OPTION') { element.textContent = text; } }
+            }
+            else if (element.placeholder) { element.placeholder = text; }
+            else if (element.dataset.langNoFile !== undefined) { element.dataset.langNoFile = text; const inputId = element.id.replace('Status','Input'); const relatedInput = document.getElementById(inputId); if (!relatedInput || !relatedInput.files || relatedInput.files.length === 0) { element.textContent = text; } }
+        } else if (langClass) { /* console.warn(`Missing translation key: ${langClass}`); */ }
+    });
+    const fileStatusPairs = [ { status: fileStatus, input: fileInput }, { status: compressFileStatus, input: compressFileInput }, { status: compressDocxFileStatus, input: compressDocxFileInput } ];
+    fileStatusPairs.forEach(pair => { if (pair.status && pair.input) { const noFileText = translations['file-no-selected'] || (currentLang === 'vi' ? 'Không có tệp nào được chọn' : 'No file selected'); pair.status.dataset.langNoFile = noFileText; if (!pair.input.files || pair.input.files.length === 0) { pair.status.textContent = noFileText; } } });
+    const uploadTextEl = imageDropZoneInstructions?.querySelector('.lang-upload-a-file'); if (uploadTextEl) uploadTextEl.textContent = translations['lang-upload-a-file'] || (currentLang === 'vi' ? 'Tải tệp lên' : 'Upload files');
+    const dragDropTextEl = imageDropZoneInstructions?.querySelector('.lang-drag-drop'); if (dragDropTextEl) dragDropTextEl.textContent = translations['lang-drag-drop'] || (currentLang === 'vi' ? 'hoặc kéo và thả' : 'or drag and drop');
+    const imageTypesTextEl = imageDropZoneInstructions?.querySelector('.lang-image-types'); if (imageTypesTextEl) imageTypesTextEl.textContent = translations['lang-image-types'] || (currentLang === 'vi' ? 'PDF, JPG, JPEG tối đa 100MB tổng' : 'PDF, JPG, JPEG up to 100MB total');
+    if(clearAllImageFilesButton) clearAllImageFilesButton.textContent = translations['lang-clear-all'] || (currentLang === 'vi' ? 'Xóa tất cả' : 'Clear All');
+    if (conversionTypeSelect && conversionTypeSelect.options[0].disabled) { conversionTypeSelect.options[0].textContent = translations['lang-select-conversion'] || (currentLang === 'vi' ? 'Chọn kiểu chuyển đổi' : 'Select conversion type'); }
+}
+
+async function updateLanguage(lang) {
+    currentLang = lang; hideError();
+    try {
+        const response = await fetch(`${TRANSLATIONS_URL}?lang=${lang}`);
+        if (!response.ok) { throw new Error(`HTTP error! status: ${response.status}`); }
+        currentTranslations = await response.json();
+        applyTranslations(currentTranslations);
+        localStorage.setItem('preferred-language', lang);
+        if(languageSelector) languageSelector.value = lang;
+        document.documentElement.lang = lang;
+        updateImageFileDisplay();
+    } catch (error) {
+        console.error('Failed to fetch translations:', error);
+        currentTranslations = {};
+        showError('err-fetch-translations');
+    }
+}
+
+function formatBytes(bytes, decimals = 2) {
+    if (!+bytes || bytes === 0) return '0 Bytes'; const k = 1024; const dm = decimals < 0 ? 0 : decimals; const sizes = ['Bytes', 'KB', 'MB', 'GB', 'TB']; const i = Math.max(0, Math.min(Math.floor(Math.log(bytes) / Math.log(k)), sizes.length - 1)); return `${parseFloat((bytes / Math.pow(k, i)).toFixed(dm))} ${sizes[i]}`;
+}
+
+function validateImageFiles(filesToAdd = []) {
+    let currentFiles = [...selectedImageFiles]; let combinedFiles = [...currentFiles, ...filesToAdd]; let mode = ''; let errorKey = null; const maxSize = 101 * 1024 * 1024;
+    if (combinedFiles.length > 0) { const firstFileName = combinedFiles[0].name || ''; const firstFileExt = firstFileName.split('.').pop().toLowerCase(); if (firstFileExt === 'pdf') { if (combinedFiles.length > 1) { errorKey = 'err-image-single-pdf'; mode = 'invalid'; } else { mode = 'pdf_to_image'; if (combinedFiles[0].size > maxSize) { errorKey = 'err-file-too-large'; mode = 'invalid'; } } } else if (['jpg', 'jpeg'].includes(firstFileExt)) { mode = 'image_to_pdf'; let totalSize = 0; for (let i = 0; i < combinedFiles.length; i++) { const fileName = combinedFiles[i].name || ''; const ext = fileName.split('.').pop().toLowerCase(); if (!['jpg', 'jpeg'].includes(ext)) { errorKey = 'err-image-all-images'; mode = 'invalid'; break; } totalSize += combinedFiles[i].size || 0; } if (mode !== 'invalid' && totalSize > maxSize) { errorKey = 'err-file-too-large'; mode = 'invalid'; } } else { errorKey = 'err-image-format'; mode = 'invalid'; } }
+    if (imageConversionModeInput) imageConversionModeInput.value = mode;
+    if (errorKey) { showError(errorKey); return { valid: false, mode: 'invalid', files: currentFiles }; }
+    if (combinedFiles.length > 0) hideError();
+    return { valid: true, mode: mode, files: combinedFiles };
+}
+
+function addImageFiles(newFiles) {
+    const filesToAdd = Array.from(newFiles).filter(f => f.name && ['pdf', 'jpg', 'jpeg'].includes(f.name.split('.').pop().toLowerCase()));
+    if (filesToAdd.length === 0) { if (newFiles.length > 0 && Array.from(newFiles).some(f => !['pdf', 'jpg', 'jpeg'].includes(f.name?.split('.').pop()?.toLowerCase()))) { showError('err-image-format'); } return; }
+    const validationResult = validateImageFiles(filesToAdd);
+    if (validationResult.valid) { selectedImageFiles = validationResult.files; }
+    updateImageFileDisplay();
+}
+
+function removeImageFile(index) {
+    if (index >= 0 && index < selectedImageFiles.length) { selectedImageFiles.splice(index, 1); validateImageFiles([]); updateImageFileDisplay(); }
+}
+
+function updateImageFileDisplay() {
+    const verticalFileList = document.getElementById('imageVerticalFileList'); const instructions = document.getElementById('imageDropZoneInstructions'); const clearButton = document.getElementById('clearAllImageFiles'); const convertBtn = document.getElementById('imageConvertButton'); const modeInput = document.getElementById('imageConversionMode');
+    if (!verticalFileList || !instructions || !clearButton || !convertBtn || !modeInput) { return; }
+    verticalFileList.innerHTML = '';
+    const isValidState = selectedImageFiles.length > 0 && modeInput.value !== '' && modeInput.value !== 'invalid';
+    if (selectedImageFiles.length > 0) {
+        verticalFileList.classList.remove('hidden'); instructions.classList.add('hidden'); clearButton.style.display = 'inline';
+        selectedImageFiles.forEach((file, index) => {
+            const originalFileName = file.name || 'unknown'; const fileSize = formatBytes(file.size || 0); const title = `${originalFileName} (${fileSize})`; const pill = document.createElement('div'); let pillClasses = ['inline-flex', 'items-center', 'justify-between', 'bg-orange-100', 'text-orange-800', 'text-sm', 'font-medium', 'px-3', 'py-1.5', 'rounded-full', 'space-x-2', 'w-full', 'max-w-full']; if (index > 0) { pillClasses.push('mt-1'); }
+            pill.className = pillClasses.join(' '); pill.innerHTML = `<span class="truncate flex-grow min-w-0 mr-2" title="${title}">${originalFileName} (${fileSize})</span><button type="button" class="flex-shrink-0 text-orange-600 hover:text-orange-800 focus:outline-none ring-offset-1 focus:ring-2 focus:ring-orange-500 rounded-sm" onclick="removeImageFile(${index})" title="Remove file"><svg class="w-3.5 h-3.5 pointer-events-none" fill="currentColor" viewBox="0 0 20 20"><path fill-rule="evenodd" d="M4.293 4.293a1 1 0 011.414 0L10 8.586l4.293-4.293a1 1 0 111.414 1.414L11.414 10l4.293 4.293a1 1 0 01-1.414 1.414L10 11.414l-4.293 4.293a1 1 0 01-1.414-1.414L8.586 10 4.293 5.707a1 1 0 010-1.414z" clip-rule="evenodd"></path></svg></button>`;
+            verticalFileList.appendChild(pill);
+        });
+        verticalFileList.scrollTop = verticalFileList.scrollHeight;
+    } else { verticalFileList.classList.add('hidden'); instructions.classList.remove('hidden'); clearButton.style.display = 'none'; modeInput.value = ''; }
+    convertBtn.disabled = !isValidState;
+}
+
+async function loadPreview(file, container) {
+    // Xem trước các trang (best-effort): lỗi preview không chặn việc convert. Ảnh loading="lazy" nên trang sau chỉ render khi cuộn tới
+    if (!container) { return; }
+    container.innerHTML = ''; container.classList.add('hidden'); container.previewFile = file || null;
+    if (!file) { return; }
+    const ext = (file.name || '').split('.').pop().toLowerCase();
+    if (!['pdf', 'docx', 'ppt', 'pptx'].includes(ext) || (ext !== 'pdf' && !SOFFICE_AVAILABLE)) { return; }
+    const formData = new FormData(); formData.append('file', file, file.name);
+    const csrfInput = document.querySelector('input[name="csrf_token"]'); if (csrfInput && csrfInput.value) { formData.append('csrf_token', csrfInput.value); }
+    try {
+        const response = await fetch('/preview', { method: 'POST', body: formData });
+        if (!response.ok || container.previewFile !== file) { return; }
+        const data = await response.json();
+        (data.pages || []).forEach((url, index) => { const img = document.createElement('img'); img.src = url; img.loading = 'lazy'; img.alt = `${index + 1}`; img.title = `${index + 1} / ${data.page_count}`; img.className = 'h-24 flex-shrink-0 border border-gray-200 rounded bg-white'; container.appendChild(img); });
+        if (data.pages && data.pages.length) { container.classList.remove('hidden'); }
+    } catch (previewError) { console.warn('Preview failed:', previewError); }
+}
+
+async function readBlobWithResume(response) {
+    // Nếu kết nối rớt khi đang tải kết quả, tải tiếp phần còn thiếu qua X-Download-URL (HTTP Range) thay vì convert lại
+    const downloadUrl = response.headers.get('X-Download-URL');
+    const contentType = response.headers.get('Content-Type') || '';
+    const etag = response.headers.get('ETag');
+    if (!downloadUrl || !response.body || !response.body.getReader) { return response.blob(); }
+    const reader = response.body.getReader(); const chunks = []; let received = 0;
+    try {
+        while (true) { const { done, value } = await reader.read(); if (done) { return new Blob(chunks, { type: contentType }); } chunks.push(value); received += value.length; }
+    } catch (streamError) { console.warn(`Download interrupted at byte ${received}, resuming...`, streamError); }
+    for (let attempt = 1; attempt <= 3; attempt++) {
+        try {
+            const headers = { 'Range': `bytes=${received}-` }; if (etag) { headers['If-Range'] = etag; }
+            const resumed = await fetch(downloadUrl, { headers });
+            if (resumed.status === 206) { chunks.push(new Uint8Array(await resumed.arrayBuffer())); return new Blob(chunks, { type: contentType }); }
+            if (resumed.ok) { return resumed.blob(); } // Server trả lại toàn bộ file (vd. ETag đã đổi)
+            if (resumed.status === 404) { throw new Error('err-download-expired'); }
+        } catch (resumeError) { if (resumeError.message === 'err-download-expired') { throw resumeError; } console.warn(`Resume attempt ${attempt} failed:`, resumeError); }
+        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+    }
+    throw new Error('err-unknown');
+}
+
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+async function sha256Hex(buffer) {
+    if (!window.crypto || !crypto.subtle) { return null; } // crypto.subtle chỉ có trên HTTPS/localhost
+    const digest = await crypto.subtle.digest('SHA-256', buffer);
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+function postWithProgress(url, body, onProgress) {
+    // fetch chưa báo tiến độ upload: dùng XHR rồi trả về Response để phần còn lại của handleFetch giữ nguyên.
+    // Rớt mạng khi đang tải kết quả về: tải lại qua X-Download-URL (header đã tới) thay vì convert lại
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest(); let downloadUrl = null;
+        xhr.open('POST', url); xhr.responseType = 'blob';
+        if (onProgress) { xhr.upload.onprogress = (e) => { if (e.lengthComputable) { onProgress(e.loaded / e.total); } }; xhr.upload.onload = () => onProgress(1); }
+        xhr.onreadystatechange = () => { if (xhr.readyState === XMLHttpRequest.HEADERS_RECEIVED) { downloadUrl = xhr.getResponseHeader('X-Download-URL'); } };
+        xhr.onload = () => {
+            const headers = new Headers();
+            xhr.getAllResponseHeaders().trim().split(/[\r\n]+/).forEach(line => { const i = line.indexOf(':'); if (i > 0) { headers.append(line.slice(0, i).trim(), line.slice(i + 1).trim()); } });
+            resolve(new Response(xhr.response, { status: xhr.status, statusText: xhr.statusText, headers }));
+        };
+        xhr.onerror = () => { if (downloadUrl) { fetch(downloadUrl).then(resolve, reject); } else { reject(new Error('err-unknown')); } };
+        xhr.send(body);
+    });
+}
+
+let imageWorker = null; let imageWorkerSeq = 0; const imageWorkerCallbacks = new Map();
+function runImageWorker(message) {
+    // Trả về { blob (ảnh đã thu nhỏ hoặc null), sha256 } hoặc null nếu trình duyệt không có Worker / worker lỗi
+    if (!window.Worker) { return Promise.resolve(null); }
+    if (!imageWorker) {
+        try { imageWorker = new Worker(IMAGE_WORKER_URL); } catch (workerError) { console.warn('Image worker unavailable:', workerError); return Promise.resolve(null); }
+        imageWorker.onmessage = (e) => { const callback = imageWorkerCallbacks.get(e.data.id); if (callback) { imageWorkerCallbacks.delete(e.data.id); callback(e.data); } };
+        imageWorker.onerror = (e) => { console.warn('Image worker failed:', e.message); imageWorkerCallbacks.forEach(callback => callback(null)); imageWorkerCallbacks.clear(); imageWorker.terminate(); imageWorker = null; };
+    }
+    return new Promise(resolve => { const id = ++imageWorkerSeq; imageWorkerCallbacks.set(id, resolve); imageWorker.postMessage({ ...message, id }); });
+}
+
+const RESULT_LOOKUP_MAX_BYTES = 32 * 1024 * 1024; // File lớn hơn: băm trên điện thoại tốn RAM/thời gian hơn lợi ích
+const CLIENT_JPEG_QUALITY = 0.88;
+async function prepareUpload(endpoint, formData) {
+    // Ảnh image_to_pdf: thu nhỏ về khổ trang/DPI đã chọn trong Web Worker (bật/tắt bằng #imageOptimize).
+    // Mọi form: sha256 từng file theo thứ tự gửi để hỏi /result/lookup; hashes = null nếu không băm được
+    const entries = [...formData.entries()]; const files = entries.filter(([, value]) => value instanceof File);
+    const totalBytes = files.reduce((sum, [, file]) => sum + file.size, 0);
+    const optimizeEl = document.getElementById('imageOptimize');
+    const shrink = endpoint === '/convert_image' && optimizeEl && optimizeEl.checked && files.length > 0 && files.every(([, file]) => /\.jpe?g$/i.test(file.name));
+    if (!files.length || (!shrink && (totalBytes > RESULT_LOOKUP_MAX_BYTES || !window.isSecureContext))) { return { formData, hashes: null }; }
+    const box = shrink ? PDF_PAGE_SIZES[formData.get('page_size') || 'fit'] : null; const maxDpi = parseInt(formData.get('dpi') || '200', 10);
+    const results = await Promise.all(files.map(([, file]) => runImageWorker({ file, box, maxDpi, quality: CLIENT_JPEG_QUALITY })));
+    const prepared = new FormData(); let fileIndex = 0; let savedBytes = 0;
+    for (const [key, value] of entries) {
+        if (!(value instanceof File)) { prepared.append(key, value); continue; }
+        const result = results[fileIndex++];
+        if (result && result.blob) { savedBytes += value.size - result.blob.size; prepared.append(key, new File([result.blob], value.name, { type: 'image/jpeg' }), value.name); }
+        else { prepared.append(key, value, value.name); }
+    }
+    if (savedBytes > 0) { console.info(`Shrunk images before upload, saved ${formatBytes(savedBytes)}`); }
+    const hashes = results.every(result => result && result.sha256) ? results.map(result => result.sha256) : null;
+    return { formData: prepared, hashes };
+}
+
+async function lookupResult(endpoint, formData, hashes) {
+    // Server đã có kết quả cho đúng input + tuỳ chọn này (cùng session, còn trong thời gian giữ file) -> tải luôn, không upload
+    if (!hashes) { return null; }
+    const fields = [...formData.entries()].filter(([key, value]) => !(value instanceof File) && key !== 'csrf_token').map(([key, value]) => [key, String(value)]);
+    try {
+        const lookup = await fetch('/result/lookup', { method: 'POST', headers: { 'Content-Type': 'application/json', 'X-CSRFToken': formData.get('csrf_token') || '' }, body: JSON.stringify({ endpoint: endpoint.replace(/^\//, ''), sha256: hashes, fields }) });
+        if (!lookup.ok) { return null; }
+        const data = await lookup.json(); if (!data.cached) { return null; }
+        const download = await fetch(data.download_url);
+        return download.ok ? download : null;
+    } catch (lookupError) { console.warn('Result lookup failed:', lookupError); return null; }
+}
+
+async function submitForm(endpoint, formData, onProgress = null) {
+    // File lớn (1 file) gửi theo chunk: init -> PUT từng chunk (rớt mạng thì hỏi offset rồi gửi tiếp) -> finalize; còn lại POST như cũ
+    const files = [...formData.entries()].filter(([, value]) => value instanceof File);
+    if (files.length !== 1 || files[0][1].size < CHUNKED_UPLOAD_THRESHOLD) { return postWithProgress(endpoint, formData, onProgress); }
+    const [fieldName, file] = files[0]; const csrfToken = formData.get('csrf_token') || '';
+    const headers = { 'X-CSRFToken': csrfToken };
+    const init = await fetch('/upload/init', { method: 'POST', headers: { ...headers, 'Content-Type': 'application/json' }, body: JSON.stringify({ filename: file.name, size: file.size, endpoint: endpoint.replace(/^\//, '') }) });
+    if (!init.ok) { return init; }
+    let status = await init.json(); let failures = 0;
+    while (status.offset < status.size) {
+        const chunk = await file.slice(status.offset, status.offset + status.chunk_size).arrayBuffer();
+        const chunkHeaders = { ...headers, 'Content-Type': 'application/octet-stream' }; const checksum = await sha256Hex(chunk); if (checksum) { chunkHeaders['X-Chunk-SHA256'] = checksum; }
+        try {
+            const put = await fetch(`${status.upload_url}?offset=${status.offset}`, { method: 'PUT', headers: chunkHeaders, body: chunk });
+            if (put.ok || put.status === 409) { status = await put.json(); failures = 0; if (onProgress) { onProgress(status.offset / status.size); } continue; }
+            if (put.status !== 422) { return put; } // Upload hết hạn / bị từ chối -> báo lỗi như POST thường
+        } catch (chunkError) { console.warn(`Chunk at ${status.offset} failed:`, chunkError); }
+        if (++failures > 5) { throw new Error('err-unknown'); }
+        await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+        try { const current = await fetch(status.upload_url); if (current.ok) { status = await current.json(); } } catch (statusError) { console.warn('Upload status check failed:', statusError); }
+    }
+    const finalizeData = new FormData();
+    for (const [key, value] of formData.entries()) { if (key !== fieldName) { finalizeData.append(key, value); } }
+    return fetch(status.finalize_url, { method: 'POST', headers, body: finalizeData });
+}
+
+function handleFetch(formElement, _loadingElement_ignored, buttonElement, endpoint, buttonTextKey, formData = null) {
+    let isManualFormData = !formElement;
+    if (!isManualFormData) { formData = new FormData(formElement); }
+    else if (!formData) { console.error("Manual FormData missing"); showError('err-unknown'); return; }
+    let conversionDirection = null; let inputFilenameBase = 'file'; let targetSizeMissed = false;
+    const fileInputEl = formElement ? formElement.querySelector('input[type=file]') : null;
+    if (fileInputEl && fileInputEl.files && fileInputEl.files.length > 0) { const name = fileInputEl.files[0].name; inputFilenameBase = name.substring(0, name.lastIndexOf('.')) || 'file'; }
+    else if (endpoint === '/convert_image' && selectedImageFiles.length > 0) { const name = selectedImageFiles[0].name; inputFilenameBase = name.substring(0, name.lastIndexOf('.')) || 'file'; }
+    if (endpoint === '/convert') { const typeEl = formElement?.querySelector('input[name="conversion_type"]'); if (typeEl) conversionDirection = typeEl.value; }
+
+    const convertingTextKeyMap = { '/convert': 'lang-converting', '/convert_image': 'lang-image-converting', '/compress_pdf': 'lang-compressing', '/compress_docx': 'lang-compressing-docx' };
+    const convertingText = currentTranslations[convertingTextKeyMap[endpoint] || 'lang-converting'] || 'Processing...';
+    const setButtonStatus = (text) => { const span = buttonElement ? buttonElement.querySelector('span') : null; if (span) { span.textContent = text; } };
+    const showUploadProgress = (fraction) => setButtonStatus(fraction < 1 ? `${currentTranslations['lang-uploading'] || 'Uploading'} ${Math.round(fraction * 100)}%` : convertingText);
+    if(buttonElement) {
+        buttonElement.disabled = true;
+        buttonElement.innerHTML = `<div class="loader loader-sm inline-block !border-t-white !border-l-white !border-b-white !border-r-transparent mr-2 align-middle"></div><span class="inline-block align-middle">${currentTranslations['lang-preparing-upload'] || 'Preparing files...'}</span>`;
+    }
+    hideError();
+
+    prepareUpload(endpoint, formData).catch(prepareError => { console.warn('Upload preprocessing failed, sending original files:', prepareError); return { formData, hashes: null }; })
+    .then(({ formData: uploadData, hashes }) => lookupResult(endpoint, uploadData, hashes).then(cached => { if (cached) { setButtonStatus(convertingText); return cached; } showUploadProgress(0); return submitForm(endpoint, uploadData, showUploadProgress); }))
+    .then(response => { if (!response.ok) { return response.text().then(text => { let errorKey = `err-unknown-${response.status}`; if (text && text.startsWith('Conversion failed:')) { errorKey = text.substring(18).trim(); } else if (text) { console.warn("Non-standard error:", text); errorKey = text.substring(0, 100); } throw new Error(errorKey); }); } return response; })
+    .then(response => { targetSizeMissed = response.headers.get('X-Target-Met') === 'false'; const disposition = response.headers.get('Content-Disposition'); let downloadFilename = `converted_file`; if (disposition && disposition.includes('attachment')) { const m1 = disposition.match(/filename\*=UTF-8''([^;]+)/i); if (m1 && m1[1]) { try { downloadFilename = decodeURIComponent(m1[1]); } catch (e) { console.warn("UTF-8 filename decode failed:", e); } } if (downloadFilename === 'converted_file' || !(m1 && m1[1])) { const m2 = /filename="?([^"]+)"?/i.exec(disposition); if (m2 && m2[1]) { downloadFilename = m2[1]; } } } if (downloadFilename === 'converted_file') { let ext = 'unknown'; let suffix = ''; if (endpoint === '/convert') { const typeMap = {'pdf_to_docx': 'docx', 'docx_to_pdf': 'pdf', 'pdf_to_ppt': 'pptx', 'ppt_to_pdf': 'pdf'}; ext = typeMap[conversionDirection] || 'unknown'; } else if (endpoint === '/convert_image') { const mode = imageConversionModeInput ? imageConversionModeInput.value : ''; ext = (mode === 'pdf_to_image') ? 'zip' : 'pdf'; } else if (endpoint === '/compress_pdf') { ext = 'pdf'; const qualityEl = formElement?.querySelector('#compressQuality'); suffix = `_compressed${qualityEl ? '_'+qualityEl.value : ''}`; } else if (endpoint === '/compress_docx') { ext = 'docx'; suffix = '_compressed'; } downloadFilename = `${inputFilenameBase}${suffix}.${ext}`; console.warn("Using constructed filename:", downloadFilename); } return readBlobWithResume(response).then(blob => ({ blob, downloadFilename })); })
+    .then(({ blob, downloadFilename }) => { const url = window.URL.createObjectURL(blob); const a = document.createElement('a'); a.style.display = 'none'; a.href = url; a.download = downloadFilename; document.body.appendChild(a); a.click(); window.URL.revokeObjectURL(url); a.remove(); if (endpoint === '/convert_image') { selectedImageFiles = []; updateImageFileDisplay(); } else if (formElement) { formElement.reset(); loadPreview(null, formElement.querySelector('[id$="Preview"]')); const statusElId = formElement.id.replace('Form','FileStatus'); const statusEl = document.getElementById(statusElId); if (statusEl) { statusEl.textContent = statusEl.dataset.langNoFile || (currentLang === 'vi' ? 'Không có tệp nào được chọn' : 'No file selected'); } if (endpoint === '/convert' && conversionTypeSelect) { conversionTypeSelect.value = ""; if(actualConversionTypeInput) actualConversionTypeInput.value = ""; } if (endpoint === '/compress_pdf' && compressQualitySelect) { compressQualitySelect.value = 'medium'; } if(buttonElement) { buttonElement.disabled = true; } } hideError(); if (targetSizeMissed) { showError('err-target-size-not-met'); } })
+    .catch(error => { console.error(`${endpoint} request failed:`, error); showError(error.message || 'err-unknown'); })
+    .finally(() => {
+        if(buttonElement) { const text = currentTranslations[buttonTextKey] || 'Submit'; buttonElement.innerHTML = text; if (endpoint === '/convert_image') { updateImageFileDisplay(); } else { buttonElement.disabled = true; } }
+    });
+}
+
+function setupEventListeners() {
+    if (languageSelector) languageSelector.addEventListener('change', function() { updateLanguage(this.value); });
+    const errorAlertClose = document.getElementById('errorAlertClose');
+    if (errorAlertClose) errorAlertClose.addEventListener('click', function() { hideError(); });
+
+    // Card 1: Convert PDF/Office
+    if (fileInput && fileStatus && conversionTypeSelect && actualConversionTypeInput && convertForm && convertButton) {
+        fileInput.addEventListener('change', function() { hideError(); const file = this.files[0]; const noFileText = fileStatus.dataset.langNoFile || (currentLang === 'vi' ? 'Không có tệp nào được chọn' : 'No file selected'); let isValidSelection = false; if (file) { fileStatus.textContent = file.name; const ext = file.name.split('.').pop().toLowerCase(); if (ext === 'pdf') { conversionTypeSelect.value = 'pdf_docx'; isValidSelection = true; } else if (ext === 'docx') { conversionTypeSelect.value = 'pdf_docx'; isValidSelection = true; } else if (ext === 'ppt' || ext === 'pptx') { conversionTypeSelect.value = 'pdf_ppt'; isValidSelection = true; } else { conversionTypeSelect.value = ""; showError('err-invalid-mime-type'); fileStatus.textContent = noFileText; this.value = null; isValidSelection = false; } if(isValidSelection && file.size > 101*1024*1024) { showError('err-file-too-large'); this.value=null; fileStatus.textContent = noFileText; conversionTypeSelect.value = ""; isValidSelection = false; } } else { fileStatus.textContent = noFileText; conversionTypeSelect.value = ""; isValidSelection = false; } convertButton.disabled = !(isValidSelection && conversionTypeSelect.value !== ""); if(actualConversionTypeInput) actualConversionTypeInput.value = ''; loadPreview(isValidSelection ? file : null, document.getElementById('convertPreview')); });
+        conversionTypeSelect.addEventListener('change', function() { hideError(); convertButton.disabled = !(fileInput.files && fileInput.files.length > 0 && this.value !== ""); if(actualConversionTypeInput) actualConversionTypeInput.value = ''; });
+        convertForm.addEventListener('submit', function(e) { e.preventDefault(); hideError(); if (!fileInput.files || fileInput.files.length === 0) { showError('err-select-file'); return; } const file = fileInput.files[0]; if (file.size > 101*1024*1024) { showError('err-file-too-large'); return; } if (!conversionTypeSelect.value) { showError('err-select-conversion'); return; } const selVal = conversionTypeSelect.value; const ext = file.name.toLowerCase().split('.').pop(); let actualType = ''; if (selVal === 'pdf_docx') { if (ext === 'pdf') actualType = 'pdf_to_docx'; else if (ext === 'docx') actualType = 'docx_to_pdf'; else { showError('err-format-docx'); return; } } else if (selVal === 'pdf_ppt') { if (ext === 'pdf') actualType = 'pdf_to_ppt'; else if (ext === 'ppt' || ext === 'pptx') actualType = 'ppt_to_pdf'; else { showError('err-format-ppt'); return; } } else { showError('err-select-conversion'); return; } if (!actualType) { showError('err-select-conversion'); return; } if(actualConversionTypeInput) actualConversionTypeInput.value = actualType; handleFetch(convertForm, null, convertButton, '/convert', 'lang-convert-btn'); });
+        convertButton.disabled = true;
+    } else { console.warn("Missing elements for Card 1"); }
+
+    // Card 2: PDF <-> Image
+    if (imageDropZone && imageFileInput && imageVerticalFileList && imageDropZoneInstructions && imageConvertForm && imageConvertButton && clearAllImageFilesButton) {
+        imageDropZone.addEventListener('click', (e) => { if (e.target.closest('button') || (imageVerticalFileList && imageVerticalFileList.contains(e.target)) || e.target.closest('label[for="imageFileInput"]')) { return; } imageFileInput.click(); });
+        imageFileInput.addEventListener('change', (e) => { if (e.target.files.length > 0) { addImageFiles(e.target.files); } e.target.value = null; });
+        imageDropZone.addEventListener('dragover', (e) => { e.preventDefault(); imageDropZone.classList.add('border-orange-500', 'bg-orange-50'); });
+        imageDropZone.addEventListener('dragleave', (e) => { if (!imageDropZone.contains(e.relatedTarget)) { imageDropZone.classList.remove('border-orange-500', 'bg-orange-50'); } });
+        imageDropZone.addEventListener('drop', (e) => { e.preventDefault(); imageDropZone.classList.remove('border-orange-500', 'bg-orange-50'); if (e.dataTransfer.files.length > 0) { addImageFiles(e.dataTransfer.files); } });
+        imageConvertForm.addEventListener('submit', function(e) { e.preventDefault(); hideError(); if (selectedImageFiles.length === 0) { showError('err-select-file'); return; } const validationResult = validateImageFiles([]); if (!validationResult.valid || validationResult.mode === 'invalid') { return; } const formData = new FormData(); selectedImageFiles.forEach(file => { formData.append('image_file', file, file.name); }); const imagePagesInput = document.getElementById('imagePages'); if (imagePagesInput && imagePagesInput.value.trim()) { formData.append('pages', imagePagesInput.value.trim()); } [['image_format', 'imageFormat'], ['color_mode', 'imageColorMode'], ['dpi', 'imageDpi'], ['page_size', 'imagePageSize']].forEach(([field, id]) => { const el = document.getElementById(id); if (el && el.value) { formData.append(field, el.value); } }); const csrfInput = imageConvertForm.querySelector('input[name="csrf_token"]'); if (csrfInput && csrfInput.value) { formData.append('csrf_token', csrfInput.value); } else { showError('err-csrf-invalid'); return; } handleFetch( null, null, imageConvertButton, '/convert_image', 'lang-image-convert-btn', formData ); });
+        clearAllImageFilesButton.addEventListener('click', () => { selectedImageFiles = []; validateImageFiles([]); updateImageFileDisplay(); hideError(); });
+        updateImageFileDisplay();
+    } else { console.warn("Missing elements for Card 2"); }
+
+    // Card 3: Compress DOCX
+    const docxCompressEnabled = SOFFICE_AVAILABLE && GS_AVAILABLE;
+    if (docxCompressEnabled && compressDocxFileInput && compressDocxFileStatus && compressDocxForm && compressDocxButton) {
+        compressDocxFileInput.addEventListener('change', function() { hideError(); const file = this.files[0]; const noFileText = compressDocxFileStatus.dataset.langNoFile || (currentLang === 'vi' ? 'Không có tệp nào được chọn' : 'No file selected'); let isValid = false; if (file) { if (!file.name.toLowerCase().endsWith('.docx')) { showError('err-format-docx'); compressDocxFileStatus.textContent = noFileText; this.value = null; } else if (file.size > 101*1024*1024) { showError('err-file-too-large'); compressDocxFileStatus.textContent = noFileText; this.value = null; } else { compressDocxFileStatus.textContent = file.name; isValid = true; } } else { compressDocxFileStatus.textContent = noFileText; } compressDocxButton.disabled = !isValid; });
+        compressDocxForm.addEventListener('submit', function(e) { e.preventDefault(); hideError(); if (!compressDocxFileInput.files || compressDocxFileInput.files.length === 0) { showError('err-select-file'); return; } const file = compressDocxFileInput.files[0]; if (!file.name.toLowerCase().endsWith('.docx')) { showError('err-format-docx'); return; } if (file.size > 101*1024*1024) { showError('err-file-too-large'); return; } handleFetch(compressDocxForm, null, compressDocxButton, '/compress_docx', 'lang-compress-docx-btn'); });
+        compressDocxButton.disabled = true;
+    } else if (!docxCompressEnabled && compressDocxCard) { console.warn("Compress DOCX disabled"); }
+      else if (docxCompressEnabled) { console.warn("Missing elements for Card 3"); }
+
+    // Card 4: Compress PDF
+    if (GS_AVAILABLE && compressFileInput && compressFileStatus && compressQualitySelect && compressForm && compressButton) {
+        compressFileInput.addEventListener('change', function() { hideError(); const file = this.files[0]; const noFileText = compressFileStatus.dataset.langNoFile || (currentLang === 'vi' ? 'Không có tệp nào được chọn' : 'No file selected'); let isValid = false; if (file) { if (!file.name.toLowerCase().endsWith('.pdf')) { showError('err-format-pdf'); compressFileStatus.textContent = noFileText; this.value = null; } else if (file.size > 101*1024*1024) { showError('err-file-too-large'); compressFileStatus.textContent = noFileText; this.value = null; } else { compressFileStatus.textContent = file.name; isValid = true; } } else { compressFileStatus.textContent = noFileText; } compressButton.disabled = !isValid; loadPreview(isValid ? file : null, document.getElementById('compressPreview')); });
+        compressForm.addEventListener('submit', function(e) { e.preventDefault(); hideError(); if (!compressFileInput.files || compressFileInput.files.length === 0) { showError('err-select-file'); return; } const file = compressFileInput.files[0]; if (!file.name.toLowerCase().endsWith('.pdf')) { showError('err-format-pdf'); return; } if (file.size > 101*1024*1024) { showError('err-file-too-large'); return; } const targetMbInput = document.getElementById('compressTargetMb'); const targetBytesInput = document.getElementById('compressTargetBytes'); if (targetBytesInput) { const targetMb = targetMbInput ? parseFloat(targetMbInput.value) : NaN; targetBytesInput.value = targetMb > 0 ? Math.round(targetMb * 1024 * 1024) : ''; } handleFetch(compressForm, null, compressButton, '/compress_pdf', 'lang-compress-btn'); });
+        compressButton.disabled = true;
+    } else if (!GS_AVAILABLE && compressCard) { console.warn("Compress PDF disabled"); }
+      else if (GS_AVAILABLE) { console.warn("Missing elements for Card 4"); }
+}
+
+// Initial Setup on DOMContentLoaded
+document.addEventListener('DOMContentLoaded', function() {
+    const savedLang = localStorage.getItem('preferred-language'); const browserLang = navigator.language.split('-')[0]; const initialLang = savedLang || (browserLang === 'vi' ? 'vi' : 'en'); const finalInitialLang = ['en', 'vi'].includes(initialLang) ? initialLang : 'en'; if(languageSelector) languageSelector.value = finalInitialLang;
+    updateLanguage(finalInitialLang).then(() => {
+         setupEventListeners();
+         const fileInputPairs = [ { status: fileStatus, input: fileInput, button: convertButton }, { status: compressFileStatus, input: compressFileInput, button: compressButton }, { status: compressDocxFileStatus, input: compressDocxFileInput, button: compressDocxButton } ];
+         fileInputPairs.forEach(pair => { if (pair.status && pair.input && pair.button) { const noFileText = pair.status.dataset.langNoFile || (currentLang === 'vi' ? 'Không có tệp nào được chọn' : 'No file selected'); if (!pair.input.files || pair.input.files.length === 0) { pair.status.textContent = noFileText; pair.button.disabled = true; } } });
+         updateImageFileDisplay();
+         if (conversionTypeSelect && conversionTypeSelect.options[0].disabled) { conversionTypeSelect.options[0].textContent = currentTranslations['lang-select-conversion'] || (currentLang === 'vi' ? 'Chọn kiểu chuyển đổi' : 'Select conversion type'); }
+         console.log("Initial setup complete.");
+    });
+});
@@ -0,0 +1,34 @@
+// Web Worker của trang chính: thu nhỏ + nén lại ảnh JPEG trước khi upload (image_to_pdf) và tính sha256 để hỏi server kết quả đã có.
+// Kích thước đích giống convert_images_to_pdf: ảnh (đã xoay theo EXIF) vừa khổ trang ở DPI đã chọn, không phóng to.
+let pending = Promise.resolve(); // Xử lý lần lượt từng ảnh: nhiều ảnh 12MP giải mã cùng lúc dễ làm tab điện thoại hết RAM
+
+async function sha256Hex(blob) {
+    if (!self.crypto || !crypto.subtle) { return null; } // crypto.subtle chỉ có trên HTTPS/localhost
+    const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function shrinkImage(file, box, maxDpi, quality) {
+    if (typeof OffscreenCanvas === 'undefined' || typeof createImageBitmap === 'undefined') { return null; }
+    const bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+    try {
+        let [boxW, boxH] = box; if (bitmap.width > bitmap.height) { [boxW, boxH] = [boxH, boxW]; } // Ảnh ngang -> trang ngang
+        const scale = Math.min(1, maxDpi / Math.max(bitmap.width / boxW, bitmap.height / boxH));
+        if (scale >= 0.95) { return null; } // Đã gần đúng kích thước: nén lại chỉ làm giảm chất lượng
+        const width = Math.max(1, Math.round(bitmap.width * scale)); const height = Math.max(1, Math.round(bitmap.height * scale));
+        const canvas = new OffscreenCanvas(width, height); const ctx = canvas.getContext('2d');
+        ctx.imageSmoothingQuality = 'high'; ctx.drawImage(bitmap, 0, 0, width, height);
+        const blob = await canvas.convertToBlob({ type: 'image/jpeg', quality });
+        return blob.size < file.size ? blob : null;
+    } finally { bitmap.close(); }
+}
+
+async function handle({ id, file, box, maxDpi, quality }) {
+    try {
+        let blob = null;
+        if (box) { try { blob = await shrinkImage(file, box, maxDpi, quality); } catch (shrinkError) { console.warn(`Could not shrink ${file.name}:`, shrinkError); } }
+        self.postMessage({ id, blob, sha256: await sha256Hex(blob || file) });
+    } catch (error) { self.postMessage({ id, blob: null, sha256: null, error: String(error) }); }
+}
+
+self.onmessage = (event) => { pending = pending.then(() => handle(event.data)); };
@@ -0,0 +1,7 @@
+// Dùng bởi build_assets.py (Tailwind standalone CLI v3): chỉ giữ class xuất hiện trong các file dưới đây.
+// Class sinh động trong JS phải viết nguyên chuỗi (vd 'bg-blue-500'), không ghép chuỗi, để Tailwind tìm thấy.
+module.exports = {
+  content: ['./templates/**/*.html', './static/app.js'],
+  theme: { extend: {} },
+  plugins: [],
+}